@@ -18,6 +18,6 @@ from .people        import * # Depends on utils, defaults, base, plotting
 from .population    import * # Depends on people et al.
 from .interventions import * # Depends on defaults, utils, base
 from .immunity      import * # Depends on utils, parameters, defaults
-from .analysis      import * # Depends on utils, misc, interventions
+from .analysis      import * # Depends on utils, base, misc, interventions
 from .sim           import * # Depends on almost everything
 from .run           import * # Depends on sim
@@ -9,6 +9,7 @@ import pylab as pl
 import pandas as pd
 import sciris as sc
 from . import utils as cvu
+from . import base as cvb
 from . import misc as cvm
 from . import interventions as cvi
 from . import settings as cvset
@@ -667,8 +668,8 @@ class daily_stats(Analyzer):
 
             # Source stats
             inflog = sim.people.infection_log
-            infloginds = [i for i,e in enumerate(inflog) if (e['date']==sim.t and e['source'] is not None)] # Person was infected today and was not a seed infection
-            sourceinds = list(set([inflog[i]['source'] for i in infloginds]))
+            infloginds = cvu.true((inflog.date == sim.t) & (inflog.source >= 0)) # Person was infected today and was not a seed infection
+            sourceinds = np.unique(inflog.source[infloginds])
             stats.source.new_sources = len(sourceinds)
             for key in self.keys:
                 stats.source[key] = len(self.intersect(sourceinds, key))
@@ -1486,6 +1487,8 @@ class TransTree(Analyzer):
 
         # Include the basic line list -- copying directly is slow, so we'll make a copy later
         self.infection_log = people.infection_log
+        if not isinstance(self.infection_log, cvb.InfectionLog): # E.g. a list of dicts from a saved sim
+            self.infection_log = cvb.InfectionLog(self.infection_log)
 
         # Parse into sources and targets
         self.sources = [None for i in range(self.pop_size)]
@@ -1493,15 +1496,13 @@ class TransTree(Analyzer):
         self.source_dates = [None for i in range(self.pop_size)]
         self.target_dates = [[]   for i in range(self.pop_size)]
 
-        for entry in self.infection_log:
-            source = entry['source']
-            target = entry['target']
-            date   = entry['date']
-            if source:
-                self.sources[target] = source # Each target has at most one source
-                self.targets[source].append(target) # Each source can have multiple targets
-                self.source_dates[target] = date # Each target has at most one source
-                self.target_dates[source].append(date) # Each source can have multiple targets
+        log = self.infection_log
+        has_source = log.source >= 0 # Skip seed infections
+        for source,target,date in zip(log.source[has_source].tolist(), log.target[has_source].tolist(), log.date[has_source].tolist()):
+            self.sources[target] = source # Each target has at most one source
+            self.targets[source].append(target) # Each source can have multiple targets
+            self.source_dates[target] = date # Each target has at most one source
+            self.target_dates[source].append(date) # Each source can have multiple targets
 
         # Count the number of targets each person has, and the list of transmissions
         self.count_targets()
@@ -1525,7 +1526,7 @@ class TransTree(Analyzer):
                 self.graph.add_node(i, **d)
 
             # Next, add edges from linelist
-            for edge in people.infection_log:
+            for edge in self.infection_log:
                 self.graph.add_edge(edge['source'],edge['target'],date=edge['date'],layer=edge['layer'])
 
         return
@@ -1586,16 +1587,11 @@ class TransTree(Analyzer):
 
         This excludes edges corresponding to seeded infections without a source
         """
-        source_inds = []
-        target_inds = []
-        transmissions = []
-        for d in self.infection_log:
-            if d['source'] is not None:
-                src = d['source']
-                trg = d['target']
-                source_inds.append(src)
-                target_inds.append(trg)
-                transmissions.append([src, trg])
+        log = self.infection_log
+        has_source = log.source >= 0
+        source_inds = log.source[has_source].tolist()
+        target_inds = log.target[has_source].tolist()
+        transmissions = [[src, trg] for src,trg in zip(source_inds, target_inds)]
         self.transmissions = transmissions
         self.source_inds = source_inds
         self.target_inds = target_inds
@@ -1613,7 +1609,7 @@ class TransTree(Analyzer):
             return arrdict
 
         # Convert infection log to a dataframe and from there to a dict of arrays
-        inflog = df_to_arrdict(sc.dcp(pd.DataFrame(self.infection_log)))
+        inflog = df_to_arrdict(self.infection_log.to_df())
 
         # Initialization
         n_people = len(people)
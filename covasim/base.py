@@ -4,6 +4,7 @@ People and Sim classes (e.g. loading, saving, key lookups, etc.), so those class
 can be focused on the disease-specific functionality.
 '''
 
+import os
 import numpy as np
 import pandas as pd
 import sciris as sc
@@ -13,9 +14,10 @@ from . import utils as cvu
 from . import misc as cvm
 from . import defaults as cvd
 from . import parameters as cvpar
+from .settings import options as cvo
 
 # Specify all externally visible classes this file defines
-__all__ = ['ParsObj', 'Result', 'BaseSim', 'BasePeople', 'Person', 'FlexDict', 'Contacts', 'Layer']
+__all__ = ['ParsObj', 'Result', 'BaseSim', 'ColumnBuffer', 'PackedStates', 'PackedArray', 'DayArray', 'BasePeople', 'Person', 'FlexDict', 'Contacts', 'Layer', 'InfectionLog']
 
 
 #%% Define simulation classes
@@ -841,6 +843,625 @@ class BaseSim(ParsObj):
 
 #%% Define people classes
 
+class ColumnBuffer(object):
+    '''
+    A single contiguous buffer that stores arrays of different dtypes and shapes
+    as columns, each starting on an aligned boundary, with a table of the offset,
+    shape, and dtype of each column. The arrays are views into the buffer, so the
+    whole set of arrays can be copied, saved, or shared as one block of memory.
+    Used by People if ``cv.options.columnar_people`` is set.
+
+    Args:
+        columns (dict): the shape and dtype of each column, e.g. {'age':(1000, np.float32)}
+        buffer (array): a uint8 array of at least nbytes to use as the buffer, e.g. a memory map; if None, allocate a new one, filled with zeros
+
+    **Example**::
+
+        cb = cv.ColumnBuffer({'age':(100, np.float32), 'sus_imm':((2,100), np.float32)})
+        cb['age'][:] = 30
+    '''
+
+    align = 64 # Alignment of each column, in bytes
+
+    def __init__(self, columns, buffer=None):
+        self.table, self.nbytes = self.layout(columns)
+        if buffer is None:
+            buffer = self.allocate(self.nbytes)
+        elif len(buffer) < self.nbytes: # pragma: no cover
+            errormsg = f'Buffer of {len(buffer)} bytes is too small for columns of {self.nbytes} bytes'
+            raise ValueError(errormsg)
+        self.buffer = buffer
+        self.make_views()
+        return
+
+
+    @classmethod
+    def layout(cls, columns):
+        ''' Work out the offset of each column, and the total number of bytes needed, e.g. to allocate a buffer elsewhere '''
+        table = {}
+        offset = 0
+        for key,(shape,dtype) in columns.items():
+            shape = tuple(np.atleast_1d(shape).tolist())
+            dtype = np.dtype(dtype)
+            table[key] = (offset, shape, dtype)
+            nbytes = int(np.prod(shape))*dtype.itemsize
+            offset += -(-nbytes//cls.align)*cls.align # Round up to the next aligned boundary
+        return table, offset
+
+
+    @classmethod
+    def allocate(cls, nbytes):
+        ''' Allocate an aligned buffer of zeros '''
+        raw = np.zeros(nbytes + cls.align, dtype=np.uint8)
+        start = -raw.ctypes.data % cls.align
+        return raw[start:start+nbytes]
+
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        ''' Create a buffer from a dictionary of arrays, copying them in '''
+        cb = cls({key:(np.shape(arr), np.asarray(arr).dtype) for key,arr in arrays.items()})
+        for key,arr in arrays.items():
+            cb.arrays[key][...] = arr
+        return cb
+
+
+    def make_views(self):
+        ''' Create the array for each column, as a view into the buffer '''
+        self.arrays = {}
+        for key,(offset,shape,dtype) in self.table.items():
+            nbytes = int(np.prod(shape))*dtype.itemsize
+            self.arrays[key] = self.buffer[offset:offset+nbytes].view(dtype).reshape(shape)
+        return
+
+
+    def __getitem__(self, key):
+        return self.arrays[key]
+
+
+    def __contains__(self, key):
+        return key in self.table
+
+
+    def keys(self):
+        return list(self.table.keys())
+
+
+    def resized(self, shapes):
+        '''
+        Return a new buffer with some columns resized, keeping the values that fit,
+        as ndarray.resize() does.
+
+        Args:
+            shapes (dict): the new shape of each column to resize
+        '''
+        cb = ColumnBuffer({key:(shapes.get(key, shape), dtype) for key,(offset,shape,dtype) in self.table.items()})
+        for key,arr in self.arrays.items():
+            new = cb.arrays[key].reshape(-1)
+            n = min(arr.size, new.size)
+            new[:n] = arr.reshape(-1)[:n]
+        return cb
+
+
+    def __getstate__(self):
+        ''' Don't save the views, since they can be regenerated '''
+        state = self.__dict__.copy()
+        state.pop('arrays', None)
+        return state
+
+
+    def __setstate__(self, state):
+        ''' Regenerate the views, copying the buffer if it isn't aligned for the dtypes of the columns '''
+        self.__dict__.update(state)
+        if any(self.buffer.ctypes.data % dtype.alignment for offset,shape,dtype in self.table.values()):
+            buffer = self.allocate(self.nbytes)
+            buffer[:] = self.buffer[:self.nbytes]
+            self.buffer = buffer
+        self.make_views()
+        return
+
+
+    def __deepcopy__(self, memo):
+        ''' Copy the buffer into a new aligned buffer in a single step '''
+        buffer = self.allocate(self.nbytes)
+        buffer[:] = self.buffer[:self.nbytes]
+        return ColumnBuffer({key:(shape, dtype) for key,(offset,shape,dtype) in self.table.items()}, buffer=buffer)
+
+
+class PackedStates(object):
+    '''
+    Boolean states held as bits rather than as one byte per person: the states of
+    each person are packed into a single state word, with one bit (flag) per state,
+    and each state by variant is held as one bitset per variant, with one bit per
+    person. Each state is accessed via a PackedArray, which can be used like a
+    Boolean array, e.g. ``people.infectious[inds] = True``. Used by People if
+    ``cv.options.packed_states`` is set.
+
+    Args:
+        states (list): the names of the states held in the state words
+        by_variant (list): the names of the states held as bitsets by variant
+        n (int): the number of people
+        n_variants (int): the number of variants
+        true (list): the states that are initially true for everyone
+
+    **Example**::
+
+        ps = cv.PackedStates(['susceptible', 'exposed'], ['exposed_by_variant'], n=100, n_variants=2, true=['susceptible'])
+        arrays = ps.views()
+        arrays['exposed'][:10] = True
+        arrays['exposed'].count_nonzero() # Returns 10
+        ps.match(dict(susceptible=True, exposed=False)) # Returns the indices of people 10-99
+    '''
+
+    def __init__(self, states, by_variant, n, n_variants, true=None):
+        nbits = max(8, 2**int(np.ceil(np.log2(max(len(states), 1))))) # The smallest unsigned integer with a bit for each state
+        if nbits > 64: # pragma: no cover
+            errormsg = f'Cannot pack {len(states)} states into a 64-bit word'
+            raise ValueError(errormsg)
+        dtype = np.dtype(f'uint{nbits}')
+        self.flags = {key:dtype.type(1 << b) for b,key in enumerate(states)}
+        self.n = int(n)
+        self.words = np.zeros(self.n, dtype=dtype)
+        default = sum(int(self.flags[key]) for key in sc.promotetolist(true))
+        if default:
+            self.words[:] = default
+        self.bitsets = {key:np.zeros((n_variants, self.n_words(self.n)), dtype=np.uint64) for key in by_variant}
+        return
+
+
+    @staticmethod
+    def n_words(n):
+        ''' The number of 64-bit words needed for a bitset of n people '''
+        return -(-n//64)
+
+
+    def __contains__(self, key):
+        return key in self.flags or key in self.bitsets
+
+
+    def keys(self):
+        return list(self.flags.keys()) + list(self.bitsets.keys())
+
+
+    def views(self):
+        ''' Return an array-like view of each state '''
+        return {key:PackedArray(self, key) for key in self.keys()}
+
+
+    def resize(self, key=None, new_size=None):
+        '''
+        Change the number of people, as ndarray.resize() does: people who are added
+        have every state false. If a key for a state by variant and a tuple of
+        (variants, people) is supplied, also change the number of variants.
+        '''
+        n_variants = None
+        if isinstance(new_size, tuple):
+            n_variants, new_size = new_size
+        n = int(new_size)
+        if n != self.n:
+            words = np.zeros(n, dtype=self.words.dtype)
+            n_keep = min(n, self.n)
+            words[:n_keep] = self.words[:n_keep]
+            self.words = words
+            for bkey,bits in self.bitsets.items():
+                self.bitsets[bkey] = self._resize_bits(bits, bits.shape[0], n)
+            self.n = n
+        if n_variants is not None and key in self.bitsets:
+            self.bitsets[key] = self._resize_bits(self.bitsets[key], n_variants, n)
+        return
+
+
+    def _resize_bits(self, bits, n_variants, n):
+        ''' Copy a bitset into one for a different number of variants or people, clearing any bits past the last person '''
+        new = np.zeros((n_variants, self.n_words(n)), dtype=np.uint64)
+        nv = min(n_variants, bits.shape[0])
+        nw = min(new.shape[1], bits.shape[1])
+        new[:nv,:nw] = bits[:nv,:nw]
+        if n % 64 and new.shape[1]:
+            new[:,-1] &= np.uint64((1 << (n % 64)) - 1)
+        return new
+
+
+    def set(self, key, value):
+        ''' Set every value of a state, resizing if needed '''
+        value = np.asarray(value, dtype=bool)
+        arr = PackedArray(self, key)
+        if value.shape != arr.shape:
+            self.resize(key, value.shape if value.ndim == 2 else value.shape[-1])
+        arr[...] = value
+        return
+
+
+    def unpack(self, keys):
+        ''' Unpack several states into Boolean arrays, in a single pass '''
+        flags = np.array([self.flags[key] for key in keys], dtype=self.words.dtype)
+        return list(cvu.unpack_bits(self.words, flags))
+
+
+    def match(self, states):
+        '''
+        Return the indices of the people whose states all match the given values,
+        in a single pass over the state words
+
+        Args:
+            states (dict): the value of each state to match, e.g. dict(symptomatic=True, diagnosed=False)
+        '''
+        mask = 0
+        value = 0
+        for key,val in states.items():
+            mask |= int(self.flags[key])
+            if val:
+                value |= int(self.flags[key])
+        dtype = self.words.dtype.type
+        return cvu.match_bits(self.words, dtype(mask), dtype(value))
+
+
+class ArrayView(np.lib.mixins.NDArrayOperatorsMixin):
+    '''
+    Base class for objects that store a people array in a different form (e.g.
+    as bits), but can be indexed and assigned to like the array. Arithmetic and
+    NumPy functions operate on a copy of the whole array, as returned by np.asarray().
+    Since the storage is not an array, the view should be modified in place
+    (e.g. ``arr[inds] = True``) rather than replaced; BasePeople does this when
+    a key is set. Subclasses define shape, dtype, __getitem__, __setitem__, assign,
+    and resize.
+    '''
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+
+    def __array__(self, dtype=None):
+        out = self[...]
+        return out if dtype is None else out.astype(dtype)
+
+
+    def __array_ufunc__(self, ufunc, method, *inputs, out=None, **kwargs):
+        ''' Operate on copies of the arrays; for in-place operations (e.g. ``arr |= mask``), write the result back '''
+        inputs = [np.asarray(x) if isinstance(x, ArrayView) else x for x in inputs]
+        if out is not None:
+            if isinstance(out[0], ArrayView):
+                out[0][...] = getattr(ufunc, method)(*inputs, **kwargs)
+                return out[0]
+            kwargs['out'] = out
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+
+    def __iter__(self):
+        return iter(np.asarray(self))
+
+    def copy(self):
+        return np.asarray(self)
+
+    def astype(self, dtype, **kwargs):
+        return np.asarray(self).astype(dtype, **kwargs)
+
+    def sum(self, *args, **kwargs):
+        return np.asarray(self).sum(*args, **kwargs)
+
+    def any(self, *args, **kwargs):
+        return np.asarray(self).any(*args, **kwargs)
+
+    def all(self, *args, **kwargs):
+        return np.asarray(self).all(*args, **kwargs)
+
+    def tolist(self):
+        return np.asarray(self).tolist()
+
+
+class PackedArray(ArrayView):
+    '''
+    A Boolean array of one state of a PackedStates object, which reads and writes
+    the bits of the state (see ArrayView).
+
+    Args:
+        packed (PackedStates): the object holding the states
+        key (str): the state
+    '''
+
+    def __init__(self, packed, key):
+        self.packed = packed
+        self.key = key
+        return
+
+
+    @property
+    def by_variant(self):
+        return self.key in self.packed.bitsets
+
+    @property
+    def shape(self):
+        if self.by_variant:
+            return (self.packed.bitsets[self.key].shape[0], self.packed.n)
+        return (self.packed.n,)
+
+    @property
+    def dtype(self):
+        return np.dtype(bool)
+
+
+    def _inds(self, key):
+        ''' Convert an index of people to an array of indices (None for everyone), and whether it was a single person '''
+        n = self.packed.n
+        if key is Ellipsis or (isinstance(key, slice) and key == slice(None)):
+            return None, False
+        elif isinstance(key, slice):
+            return np.arange(n)[key], False
+        elif isinstance(key, (int, np.integer)):
+            ind = int(key) + n if key < 0 else int(key)
+            if not 0 <= ind < n:
+                errormsg = f'Index {key} is out of bounds for {n} people'
+                raise IndexError(errormsg)
+            return np.array([ind]), True
+        inds = np.asarray(key)
+        if inds.dtype == bool:
+            if len(inds) != n:
+                errormsg = f'Boolean index of length {len(inds)} does not match {n} people'
+                raise IndexError(errormsg)
+            return inds.nonzero()[0], False
+        if not np.issubdtype(inds.dtype, np.integer):
+            if inds.size: # pragma: no cover
+                errormsg = f'Arrays used as indices must be of integer or Boolean type, not {inds.dtype}'
+                raise IndexError(errormsg)
+            inds = inds.astype(np.int64)
+        inds = inds.ravel()
+        if len(inds):
+            if inds.min() < 0:
+                inds = np.where(inds < 0, inds + n, inds)
+            if inds.min() < 0 or inds.max() >= n:
+                errormsg = f'Indices are out of bounds for {n} people'
+                raise IndexError(errormsg)
+        return inds, False
+
+
+    def _split(self, key):
+        ''' For a state by variant, split the index into the variants and the people '''
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        if len(key) != 2: # pragma: no cover
+            errormsg = f'Expecting an index of variants and people, not {key}'
+            raise IndexError(errormsg)
+        variants = np.arange(self.shape[0])[key[0]]
+        return variants, key[1]
+
+
+    def _get(self, variant, inds):
+        ''' Read the state of the given people, for the given variant if a state by variant '''
+        packed = self.packed
+        if variant is None:
+            flag = packed.flags[self.key]
+            if inds is None:
+                return (packed.words & flag) != 0
+            return cvu.get_bits(packed.words, flag, inds)
+        else:
+            bits = packed.bitsets[self.key][variant]
+            if inds is None:
+                return cvu.unpack_bitset(bits, packed.n)
+            return cvu.get_bitset(bits, inds)
+
+
+    def _set(self, variant, inds, values):
+        ''' Write the state of the given people, for the given variant if a state by variant '''
+        packed = self.packed
+        values = np.asarray(values, dtype=bool).ravel()
+        n = packed.n if inds is None else len(inds)
+        if len(values) not in [1, n]:
+            errormsg = f'Could not assign {len(values)} values to {n} people'
+            raise ValueError(errormsg)
+        if variant is None:
+            flag = packed.flags[self.key]
+            if inds is None and len(values) == 1:
+                if values[0]:
+                    packed.words |= flag
+                else:
+                    packed.words &= ~flag
+            else:
+                cvu.set_bits(packed.words, flag, np.arange(n) if inds is None else inds, values)
+        else:
+            bits = packed.bitsets[self.key][variant]
+            cvu.set_bitset(bits, np.arange(n) if inds is None else inds, values)
+        return
+
+
+    def __getitem__(self, key):
+        if not self.by_variant:
+            inds, scalar = self._inds(key)
+            out = self._get(None, inds)
+            return out[0] if scalar else out
+        variants, key = self._split(key)
+        inds, scalar = self._inds(key)
+        if np.ndim(variants) == 0:
+            out = self._get(variants, inds)
+            return out[0] if scalar else out
+        out = np.empty((len(variants), self.packed.n if inds is None else len(inds)), dtype=bool)
+        for v,variant in enumerate(variants):
+            out[v] = self._get(variant, inds)
+        return out[:,0] if scalar else out
+
+
+    def __setitem__(self, key, value):
+        if not self.by_variant:
+            inds, scalar = self._inds(key)
+            self._set(None, inds, value)
+            return
+        variants, key = self._split(key)
+        inds, scalar = self._inds(key)
+        if np.ndim(variants) == 0:
+            self._set(variants, inds, value)
+        else:
+            value = np.asarray(value, dtype=bool)
+            for v,variant in enumerate(variants):
+                self._set(variant, inds, value[v] if value.ndim == 2 else value)
+        return
+
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}("{self.key}", {np.asarray(self)!r})'
+
+
+    def nonzero(self):
+        ''' The indices where the state is true, as for a Boolean array '''
+        if not self.by_variant:
+            flag = self.packed.flags[self.key]
+            return (cvu.match_bits(self.packed.words, flag, flag),)
+        return np.asarray(self).nonzero()
+
+
+    def count_nonzero(self, variant=None):
+        ''' The number of people in the state, optionally only for the given variant '''
+        if not self.by_variant:
+            return cvu.count_bits(self.packed.words, self.packed.flags[self.key])
+        bits = self.packed.bitsets[self.key]
+        variants = range(len(bits)) if variant is None else [variant]
+        return sum(cvu.popcount(bits[v]) for v in variants)
+
+
+    def assign(self, value):
+        ''' Set every value, resizing if needed '''
+        self.packed.set(self.key, value)
+        return
+
+
+    def resize(self, new_shape, refcheck=True):
+        ''' Change the size of the state, as ndarray.resize() does; note that for states in the state words, this changes every state '''
+        self.packed.resize(self.key, new_shape)
+        return
+
+
+class DayArray(ArrayView):
+    '''
+    An array of dates or durations in whole days, stored as 16- or 32-bit integers,
+    with the largest integer meaning "undefined". It is read and written as floats
+    (see ArrayView), with NaN for undefined, so it can be used in place of the float
+    arrays of dates and durations of People, converting values only as they are
+    used. Used by People if ``cv.options.compact_days`` is set.
+
+    Since days are stored as integers, only whole days can be stored, e.g. dates
+    and durations drawn from integer distributions (the default, e.g. 'lognormal_int').
+
+    Args:
+        n (int): the number of people; all are initially undefined
+        bits (int): the size of the integers, 16 or 32
+        dtype (type): the float type used to read the days
+
+    **Example**::
+
+        days = cv.DayArray(100)
+        days[:10] = 5
+        days.due(t=4) # Returns an empty array
+        days.due(t=5) # Returns array([0, 1, ..., 9])
+    '''
+
+    def __init__(self, n=0, bits=16, dtype=None):
+        bits = 16 if bits is True else bits
+        if bits not in [16, 32]:
+            errormsg = f'Days can be stored as 16- or 32-bit integers, not {bits}-bit'
+            raise ValueError(errormsg)
+        self.days = np.full(int(n), np.iinfo(f'int{bits}').max, dtype=f'int{bits}')
+        self.fdtype = np.dtype(cvd.default_float if dtype is None else dtype)
+        return
+
+
+    @property
+    def undefined_day(self):
+        ''' The value stored for undefined days '''
+        return np.iinfo(self.days.dtype).max
+
+    @property
+    def shape(self):
+        return self.days.shape
+
+    @property
+    def dtype(self):
+        return self.fdtype
+
+
+    def encode(self, values):
+        ''' Convert days as floats, with NaN for undefined, to integers '''
+        values = np.asarray(values, dtype=np.float64)
+        undefined = np.isnan(values)
+        days = np.where(undefined, 0, values)
+        info = np.iinfo(self.days.dtype)
+        if np.any(days != np.floor(days)):
+            errormsg = 'Only whole days can be stored as integers; use integer distributions for durations, or turn off cv.options.compact_days'
+            raise ValueError(errormsg)
+        if np.any(days < info.min) or np.any(days >= info.max):
+            errormsg = f'Days are out of range for {info.bits}-bit integers; use cv.options.set(compact_days=32), or turn off cv.options.compact_days'
+            raise ValueError(errormsg)
+        days = days.astype(self.days.dtype)
+        days[undefined] = info.max
+        return days
+
+
+    def decode(self, days):
+        ''' Convert days as integers to floats, with NaN for undefined '''
+        undefined = days == self.undefined_day
+        values = np.asarray(days, dtype=self.fdtype)
+        if values.ndim:
+            values[undefined] = np.nan
+            return values
+        return self.fdtype.type(np.nan) if undefined else values[()]
+
+
+    def __getitem__(self, key):
+        return self.decode(self.days[key])
+
+
+    def __setitem__(self, key, value):
+        self.days[key] = self.encode(value)
+        return
+
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({np.asarray(self)!r})'
+
+
+    def due(self, t, inds=None):
+        '''
+        Return the people whose day is on or before day t, optionally only among
+        the given people. Since undefined days are stored as the largest integer,
+        this is a single integer comparison, without checking for undefined days.
+        '''
+        if inds is None:
+            return (self.days <= t).nonzero()[0]
+        return inds[self.days[inds] <= t]
+
+
+    def defined(self):
+        ''' Return the people whose day is defined '''
+        return (self.days != self.undefined_day).nonzero()[0]
+
+
+    def undefined(self):
+        ''' Return the people whose day is undefined '''
+        return (self.days == self.undefined_day).nonzero()[0]
+
+
+    def assign(self, value):
+        ''' Set every value, resizing if needed '''
+        value = np.asarray(value)
+        if value.shape != self.shape:
+            self.days = np.empty(value.shape, dtype=self.days.dtype)
+        self[...] = value
+        return
+
+
+    def resize(self, new_shape, refcheck=True):
+        ''' Change the number of people, as ndarray.resize() does, i.e. filling with zeros '''
+        days = np.zeros(new_shape, dtype=self.days.dtype)
+        n = min(days.size, self.days.size)
+        days.reshape(-1)[:n] = self.days.reshape(-1)[:n]
+        self.days = days
+        return
+
 class BasePeople(FlexPretty):
     '''
     A class to handle all the boilerplate for people -- note that as with the
@@ -848,6 +1469,30 @@ class BasePeople(FlexPretty):
     whereas this class exists to handle the less interesting implementation details.
     '''
 
+    _state_inds = None # Optional index sets of the people in each state; see init_state_inds()
+    _indexed_states = ['exposed', 'infectious', 'symptomatic', 'severe', 'critical', 'quarantined', 'exposed_by_variant', 'infectious_by_variant'] # States that people leave, so only a small fraction are in them at once
+    _columns = None # Optional buffer that holds all the people arrays; see init_arrays()
+    _packed = None # Optional bits that hold the Boolean states; see PackedStates
+    _lazy = None # The arrays that are only created when first used, by key; see init_arrays()
+
+    def __getstate__(self):
+        ''' If the arrays are held in a single buffer, save the buffer rather than each array '''
+        self.pack_columns()
+        state = self.__dict__.copy()
+        if self._columns is not None:
+            for key in self._columns.keys():
+                state.pop(key, None)
+        return state
+
+
+    def __setstate__(self, state):
+        ''' Restore the arrays as views into the buffer, if used '''
+        self.__dict__.update(state)
+        if self._columns is not None:
+            self.__dict__.update(self._columns.arrays)
+        return
+
+
     def __getitem__(self, key):
         ''' Allow people['attr'] instead of getattr(people, 'attr')
             If the key is an integer, alias `people.person()` to return a `Person` instance
@@ -856,19 +1501,36 @@ class BasePeople(FlexPretty):
         try:
             return self.__dict__[key]
         except: # pragma: no cover
-            if isinstance(key, int):
+            if self._lazy and key in self._lazy:
+                return getattr(self, key)
+            elif isinstance(key, int):
                 return self.person(key)
             else:
                 errormsg = f'Key "{key}" is not a valid attribute of people'
                 raise AttributeError(errormsg)
 
 
+    def __getattr__(self, key):
+        ''' Create arrays that have not been used yet on first access; see init_arrays() '''
+        if self._lazy and key in self._lazy:
+            self.alloc_arrays(key)
+            return self.__dict__[key]
+        errormsg = f"'{self.__class__.__name__}' object has no attribute '{key}'"
+        raise AttributeError(errormsg)
+
+
     def __setitem__(self, key, value):
         ''' Ditto '''
-        if self._lock and key not in self.__dict__: # pragma: no cover
+        if self._lock and key not in self.__dict__ and not (self._lazy and key in self._lazy): # pragma: no cover
             errormsg = f'Key "{key}" is not a current attribute of people, and the people object is locked; see people.unlock()'
             raise AttributeError(errormsg)
-        self.__dict__[key] = value
+        current = self.__dict__.get(key)
+        if isinstance(current, ArrayView) and not isinstance(value, ArrayView): # Write the values into the storage (e.g. bits) rather than replacing it
+            current.assign(value)
+        else:
+            self.__dict__[key] = value
+        if self._state_inds is not None and key in self._state_inds.states: # Replacing a state array invalidates its index set
+            self._state_inds = None
         return
 
 
@@ -900,7 +1562,9 @@ class BasePeople(FlexPretty):
         newpeople = sc.dcp(self)
         keys = list(self.keys())
         for key in keys:
-            npval = newpeople[key]
+            if not self.allocated(key) and not people2.allocated(key): # Leave it to be created on first use
+                continue
+            npval = self[key] # Not newpeople, since packed states are resized together when the first one is set
             p2val = people2[key]
             if npval.ndim == 1:
                 newpeople.set(key, np.concatenate([npval, p2val], axis=0), die=False) # Allow size mismatch
@@ -916,6 +1580,7 @@ class BasePeople(FlexPretty):
 
         # Reassign UIDs so they're unique
         newpeople.set('uid', np.arange(len(newpeople)))
+        newpeople.pack_columns()
 
         return newpeople
 
@@ -952,6 +1617,9 @@ class BasePeople(FlexPretty):
         if die and len(value) != len(current): # pragma: no cover
             errormsg = f'Length of new array does not match current ({len(value)} vs. {len(current)})'
             raise IndexError(errormsg)
+        if self._columns is not None and key in self._columns and current is self._columns[key] and value.shape == current.shape:
+            current[...] = value # Keep the array in the buffer
+            value = current
         self[key] = value
         return
 
@@ -969,34 +1637,173 @@ class BasePeople(FlexPretty):
 
     def true(self, key):
         ''' Return indices matching the condition '''
+        if self._is_indexed(key):
+            return self.state_inds(key)
         return self[key].nonzero()[0]
 
 
     def false(self, key):
         ''' Return indices not matching the condition '''
+        if self._packed is not None and key in self._packed.flags:
+            return self._packed.match({key:False})
         return (~self[key]).nonzero()[0]
 
 
+    def match(self, **states):
+        '''
+        Return the indices of the people whose states all match the given values.
+        If the states are packed into bits (see ``cv.options.packed_states``), this
+        is done in a single compiled pass.
+
+        Args:
+            states (dict): the value of each state to match
+
+        **Example**::
+
+            inds = sim.people.match(symptomatic=True, diagnosed=False, quarantined=False) # People with undiagnosed symptoms outside of quarantine
+        '''
+        if self._packed is not None and all(key in self._packed.flags for key in states):
+            return self._packed.match(states)
+        mask = np.ones(len(self), dtype=bool)
+        for key,value in states.items():
+            if value:
+                mask &= self[key]
+            else:
+                mask &= np.logical_not(self[key])
+        return mask.nonzero()[0]
+
+
     def defined(self, key):
         ''' Return indices of people who are not-nan '''
+        if isinstance(self[key], DayArray):
+            return self[key].defined()
         return (~np.isnan(self[key])).nonzero()[0]
 
 
     def undefined(self, key):
         ''' Return indices of people who are nan '''
+        if isinstance(self[key], DayArray):
+            return self[key].undefined()
         return np.isnan(self[key]).nonzero()[0]
 
 
     def count(self, key):
         ''' Count the number of people for a given key '''
+        if self._is_indexed(key):
+            return self.get_state_inds().counts[key]
+        if self._packed is not None and key in self._packed:
+            return self[key].count_nonzero()
         return np.count_nonzero(self[key])
 
 
     def count_by_variant(self, key, variant):
         ''' Count the number of people for a given key '''
+        if not self.allocated(key): # Only the first variant has circulated, and people who died keep it; see alloc_arrays()
+            return (self.count(self.by_variant_base(key)) + self.count('dead')) if variant == 0 else 0
+        if self._is_indexed(key):
+            return self.get_state_inds().counts[(key, variant)]
+        if self._packed is not None and key in self._packed:
+            return self[key].count_nonzero(variant)
         return np.count_nonzero(self[key][variant,:])
 
 
+    def _is_indexed(self, key):
+        '''
+        Whether the people in this state are tracked by an index set -- only for
+        states that people leave, since reading a set costs O(k log k) for k people
+        in it, so for states that most people end up in (e.g. recovered) it would
+        be slower than checking everyone
+        '''
+        return cvo.state_index and key in self._indexed_states
+
+
+    def init_state_inds(self):
+        '''
+        Initialize index sets and counts of the people in each sparse state counted
+        in the results (see _is_indexed()), so that true() and count() only need to
+        check the people in the set rather than everyone. States must be changed via
+        set_state(), which People does at each point where states are set, so that
+        the counts are kept up to date and people who enter the state are added to
+        the set; people who leave the state are removed the next time the set is used.
+
+        Used if ``cv.options.state_index`` is set. The sets are initialized from
+        the current states on first use, and reset if a state array is replaced.
+        '''
+        inds = {}
+        for key in self._indexed_states:
+            if key not in cvd.result_stocks_by_variant:
+                inds[key] = [self[key].nonzero()[0]]
+            elif self.allocated(key): # Otherwise, counted without the arrays; see count_by_variant()
+                for variant in range(self[key].shape[0]):
+                    inds[(key, variant)] = [self[key][variant,:].nonzero()[0]]
+        counts = {lkey:len(arrs[0]) for lkey,arrs in inds.items()}
+        self._state_inds = sc.objdict(n=len(self), states=set(self._indexed_states), inds=inds, counts=counts)
+        return
+
+
+    def get_state_inds(self):
+        ''' Return the index sets and counts of the people in each state, initializing them if needed; see init_state_inds() '''
+        if self._state_inds is None or self._state_inds.n != len(self):
+            self.init_state_inds()
+        return self._state_inds
+
+
+    def set_state(self, key, inds, value, variant=None):
+        '''
+        Set a state for the given people. If the state is indexed (see init_state_inds()),
+        this also updates its count by the number of people who entered or left it,
+        and adds the people who entered it to its index set.
+
+        Args:
+            key (str): the state, e.g. 'symptomatic'
+            inds (array): the people to set the state for
+            value (bool): the value to set
+            variant (int): for states by variant, the variant to set it for (default: all)
+        '''
+        by_variant = key in self.meta.by_variant_states
+        sinds = self._state_inds
+        if sinds is not None and sinds.n == len(self) and key in sinds.states:
+            inds = np.asarray(inds)
+            variants = [None] if not by_variant else [variant] if variant is not None else range(self[key].shape[0])
+            for v in variants:
+                lkey = key if v is None else (key, v)
+                if lkey in sinds.counts: # Otherwise, the array hasn't been created yet
+                    current = self[key][inds] if v is None else self[key][v, inds]
+                    changed = np.unique(inds[current != value]) # In case of duplicates
+                    if value:
+                        sinds.counts[lkey] += len(changed)
+                        sinds.inds[lkey].append(changed)
+                    else:
+                        sinds.counts[lkey] -= len(changed)
+        if variant is not None:
+            self[key][variant, inds] = value
+        elif by_variant:
+            self[key][:, inds] = value
+        else:
+            self[key][inds] = value
+        return
+
+
+    def state_inds(self, key, variant=None):
+        '''
+        Return the indices of the people in a state from its index set, in the same
+        (sorted) order as true(); see init_state_inds().
+
+        Args:
+            key (str): the state, e.g. 'symptomatic'
+            variant (int): for states by variant, e.g. 'exposed_by_variant', the variant
+        '''
+        lkey = key if variant is None else (key, variant)
+        arrs = self.get_state_inds().inds[lkey]
+        if len(arrs) == 1:
+            inds = arrs[0]
+        else:
+            inds = np.unique(np.concatenate(arrs)).astype(np.intp, copy=False)
+        inds = inds[self[key][inds] if variant is None else self[key][variant,inds]] # Remove people who have left the state
+        arrs[:] = [inds]
+        return inds
+
+
     def count_not(self, key):
         ''' Count the number of people who do not have a property for a given key '''
         return len(self[key]) - self.count(key)
@@ -1078,6 +1885,8 @@ class BasePeople(FlexPretty):
         expected_len = len(self)
         expected_variants = self.pars['n_variants']
         for key in self.keys():
+            if not self.allocated(key): # Created with the right shape when first used
+                continue
             if self[key].ndim == 1:
                 actual_len = len(self[key])
             else: # If it's 2D, variants need to be checked separately
@@ -1114,16 +1923,121 @@ class BasePeople(FlexPretty):
         # Reset sizes
         if keys is None:
             keys = self.keys()
-        keys = sc.promotetolist(keys)
+        keys = [key for key in sc.promotetolist(keys) if self.allocated(key)] # Arrays that haven't been used yet are created with the new size
+        views = [key for key in keys if isinstance(self[key], ArrayView)] # Arrays stored in other forms, e.g. as bits, which resize themselves
+        for key in views:
+            self[key].resize(new_size)
+        keys = [key for key in keys if key not in views]
+        if self._columns is not None: # Views can't be resized, so make a new buffer instead
+            self.pack_columns()
+            buffered = [key for key in keys if key in self._columns]
+            self._columns = self._columns.resized({key:new_size for key in buffered})
+            self.__dict__.update(self._columns.arrays)
+            keys = [key for key in keys if key not in buffered] # Arrays created after the buffer
         for key in keys:
-            self[key].resize(new_size, refcheck=False) # Don't worry about cross-references to the arrays
+            arr = self[key]
+            if arr.flags.owndata:
+                arr.resize(new_size, refcheck=False) # Don't worry about cross-references to the arrays
+            else: # Views, e.g. of memory-mapped files, can't be resized, so copy instead
+                resized = np.zeros(new_size, dtype=arr.dtype)
+                n = min(arr.size, resized.size)
+                resized.reshape(-1)[:n] = arr.reshape(-1)[:n]
+                self[key] = resized
 
         return
 
 
+    def init_arrays(self, columns, lazy=None):
+        '''
+        Create the people arrays, either separately or, if ``cv.options.columnar_people``
+        is set, as views into a single buffer (see ColumnBuffer).
+
+        Arrays that only some sims need (e.g. immunity, which is only used with
+        waning) can instead be created when they are first used, either by being
+        accessed or via alloc_arrays(). Until then they take no memory, and
+        allocated() is false for them.
+
+        Args:
+            columns (dict): the shape, dtype, and initial value of each array
+            lazy (list): the keys of the arrays to create on first use, rather than now
+        '''
+        if lazy:
+            self._lazy = {key:columns.pop(key) for key in lazy}
+        if cvo.columnar_people:
+            self._columns = ColumnBuffer({key:(shape, dtype) for key,(shape,dtype,value) in columns.items()})
+            for key,(shape,dtype,value) in columns.items():
+                arr = self._columns[key]
+                if value: # The buffer is already filled with zeros
+                    arr.fill(value)
+                self[key] = arr
+        else:
+            for key,(shape,dtype,value) in columns.items():
+                self[key] = np.full(shape, value, dtype=dtype)
+        return
+
+
+    def allocated(self, key):
+        ''' Whether an array has been created yet; see init_arrays() '''
+        return key in self.__dict__ or not (self._lazy and key in self._lazy)
+
+
+    def alloc_arrays(self, keys):
+        '''
+        Create arrays that are only created when first used (see init_arrays()),
+        with the current population size and number of variants. Arrays that
+        already exist are left as they are.
+
+        Args:
+            keys (str/list): the arrays to create
+        '''
+        for key in sc.promotetolist(keys):
+            if not self.allocated(key):
+                shape, dtype, value = self._lazy[key]
+                shape = (self.pars['n_variants'], len(self)) if isinstance(shape, tuple) else len(self)
+                self[key] = np.full(shape, value, dtype=dtype)
+                del self._lazy[key]
+                if key in self.meta.by_variant_states: # Until now, everyone in the state had the first variant, as did everyone who died, since dying doesn't reset these
+                    self[key][0] = self[self.by_variant_base(key)] | self.dead
+        return
+
+
+    @staticmethod
+    def by_variant_base(key):
+        ''' The state that a state by variant is a breakdown of, e.g. 'exposed' for 'exposed_by_variant' '''
+        return key.replace('_by_variant', '')
+
+
+    def pack_columns(self):
+        '''
+        If the arrays are held in a single buffer, copy any arrays that have been
+        replaced (e.g. by people.set()) into a new buffer, so all of them are
+        held in it again. Called automatically when the people are saved, copied,
+        resized, or combined.
+        '''
+        if self._columns is not None:
+            arrays = {key:self[key] for key in self._columns.keys()}
+            if any(arr is not self._columns[key] for key,arr in arrays.items()):
+                self._columns = ColumnBuffer.from_arrays(arrays)
+                self.__dict__.update(self._columns.arrays)
+        return
+
+
     def to_df(self):
-        ''' Convert to a Pandas dataframe '''
-        df = pd.DataFrame.from_dict({key:self[key] for key in self.keys()})
+        '''
+        Convert to a Pandas dataframe, leaving out arrays that haven't been created
+        (see init_arrays()). Arrays by variant are split into a column per variant,
+        e.g. ``sus_imm_0``.
+        '''
+        columns = {}
+        for key in self.keys():
+            if self.allocated(key):
+                arr = np.asarray(self[key]) # In case the states are packed into bits, or days are stored as integers
+                if arr.ndim == 2:
+                    for v,row in enumerate(arr):
+                        columns[f'{key}_{v}'] = row
+                else:
+                    columns[key] = arr
+        df = pd.DataFrame.from_dict(columns)
         return df
 
 
@@ -1134,10 +2048,107 @@ class BasePeople(FlexPretty):
             if key == 'uid':
                 arr[:,k] = np.arange(len(self))
             else:
-                arr[:,k] = self[key]
+                arr[:,k] = np.asarray(self[key])
         return arr
 
 
+    def save_columns(self, folder):
+        '''
+        Save the people arrays and contact layers to a folder as a set of raw
+        .npy files, one per array, plus a JSON manifest describing them. Unlike
+        saving the People object, this allows the population to be loaded by
+        memory-mapping the files (see load_columns()). Other attributes, such as
+        the infection log, are not saved, so this is intended for populations
+        that have not yet been run.
+
+        Args:
+            folder (str): the folder to save to; created if it doesn't exist
+
+        Returns:
+            folder (str): the full path of the folder
+
+        **Example**::
+
+            sim = cv.Sim(pop_size=10e3, popfile='my-population/', save_pop=True).initialize() # Or equivalently:
+            sim.people.save_columns('my-population')
+        '''
+        folder = os.path.abspath(folder)
+        os.makedirs(folder, exist_ok=True)
+        manifest = dict(
+            version    = cvv.__version__,
+            pop_size   = len(self),
+            n_variants = self.pars['n_variants'],
+            t          = self.t,
+            columns    = {},
+            layers     = {},
+        )
+
+        def save(filename, arr):
+            np.save(os.path.join(folder, filename), arr)
+            return dict(file=filename, dtype=arr.dtype.str, shape=list(arr.shape))
+
+        for key in self.keys():
+            if self.allocated(key): # Otherwise, it will be created when first used after loading too
+                manifest['columns'][key] = save(f'{key}.npy', np.asarray(self[key]))
+        for lkey,layer in self.contacts.items():
+            manifest['layers'][lkey] = {key:save(f'layer_{lkey}_{key}.npy', np.asarray(layer[key])) for key in layer.keys()}
+        sc.savejson(os.path.join(folder, 'manifest.json'), manifest)
+
+        return folder
+
+
+    @classmethod
+    def load_columns(cls, folder, pars=None, mmap_mode='c'):
+        '''
+        Load people saved by save_columns(). By default, the files are memory-mapped
+        copy-on-write, so arrays are only read from disk as they are used, pages
+        that are only read are shared by every process that loads the same files,
+        and changes are never written back to the files.
+
+        Memory-mapped arrays are kept as they are, rather than being copied into
+        a single buffer if ``cv.options.columnar_people`` is set. However, if
+        ``cv.options.packed_states`` or ``cv.options.compact_days`` is set, the
+        states or dates are still converted to bits or integers, and so are read
+        into memory; a warning is printed if so.
+
+        Args:
+            folder (str): the folder to load from
+            pars (dict): the parameters for the people; usually replaced when the people are added to a sim
+            mmap_mode (str): passed to np.load(); use None to read the arrays into memory instead
+
+        **Example**::
+
+            sim = cv.Sim(pop_size=10e3, popfile='my-population/', load_pop=True)
+        '''
+        manifest = sc.loadjson(os.path.join(folder, 'manifest.json'))
+
+        def load(entry):
+            return np.asarray(np.load(os.path.join(folder, entry['file']), mmap_mode=mmap_mode)) # Drop the memmap subclass, but keep the mapping
+
+        # Create empty people, then replace the arrays with the saved ones
+        pars = sc.mergedicts(pars, {'pop_size':0})
+        people = cls(pars)
+        if mmap_mode is not None:
+            people._columns = None # Keep the mapped arrays, rather than copying them into a buffer
+            converted = [key for key in manifest['columns'] if isinstance(people.__dict__.get(key), ArrayView)]
+            if converted:
+                warningmsg = f'Warning: {len(converted)} arrays (e.g. "{converted[0]}") are stored as bits or whole days (see cv.options.packed_states and cv.options.compact_days), so they are read into memory rather than memory-mapped'
+                print(warningmsg)
+        for key,entry in manifest['columns'].items():
+            people[key] = load(entry)
+        people.pars['pop_size'] = manifest['pop_size']
+        people.pars['n_variants'] = manifest['n_variants']
+        people.t = manifest['t']
+
+        # Replace the layers
+        people.contacts = Contacts(layer_keys=list(manifest['layers'].keys()))
+        for lkey,columns in manifest['layers'].items():
+            for key,entry in columns.items():
+                people.contacts[lkey][key] = load(entry) # Set directly since creating a layer would copy the arrays
+
+        return people
+
+
     def person(self, ind):
         ''' Method to create person from the people '''
         p = Person()
@@ -1176,7 +2187,11 @@ class BasePeople(FlexPretty):
         # Iterate over people -- slow!
         for p,person in enumerate(people):
             for key in self.keys():
-                self[key][p] = getattr(person, key)
+                if self[key].ndim == 2: # By variant, as in person()
+                    self[key][:,p] = getattr(person, key)
+                else:
+                    self[key][p] = getattr(person, key)
+        self._state_inds = None # The states were set directly, so the index sets need rebuilding
 
         return
 
@@ -1271,8 +2286,7 @@ class BasePeople(FlexPretty):
                 self.contacts[lkey] = Layer(label=lkey)
 
             # Actually include them, and update properties if supplied
-            for col in self.contacts[lkey].keys(): # Loop over the supplied columns
-                self.contacts[lkey][col] = np.concatenate([self.contacts[lkey][col], new_layer[col]])
+            self.contacts[lkey].append({col:np.asarray(new_layer[col]) for col in self.contacts[lkey].keys()}) # Loop over the supplied columns
             self.contacts[lkey].validate()
 
         return
@@ -1490,6 +2504,9 @@ class Layer(FlexDict):
         layer2 = cv.Layer(**layer, index=index, self_conn=self_conn, label=layer.label)
     '''
 
+    _index = None # The cached CSR index of each person's edges; see get_index()
+    _buffers = None # The storage behind each key's array, if it has spare capacity at the end; see _storage()
+
     def __init__(self, label=None, **kwargs):
         self.meta = {
             'p1':    cvd.default_int,   # Person 1
@@ -1510,6 +2527,22 @@ class Layer(FlexDict):
         return
 
 
+    def __setitem__(self, key, value):
+        ''' Reset the index if the edges are changed '''
+        super().__setitem__(key, value)
+        if key in ['p1', 'p2']:
+            self._index = None
+        return
+
+
+    def __getstate__(self):
+        ''' Don't save the index or the spare capacity, since they can be regenerated '''
+        state = self.__dict__.copy()
+        state.pop('_index', None)
+        state.pop('_buffers', None)
+        return state
+
+
     def __len__(self):
         try:
             return len(self[self.basekey])
@@ -1537,14 +2570,21 @@ class Layer(FlexDict):
         Returns: True if person index appears in any interactions
 
         """
-        return (item in self['p1']) or (item in self['p2'])
+        if not isinstance(item, (int, np.integer)): # E.g. a float, so use the original check
+            return (item in self['p1']) or (item in self['p2'])
+        index = self.get_index()
+        if not 0 <= item < index.n:
+            return False
+        return (index.p1_ptr[item+1] > index.p1_ptr[item]) or (index.p2_ptr[item+1] > index.p2_ptr[item])
 
     @property
     def members(self):
         """
         Return sorted array of all members
         """
-        return np.unique([self['p1'], self['p2']])
+        index = self.get_index()
+        members = (np.diff(index.p1_ptr) > 0) | (np.diff(index.p2_ptr) > 0)
+        return np.flatnonzero(members).astype(self['p1'].dtype)
 
 
     def meta_keys(self):
@@ -1569,35 +2609,137 @@ class Layer(FlexDict):
         return
 
 
-    def pop_inds(self, inds):
+    def get_index(self, n=None):
+        '''
+        Return a compressed sparse row (CSR) index of each person's edges, building
+        it if needed. For person i, ``index.p1_edges[index.p1_ptr[i]:index.p1_ptr[i+1]]``
+        are the indices of the edges where they are p1, in ascending order, and
+        likewise for p2. This lets the edges of a small number of people (e.g. the
+        infectious) be found without scanning the whole layer.
+
+        The index is cached, and is discarded whenever the edges are changed by the
+        layer's methods, e.g. when p1 or p2 is replaced, or by pop_inds(), append(),
+        and update(). If p1 or p2 is modified in place, call reset_index() afterwards.
+
+        Args:
+            n (int): the number of people (default: the largest index in the layer plus one)
+
+        **Example**::
+
+            index = sim.people.contacts['h'].get_index()
+            edges = index.p1_edges[index.p1_ptr[0]:index.p1_ptr[1]] # Edges where person 0 is p1
+        '''
+        n = 0 if n is None else int(n)
+        index = self._index
+        if index is None or index.n < n:
+            if len(self):
+                n = max(n, int(max(self['p1'].max(), self['p2'].max())) + 1)
+            index = sc.objdict(n=n)
+            index.p1_ptr, index.p1_edges = cvu.build_csr(self['p1'], n)
+            index.p2_ptr, index.p2_edges = cvu.build_csr(self['p2'], n)
+            self._index = index
+        return index
+
+
+    def reset_index(self):
+        ''' Discard the cached index (see get_index()), e.g. after modifying the edges in place '''
+        self._index = None
+        return
+
+
+    def _storage(self, key):
+        '''
+        Return the array holding this key's edges. This may extend past the end of
+        the layer, if edges have been removed in place (see pop_inds()), in which
+        case the layer's array is a view of the first len(layer) entries. If the
+        layer's array has since been replaced, it is returned instead.
+        '''
+        if self._buffers is not None and key in self._buffers:
+            buf, view = self._buffers[key]
+            if self[key] is view:
+                return buf
+        return self[key]
+
+
+    def _set_storage(self, key, buf, n):
+        ''' Set this key's array to the first n entries of buf, keeping the rest as spare capacity '''
+        view = buf[:n]
+        if self._buffers is None:
+            self._buffers = {}
+        self._buffers[key] = (buf, view)
+        self[key] = view
+        self._index = None
+        return
+
+
+    def pop_inds(self, inds, in_place=False):
         '''
         "Pop" the specified indices from the edgelist and return them as a dict.
         Returns in the right format to be used with layer.append().
 
+        By default, the remaining edges are copied into new arrays, keeping their order.
+        With ``in_place=True``, the removed edges are instead overwritten by the edges
+        at the end of the layer, which is then shortened, so the cost only depends on
+        the number of edges removed. The order of the remaining edges changes, and the
+        freed space is reused by append().
+
         Args:
             inds (int, array, slice): the indices to be removed
+            in_place (bool): whether to remove the edges in place, without copying the remaining edges
         '''
         output = {}
-        for key in self.meta_keys():
-            output[key] = self[key][inds] # Copy to the output object
-            self[key] = np.delete(self[key], inds) # Remove from the original
+        self._index = None
+        if not in_place:
+            for key in self.meta_keys():
+                output[key] = self[key][inds] # Copy to the output object
+                self[key] = np.delete(self[key], inds) # Remove from the original
+            return output
+
+        # Work out which edges at the end of the layer will fill the gaps
+        n = len(self)
+        if isinstance(inds, slice):
+            inds = np.arange(*inds.indices(n))
+        inds = np.atleast_1d(inds)
+        remove = np.unique(np.where(inds < 0, inds + n, inds))
+        n_keep = n - len(remove)
+        holes = remove[remove < n_keep] # Removed edges to be overwritten
+        fill = np.setdiff1d(np.arange(n_keep, n), remove, assume_unique=True) # Kept edges to move into the holes
+
+        # Move the edges, including any extra keys, so they stay the same length
+        for key in self.keys():
+            output[key] = self[key][inds]
+            buf = self._storage(key)
+            if not buf.flags.owndata: # E.g. shared between runs (see cv.multi_run()), so copy rather than modify it
+                buf = buf.copy()
+            buf[holes] = buf[fill]
+            self._set_storage(key, buf, n_keep)
         return output
 
 
     def append(self, contacts):
         '''
-        Append contacts to the current layer.
+        Append contacts to the current layer. New contacts are copied into spare
+        capacity at the end of the layer's storage if there is room (e.g. left by
+        previous appends, or by removing edges in place); otherwise, the storage
+        is grown by a constant factor, so that adding edges a few at a time (e.g.
+        every day) takes constant time per edge on average.
 
         Args:
             contacts (dict): a dictionary of arrays with keys p1,p2,beta, as returned from layer.pop_inds()
         '''
+        self._index = None
         for key in self.keys():
             new_arr = contacts[key]
             n_curr = len(self[key]) # Current number of contacts
             n_new = len(new_arr) # New contacts to add
             n_total = n_curr + n_new # New size
-            self[key] = np.resize(self[key], n_total) # Resize to make room, preserving dtype
-            self[key][n_curr:] = new_arr # Copy contacts into the layer
+            buf = self._storage(key)
+            if len(buf) < n_total or not buf.flags.owndata: # Not enough room (or the storage is shared), so make more, preserving dtype
+                capacity = max(n_total, int(1.5*len(buf)))
+                buf = np.empty(capacity, dtype=self[key].dtype)
+                buf[:n_curr] = self[key]
+            buf[n_curr:n_total] = new_arr # Copy contacts into the layer
+            self._set_storage(key, buf, n_total)
         return
 
 
@@ -1648,6 +2790,9 @@ class Layer(FlexDict):
         this cannot be used for cases where multiple connections count differently than a single
         infection, e.g. exposure risk.
 
+        Contacts are found using the cached index of each person's edges (see
+        get_index()), so only the edges of the specified people are checked.
+
         Args:
             inds (array): indices of people whose contacts to return
             as_array (bool): if true, return as sorted array (otherwise, return as unsorted set)
@@ -1668,10 +2813,12 @@ class Layer(FlexDict):
             inds = np.array(inds, dtype=np.int64)
 
         # Find the contacts
-        contact_inds = cvu.find_contacts(self['p1'], self['p2'], inds)
+        index = self.get_index()
+        partners = cvu.find_indexed_contacts(self['p1'], self['p2'], index.p1_ptr, index.p1_edges, index.p2_ptr, index.p2_edges, inds)
         if as_array:
-            contact_inds = np.fromiter(contact_inds, dtype=cvd.default_int)
-            contact_inds.sort()  # Sorting ensures that the results are reproducible for a given seed as well as being identical to previous versions of Covasim
+            contact_inds = np.unique(partners).astype(cvd.default_int, copy=False) # Sorting ensures that the results are reproducible for a given seed as well as being identical to previous versions of Covasim
+        else:
+            contact_inds = set(partners.tolist())
 
         return contact_inds
 
@@ -1703,5 +2850,191 @@ class Layer(FlexDict):
         self['p1'][inds]   = np.array(cvu.choose_r(max_n=pop_size, n=n_new), dtype=cvd.default_int) # Choose with replacement
         self['p2'][inds]   = np.array(cvu.choose_r(max_n=pop_size, n=n_new), dtype=cvd.default_int)
         self['beta'][inds] = np.ones(n_new, dtype=cvd.default_float)
+        self.reset_index()
         return
 
+
+
+
+class InfectionLog(FlexPretty):
+    '''
+    A record of who infected whom, stored as columns of preallocated arrays that
+    grow as infections are added: the source (-1 for seed infections and
+    importations), the target, the date, and codes for the layer and variant.
+    Layer keys and variant labels are stored once, in ``log.layer_keys`` and
+    ``log.variant_keys``, and the codes index into these lists (-1 for no layer).
+
+    This class is usually not invoked directly by the user, but is created by the
+    people object as ``people.infection_log``. For compatibility, it also behaves
+    like a list of dictionaries with keys ``source``, ``target``, ``date``, ``layer``,
+    and ``variant``: it can be iterated over, indexed, and appended to.
+
+    **Examples**::
+
+        sim = cv.Sim().run()
+        log = sim.people.infection_log
+        log[0] # A dict for the first infection
+        log.source # An array of the source of each infection
+        df = log.to_df() # A dataframe of all infections
+    '''
+
+    def __init__(self, entries=None):
+        self.n = 0 # Number of infections recorded
+        self.layer_keys   = []
+        self.variant_keys = []
+        self._source  = np.empty(0, dtype=cvd.default_int)
+        self._target  = np.empty(0, dtype=cvd.default_int)
+        self._date    = np.empty(0, dtype=np.int16)
+        self._layer   = np.empty(0, dtype=np.int8)
+        self._variant = np.empty(0, dtype=np.int8)
+        if entries is not None:
+            for entry in entries:
+                self.append(entry)
+        return
+
+
+    def __len__(self):
+        return self.n
+
+
+    def __getitem__(self, ind):
+        ''' Return an infection as a dict, or a list of dicts for a slice '''
+        if isinstance(ind, slice):
+            return [self[i] for i in range(*ind.indices(self.n))]
+        if ind < 0:
+            ind += self.n
+        if not 0 <= ind < self.n:
+            raise IndexError(f'Infection {ind} is out of range for an infection log of length {self.n}')
+        source  = self._source[ind]
+        layer   = self._layer[ind]
+        variant = self._variant[ind]
+        entry = dict(
+            source  = int(source) if source >= 0 else None,
+            target  = int(self._target[ind]),
+            date    = int(self._date[ind]),
+            layer   = self.layer_keys[layer] if layer >= 0 else None,
+            variant = self.variant_keys[variant] if variant >= 0 else None,
+        )
+        return entry
+
+
+    def __iter__(self):
+        for i in range(self.n):
+            yield self[i]
+
+
+    def __getstate__(self):
+        ''' Only store the infections that have been recorded, not the spare capacity '''
+        state = self.__dict__.copy()
+        for key in ['_source', '_target', '_date', '_layer', '_variant']:
+            state[key] = state[key][:self.n].copy()
+        return state
+
+
+    def _brief(self):
+        return f'InfectionLog(n={self.n})'
+
+
+    @property
+    def source(self):
+        ''' The source of each infection, or -1 if there was none '''
+        return self._source[:self.n]
+
+    @property
+    def target(self):
+        ''' The person infected '''
+        return self._target[:self.n]
+
+    @property
+    def date(self):
+        ''' The timestep of each infection '''
+        return self._date[:self.n]
+
+    @property
+    def layer(self):
+        ''' The index of the layer of each infection in layer_keys, or -1 if there was none '''
+        return self._layer[:self.n]
+
+    @property
+    def variant(self):
+        ''' The index of the variant of each infection in variant_keys, or -1 if there was none '''
+        return self._variant[:self.n]
+
+
+    def _code(self, keys, key):
+        ''' Find the code for a layer key or variant label, adding it if it's new '''
+        if key is None:
+            return -1
+        if key not in keys:
+            keys.append(key)
+        return keys.index(key)
+
+
+    def _fit(self, key, value):
+        '''
+        Make sure a column can hold the given value, since the dates, layers, and
+        variants are stored in small integer types; if it can't, widen the column
+        '''
+        arr = self.__dict__[key]
+        info = np.iinfo(arr.dtype)
+        if not info.min <= value <= info.max:
+            self.__dict__[key] = arr.astype(np.promote_types(arr.dtype, np.min_scalar_type(value)))
+        return value
+
+
+    def add(self, targets, sources=None, date=0, layer=None, variant=None):
+        '''
+        Record a set of infections that happened on the same day in the same layer.
+
+        Args:
+            targets (array): the people infected
+            sources (array): the person who infected each target, or None for seed infections and importations
+            date (int): the timestep of the infections
+            layer (str): the layer the infections happened in
+            variant (str): the label of the variant
+        '''
+        n_new = len(targets)
+        if not n_new:
+            return
+        end = self.n + n_new
+        if end > len(self._target): # Grow the arrays, doubling the capacity so this is rare
+            capacity = max(end, 2*len(self._target), 100)
+            for key in ['_source', '_target', '_date', '_layer', '_variant']:
+                old = self.__dict__[key]
+                new = np.empty(capacity, dtype=old.dtype)
+                new[:self.n] = old[:self.n]
+                self.__dict__[key] = new
+        self._source[self.n:end]  = sources if sources is not None else -1
+        self._target[self.n:end]  = targets
+        self._date[self.n:end]    = self._fit('_date', date)
+        self._layer[self.n:end]   = self._fit('_layer', self._code(self.layer_keys, layer))
+        self._variant[self.n:end] = self._fit('_variant', self._code(self.variant_keys, variant))
+        self.n = end
+        return
+
+
+    def append(self, entry):
+        ''' Record a single infection, given as a dict as returned by log[i] '''
+        source = entry.get('source')
+        sources = None if source is None else [source]
+        self.add([entry['target']], sources=sources, date=entry['date'], layer=entry.get('layer'), variant=entry.get('variant'))
+        return
+
+
+    def to_list(self):
+        ''' Convert to a list of dicts, the format previously used for people.infection_log '''
+        return list(self)
+
+
+    def to_df(self):
+        ''' Convert to a dataframe, with NaN sources and None layers where there were none '''
+        source = self.source.astype(np.float64)
+        source[self.source < 0] = np.nan
+        df = pd.DataFrame(dict(
+            source  = source,
+            target  = self.target,
+            date    = self.date,
+            layer   = np.array([None] + self.layer_keys,   dtype=object)[self.layer + 1],
+            variant = np.array([None] + self.variant_keys, dtype=object)[self.variant + 1],
+        ))
+        return df
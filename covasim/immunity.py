@@ -199,17 +199,72 @@ def update_peak_nab(people, inds, nab_pars, natural=True):
         if len(prior_nab_inds):
             people.peak_nab[prior_nab_inds] *= nab_pars['nab_boost']
 
+    # Their NAbs will now change, so make sure they're updated if only active people are being updated
+    if people._nab_active is not None:
+        people._nab_active.new.append(np.asarray(inds))
+
     return
 
 
-def update_nab(people, inds):
+def update_nab(people, inds, kin_bounds=None):
+    '''
+    Step NAb levels forward in time, in place; see cvu.update_nab()
+
+    Args:
+        people: A people object
+        inds: Array of people indices
+        kin_bounds: if supplied, the output of nab_kin_bounds(), used to find dormant people
+
+    Returns: for each person, whether their NAbs will not change again until they are boosted
+    '''
+    sums = people._imm_sums
+    if sums is not None:
+        alive = inds[~people.dead[inds]]
+        old = people.nab[alive].sum(dtype=np.float64)
+    if kin_bounds is None:
+        kin_bounds = (np.empty(0), np.empty(0))
+    inds = np.asarray(inds, dtype=np.int64)
+    dormant = cvu.update_nab(people.t, inds, people.nab, people.peak_nab, np.asarray(people.date_exposed), np.asarray(people.date_vaccinated), people.pars['nab_kin'], *kin_bounds)
+    if sums is not None:
+        sums.nab += people.nab[alive].sum(dtype=np.float64) - old
+    return dormant
+
+
+def nab_kin_bounds(nab_kin):
     '''
-    Step NAb levels forward in time
+    Calculate the maximum and maximum absolute value of the NAb kinetics after
+    each day, used to tell when NAbs will not change again (see cvu.update_nab())
     '''
-    t_since_boost = people.t-np.fmax(people.date_exposed[inds],people.date_vaccinated[inds]).astype(cvd.default_int)
-    people.nab[inds] += people.pars['nab_kin'][t_since_boost]*people.peak_nab[inds]
-    people.nab[inds[people.nab[inds] < 0]] = 0 # Make sure nabs don't drop below 0
-    people.nab[inds[people.nab[inds] > people.peak_nab[inds]]] = people.peak_nab[inds[people.nab[inds] > people.peak_nab[inds]]] # Make sure nabs don't exceed peak_nab
+    nab_kin = np.asarray(nab_kin, dtype=np.float64)
+    kin_max    = np.append(np.maximum.accumulate(nab_kin[::-1])[::-1][1:], -np.inf)
+    kin_maxabs = np.append(np.maximum.accumulate(np.abs(nab_kin)[::-1])[::-1][1:], 0.0)
+    return kin_max, kin_maxabs
+
+
+def update_active_nabs(people):
+    '''
+    Step NAb levels forward in time for people whose NAbs are still changing.
+    People are added to the active set when their NAbs are boosted (in
+    update_peak_nab()), and retired from it once their NAbs have decayed to a
+    level that will not change again, so that they no longer need to be updated
+    on each timestep. Results are identical to updating everyone with NAbs.
+
+    Used by the sim if ``cv.options.retire_nabs`` is set. The active set is
+    initialized from everyone with NAbs on the first call.
+    '''
+    state = people._nab_active
+    if state is None or state.n != len(people):
+        state = sc.objdict(n=len(people), inds=cvu.true(people.peak_nab), new=[], kin_bounds=nab_kin_bounds(people.pars['nab_kin']))
+        people._nab_active = state
+    elif len(state.new):
+        inds = np.unique(np.concatenate([state.inds] + state.new)).astype(np.int64)
+        state.inds = inds[people.peak_nab[inds] != 0] # Remove people who have been made naive
+        state.new = []
+
+    inds = state.inds
+    if len(inds):
+        dormant = update_nab(people, inds, kin_bounds=state.kin_bounds)
+        state.inds = inds[~dormant]
     return
 
 
@@ -333,67 +388,101 @@ def check_immunity(people, variant, sus=True, inds=None):
 
     # Handle parameters and indices
     pars = people.pars
-    vaccine_pars = get_vaccine_pars(pars)
-    was_inf  = cvu.true(people.t >= people.date_recovered)  # Had a previous exposure, now recovered
-    is_vacc  = cvu.true(people.vaccinated)  # Vaccinated
-    date_rec = people.date_recovered  # Date recovered
     immunity = pars['immunity'] # cross-immunity/own-immunity scalars to be applied to NAb level before computing efficacy
     nab_eff  = pars['nab_eff']
 
-    # If vaccines are present, extract relevant information about them
-    vacc_present = len(is_vacc)
-    if vacc_present:
-        vx_nab_eff_pars = vaccine_pars['nab_eff']
+    def vacc_scale():
+        ''' Extract information about the vaccine, if anyone has been vaccinated '''
+        vaccine_pars = get_vaccine_pars(pars)
         vacc_mapping = np.array([vaccine_pars.get(label, 1.0) for label in pars['variant_map'].values()]) # TODO: make more robust
+        return vaccine_pars, vacc_mapping[variant]
 
     # PART 1: Immunity to infection for susceptible individuals
     if sus:
-        is_sus = cvu.true(people.susceptible)  # Currently susceptible
-        was_inf_same = cvu.true((people.recovered_variant == variant) & (people.t >= date_rec))  # Had a previous exposure to the same variant, now recovered
-        was_inf_diff = np.setdiff1d(was_inf, was_inf_same)  # Had a previous exposure to a different variant, now recovered
-        is_sus_vacc = np.intersect1d(is_sus, is_vacc)  # Susceptible and vaccinated
-        is_sus_vacc = np.setdiff1d(is_sus_vacc, was_inf)  # Susceptible, vaccinated without prior infection
-        is_sus_was_inf_same = np.intersect1d(is_sus, was_inf_same)  # Susceptible and being challenged by the same variant
-        is_sus_was_inf_diff = np.intersect1d(is_sus, was_inf_diff)  # Susceptible and being challenged by a different variant
-
-        if len(is_sus_vacc):
-            vaccine_source = cvd.default_int(people.vaccine_source[is_sus_vacc]) # TODO: use vaccine source
-            vaccine_scale = vacc_mapping[variant]
-            current_nabs = people.nab[is_sus_vacc]
-            people.sus_imm[variant, is_sus_vacc] = nab_to_efficacy(current_nabs * vaccine_scale, 'sus', vx_nab_eff_pars)
+        is_sus_vacc, is_sus_was_inf, sus_was_inf_nabs = cvu.immunity_groups(np.asarray(people.susceptible), np.asarray(people.vaccinated), np.asarray(people.date_recovered), np.asarray(people.recovered_variant), np.asarray(people.nab), cvd.default_float(immunity[variant, :]), people.t, variant)
 
-        if len(is_sus_was_inf_same):  # Immunity for susceptibles with prior exposure to this variant
-            current_nabs = people.nab[is_sus_was_inf_same]
-            people.sus_imm[variant, is_sus_was_inf_same] = nab_to_efficacy(current_nabs * immunity[variant, variant], 'sus', nab_eff)
+        if len(is_sus_vacc): # Susceptible, vaccinated without prior infection
+            vaccine_pars, vaccine_scale = vacc_scale()
+            current_nabs = people.nab[is_sus_vacc]
+            set_immunity(people, 'sus_imm', variant, is_sus_vacc, nab_to_efficacy(current_nabs * vaccine_scale, 'sus', vaccine_pars['nab_eff']))
 
-        if len(is_sus_was_inf_diff):  # Cross-immunity for susceptibles with prior exposure to a different variant
-            prior_variants = people.recovered_variant[is_sus_was_inf_diff]
-            prior_variants_unique = cvd.default_int(np.unique(prior_variants))
-            for unique_variant in prior_variants_unique:
-                unique_inds = is_sus_was_inf_diff[cvu.true(prior_variants == unique_variant)]
-                current_nabs = people.nab[unique_inds]
-                people.sus_imm[variant, unique_inds] = nab_to_efficacy(current_nabs * immunity[variant, unique_variant], 'sus', nab_eff)
+        if len(is_sus_was_inf):  # Immunity (or cross-immunity) for susceptibles with prior exposure; NAbs are already scaled
+            set_immunity(people, 'sus_imm', variant, is_sus_was_inf, nab_to_efficacy(sus_was_inf_nabs, 'sus', nab_eff))
 
     # PART 2: Immunity to disease for currently-infected people
     else:
-        is_inf_vacc = np.intersect1d(inds, is_vacc)
-        was_inf = np.intersect1d(inds, was_inf)
+        inds = np.unique(inds) # Usually already unique and sorted
+        is_inf_vacc = inds[people.vaccinated[inds]]
+        was_inf = inds[people.t >= people.date_recovered[inds]] # Had a previous exposure, now recovered
 
         if len(is_inf_vacc):  # Immunity for infected people who've been vaccinated
-            vaccine_source = cvd.default_int(people.vaccine_source[is_inf_vacc])  # TODO: use vaccine source
-            vaccine_scale = vacc_mapping[variant]
+            vaccine_pars, vaccine_scale = vacc_scale()
             current_nabs = people.nab[is_inf_vacc]
-            people.symp_imm[variant, is_inf_vacc] = nab_to_efficacy(current_nabs * vaccine_scale, 'symp', nab_eff)
+            set_immunity(people, 'symp_imm', variant, is_inf_vacc, nab_to_efficacy(current_nabs * vaccine_scale, 'symp', nab_eff))
             people.sev_imm[variant, is_inf_vacc] = nab_to_efficacy(current_nabs * vaccine_scale, 'sev', nab_eff)
 
         if len(was_inf):  # Immunity for reinfected people
             current_nabs = people.nab[was_inf]
-            people.symp_imm[variant, was_inf] = nab_to_efficacy(current_nabs, 'symp', nab_eff)
+            set_immunity(people, 'symp_imm', variant, was_inf, nab_to_efficacy(current_nabs, 'symp', nab_eff))
             people.sev_imm[variant, was_inf] = nab_to_efficacy(current_nabs, 'sev', nab_eff)
 
     return
 
 
+def set_immunity(people, key, variant, inds, values):
+    ''' Set the immunity levels (sus_imm or symp_imm) of the specified people, keeping the population sums up to date if they are being used '''
+    arr = people[key]
+    sums = people._imm_sums
+    if sums is None:
+        arr[variant, inds] = values
+    else:
+        old = arr[variant, inds].sum(dtype=np.float64)
+        arr[variant, inds] = values
+        sums[key] += arr[variant, inds].sum(dtype=np.float64) - old
+    return
+
+
+def init_pop_immunity(people):
+    '''
+    Initialize running sums of the NAb levels of people who are alive, and of
+    the immunity levels of everyone, from their current values. The sums are then
+    kept up to date by update_nab(), set_immunity(), and the People methods that
+    kill people or make them naive; see pop_immunity().
+    '''
+    alive = ~people.dead
+    people._imm_sums = sc.objdict(
+        n        = len(people),
+        nab      = people.nab[alive].sum(dtype=np.float64),
+        sus_imm  = people.sus_imm.sum(dtype=np.float64),
+        symp_imm = people.symp_imm.sum(dtype=np.float64),
+    )
+    return
+
+
+def pop_immunity(people):
+    '''
+    Calculate the population NAb and protection results from running sums, rather
+    than by summing over everyone on each timestep. Results agree with the full
+    calculation to within floating-point rounding.
+
+    Used by the sim if ``cv.options.immunity_sums`` is set.
+
+    Returns:
+        pop_nabs (float): the average NAb level of people who are alive
+        pop_protection (float): the average protection against infection, over people and variants
+        pop_symp_protection (float): the average protection against symptoms, over people and variants
+    '''
+    sums = people._imm_sums
+    if sums is None or sums.n != len(people):
+        init_pop_immunity(people)
+        sums = people._imm_sums
+    n_alive = len(people) - people.count('dead')
+    pop_nabs            = sums.nab/n_alive
+    pop_protection      = sums.sus_imm/people.sus_imm.size
+    pop_symp_protection = sums.symp_imm/people.symp_imm.size
+    return pop_nabs, pop_protection, pop_symp_protection
+
+
 
 #%% Methods for computing waning
 
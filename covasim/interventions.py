@@ -14,6 +14,7 @@ from . import defaults as cvd
 from . import base as cvb
 from . import parameters as cvpar
 from . import immunity as cvi
+from .settings import options as cvo
 from collections import defaultdict
 
 
@@ -642,6 +643,7 @@ class clip_edges(Intervention):
         for ind in find_day(self.days, sim.t, interv=self, sim=sim):
 
             # Do the contact moving
+            choose = cvu.choose_sparse if cvo.clip_in_place else cvu.choose
             for lkey in self.layers:
                 s_layer = sim.people.contacts[lkey] # Contact layer in the sim
                 i_layer = self.contacts[lkey] # Contact layer in the intervention
@@ -655,12 +657,12 @@ class clip_edges(Intervention):
                     n_to_move = int(prop_to_move*n_contacts) # Number of contacts to move
                     from_sim = (n_to_move>0) # Check if we're moving contacts from the sim
                     if from_sim: # We're moving from the sim to the intervention
-                        inds = cvu.choose(max_n=n_sim, n=n_to_move)
-                        to_move = s_layer.pop_inds(inds)
+                        inds = choose(max_n=n_sim, n=n_to_move)
+                        to_move = s_layer.pop_inds(inds, in_place=cvo.clip_in_place)
                         i_layer.append(to_move)
                     else: # We're moving from the intervention back to the sim
-                        inds = cvu.choose(max_n=n_int, n=abs(n_to_move))
-                        to_move = i_layer.pop_inds(inds)
+                        inds = choose(max_n=n_int, n=abs(n_to_move))
+                        to_move = i_layer.pop_inds(inds, in_place=cvo.clip_in_place)
                         s_layer.append(to_move)
                 else: # pragma: no cover
                     print(f'Warning: clip_edges() was applied to layer "{lkey}", but no edges were found; please check sim.people.contacts["{lkey}"]')
@@ -700,7 +702,7 @@ def get_quar_inds(quar_policy, sim):
     elif quar_policy == 'start': quar_test_inds = cvu.true(sim.people.date_quarantined==t-1) # Actually do the day after since testing usually happens before contact tracing
     elif quar_policy == 'end':   quar_test_inds = cvu.true(sim.people.date_end_quarantine==t+1) # +1 since they are released on date_end_quarantine, so do the day before
     elif quar_policy == 'both':  quar_test_inds = np.concatenate([cvu.true(sim.people.date_quarantined==t-1), cvu.true(sim.people.date_end_quarantine==t+1)])
-    elif quar_policy == 'daily': quar_test_inds = cvu.true(sim.people.quarantined)
+    elif quar_policy == 'daily': quar_test_inds = sim.people.true('quarantined')
     elif sc.isnumber(quar_policy) or (sc.isiterable(quar_policy) and not sc.isstring(quar_policy)):
         quar_policy = sc.promotetoarray(quar_policy)
         quar_test_inds = np.unique(np.concatenate([cvu.true(sim.people.date_quarantined==t-1-q) for q in quar_policy]))
@@ -803,7 +805,7 @@ class test_num(Intervention):
         test_probs = np.ones(sim.n) # Begin by assigning equal testing weight (converted to a probability) to everyone
 
         # Calculate test probabilities for people with symptoms
-        symp_inds = cvu.true(sim.people.symptomatic)
+        symp_inds = sim.people.true('symptomatic')
         symp_test = self.symp_test
         if self.pdf: # Handle the onset to swab delay
             symp_time = cvd.default_int(t - sim.people.date_symptomatic[symp_inds]) # Find time since symptom onset
@@ -917,7 +919,7 @@ class test_prob(Intervention):
             return
 
         # Find probablity for symptomatics to be tested
-        symp_inds  = cvu.true(sim.people.symptomatic)
+        symp_inds  = sim.people.true('symptomatic')
         symp_prob = self.symp_prob
         if self.pdf:
             symp_time = cvd.default_int(t - sim.people.date_symptomatic[symp_inds]) # Find time since symptom onset
@@ -1355,6 +1357,7 @@ class BaseVaccination(Intervention):
         self.vaccinated           = [None]*sim.npts # Keep track of inds of people vaccinated on each day
         self.vaccinations         = np.zeros(sim['pop_size'], dtype=cvd.default_int) # Number of doses given per person
         self.vaccination_dates    = np.full(sim['pop_size'], np.nan) # Store the dates when people are vaccinated
+        sim.people.alloc_arrays(sim.people.meta.vacc_states) # Only created for sims with vaccines
 
         sim['vaccine_pars'][self.label] = self.p # Store the parameters
         self.index = list(sim['vaccine_pars'].keys()).index(self.label) # Find where we are in the list
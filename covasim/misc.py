@@ -320,12 +320,19 @@ def migrate(obj, update=True, verbose=True, die=False):
                 print('Adding variant parameters')
             migrate_variants(sim.pars, verbose=verbose)
 
+        # Migrate the infection log from a list of dicts
+        if sim.people:
+            sim.people = migrate(sim.people, update=update)
+
     # Migrations for People
     elif isinstance(obj, cvb.BasePeople): # pragma: no cover
         ppl = obj
         if not hasattr(ppl, 'version'): # For people prior to 2.0
             if verbose: print(f'Migrating people from version <2.0 to version {cvv.__version__}')
             cvb.set_metadata(ppl) # Set all metadata
+        if isinstance(getattr(ppl, 'infection_log', None), list): # For people with a list-of-dicts infection log
+            if verbose: print('Converting infection log to columns')
+            ppl.infection_log = cvb.InfectionLog(ppl.infection_log)
 
     # Migrations for MultiSims -- use recursion
     elif isinstance(obj, cvr.MultiSim):
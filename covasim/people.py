@@ -12,6 +12,7 @@ from . import defaults as cvd
 from . import base as cvb
 from . import plotting as cvplt
 from . import immunity as cvi
+from .settings import options as cvo
 
 
 __all__ = ['People']
@@ -41,6 +42,13 @@ class People(cvb.BasePeople):
         ppl2 = cv.People(sim.pars)
     '''
 
+    _viral  = None # State for computing viral loads incrementally; see update_viral_load()
+    _events = None # Calendar queue of scheduled disease-state transitions; see schedule_events()
+    _due    = None # The people with a transition due on the current timestep, by state
+    _imm_sums = None # Running sums of NAb and immunity levels; see cvi.pop_immunity()
+    _nab_active = None # People whose NAbs are still changing; see cvi.update_active_nabs()
+    _event_states = ['infectious', 'symptomatic', 'severe', 'critical', 'recovered', 'dead'] # States with a transition scheduled at infection
+
     def __init__(self, pars, strict=True, **kwargs):
 
         # Handle pars and population size
@@ -53,42 +61,61 @@ class People(cvb.BasePeople):
         self.meta = cvd.PeopleMeta() # Store list of keys and dtypes
         self.contacts = None
         self.init_contacts() # Initialize the contacts
-        self.infection_log = [] # Record of infections - keys for ['source','target','date','layer']
+        self.infection_log = cvb.InfectionLog() # Record of infections - keys for ['source','target','date','layer','variant']
+
+        # Set the shape, dtype, and initial value of each array
+        pop_size = self.pars['pop_size']
+        n_variants = self.pars['n_variants']
+        columns = {}
 
         # Set person properties -- all floats except for UID
         for key in self.meta.person:
-            if key == 'uid':
-                self[key] = np.arange(self.pars['pop_size'], dtype=cvd.default_int)
-            elif key == 'n_infections':
-                self[key] = np.full(self.pars['pop_size'], 0, dtype=cvd.default_int)
+            if key in ['uid', 'n_infections']:
+                columns[key] = (pop_size, cvd.default_int, 0) # UIDs are set below
             else:
-                self[key] = np.full(self.pars['pop_size'], np.nan, dtype=cvd.default_float)
+                columns[key] = (pop_size, cvd.default_float, np.nan)
 
         # Set health states -- only susceptible is true by default -- booleans except exposed by variant which should return the variant that ind is exposed to
-        for key in self.meta.states:
-            val = (key in ['susceptible', 'naive']) # Default value is True for susceptible and naive, false otherwise
-            self[key] = np.full(self.pars['pop_size'], val, dtype=bool)
+        if cvo.packed_states: # Hold the Boolean states as bits instead
+            self._packed = cvb.PackedStates(self.meta.states, self.meta.by_variant_states, n=pop_size, n_variants=n_variants, true=['susceptible', 'naive'])
+        else:
+            for key in self.meta.states:
+                val = (key in ['susceptible', 'naive']) # Default value is True for susceptible and naive, false otherwise
+                columns[key] = (pop_size, bool, val)
 
         # Set variant states, which store info about which variant a person is exposed to
         for key in self.meta.variant_states:
-            self[key] = np.full(self.pars['pop_size'], np.nan, dtype=cvd.default_float)
-        for key in self.meta.by_variant_states:
-            self[key] = np.full((self.pars['n_variants'], self.pars['pop_size']), False, dtype=bool)
+            columns[key] = (pop_size, cvd.default_float, np.nan)
+        if not cvo.packed_states:
+            for key in self.meta.by_variant_states:
+                columns[key] = ((n_variants, pop_size), bool, False)
 
         # Set immunity and antibody states
         for key in self.meta.imm_states:  # Everyone starts out with no immunity
-            self[key] = np.zeros((self.pars['n_variants'], self.pars['pop_size']), dtype=cvd.default_float)
+            columns[key] = ((n_variants, pop_size), cvd.default_float, 0)
         for key in self.meta.nab_states:  # Everyone starts out with no antibodies
-            self[key] = np.zeros(self.pars['pop_size'], dtype=cvd.default_float)
+            columns[key] = (pop_size, cvd.default_float, 0)
         for key in self.meta.vacc_states:
-            self[key] = np.zeros(self.pars['pop_size'], dtype=cvd.default_int)
+            columns[key] = (pop_size, cvd.default_int, 0)
 
-        # Set dates and durations -- both floats
+        # Set dates and durations -- both floats, unless stored as whole days in integers
+        days = {}
         for key in self.meta.dates + self.meta.durs:
-            self[key] = np.full(self.pars['pop_size'], np.nan, dtype=cvd.default_float)
+            if cvo.compact_days:
+                days[key] = cvb.DayArray(pop_size, bits=cvo.compact_days)
+            else:
+                columns[key] = (pop_size, cvd.default_float, np.nan)
+
+        # Actually create the arrays, except those that only some sims use -- immunity, NAbs, and vaccinations, which need waning or a vaccine, and states by variant, which need more than one variant
+        lazy = [key for key in self.meta.by_variant_states + self.meta.imm_states + self.meta.nab_states + self.meta.vacc_states if key in columns]
+        self.init_arrays(columns, lazy=lazy)
+        if self._packed is not None:
+            self.__dict__.update(self._packed.views())
+        self.__dict__.update(days)
+        self.uid[:] = np.arange(pop_size)
 
         # Store the dtypes used in a flat dict
-        self._dtypes = {key:self[key].dtype for key in self.keys()} # Assign all to float by default
+        self._dtypes = {key:(self[key].dtype if self.allocated(key) else np.dtype(self._lazy[key][1])) for key in self.keys()} # Assign all to float by default
         if strict:
             self.lock() # If strict is true, stop further keys from being set (does not affect attributes)
 
@@ -109,7 +136,7 @@ class People(cvb.BasePeople):
             else:
                 self[key] = value
 
-        self._pending_quarantine = defaultdict(list)  # Internal cache to record people that need to be quarantined on each timestep {t:(person, quarantine_end_day)}
+        self._pending_quarantine = defaultdict(list)  # Internal cache to record people that need to be quarantined on each timestep {t:[(people, quarantine_end_days)]}
 
         return
 
@@ -125,6 +152,8 @@ class People(cvb.BasePeople):
 
     def initialize(self):
         ''' Perform initializations '''
+        if self.pars.get('use_waning'): # Otherwise, these are only created if a vaccine is used
+            self.alloc_arrays(self.meta.imm_states + self.meta.nab_states)
         self.set_prognoses()
         self.validate()
         self.initialized = True
@@ -134,7 +163,9 @@ class People(cvb.BasePeople):
     def set_prognoses(self):
         '''
         Set the prognoses for each person based on age during initialization. Need
-        to reset the seed because viral loads are drawn stochastically.
+        to reset the seed because viral loads are drawn stochastically. The arrays
+        are replaced rather than written in place, since they may be shared with
+        other runs (see cv.SharedPeople).
         '''
 
         pars = self.pars # Shorten
@@ -155,12 +186,12 @@ class People(cvb.BasePeople):
 
         progs = pars['prognoses'] # Shorten the name
         inds = np.fromiter((find_cutoff(progs['age_cutoffs'], this_age) for this_age in self.age), dtype=cvd.default_int, count=len(self)) # Convert ages to indices
-        self.symp_prob[:]   = progs['symp_probs'][inds] # Probability of developing symptoms
-        self.severe_prob[:] = progs['severe_probs'][inds]*progs['comorbidities'][inds] # Severe disease probability is modified by comorbidities
-        self.crit_prob[:]   = progs['crit_probs'][inds] # Probability of developing critical disease
-        self.death_prob[:]  = progs['death_probs'][inds] # Probability of death
-        self.rel_sus[:]     = progs['sus_ORs'][inds]  # Default susceptibilities
-        self.rel_trans[:]   = progs['trans_ORs'][inds] * cvu.sample(**self.pars['beta_dist'], size=len(inds))  # Default transmissibilities, with viral load drawn from a distribution
+        self.set('symp_prob',   progs['symp_probs'][inds]) # Probability of developing symptoms
+        self.set('severe_prob', progs['severe_probs'][inds]*progs['comorbidities'][inds]) # Severe disease probability is modified by comorbidities
+        self.set('crit_prob',   progs['crit_probs'][inds]) # Probability of developing critical disease
+        self.set('death_prob',  progs['death_probs'][inds]) # Probability of death
+        self.set('rel_sus',     progs['sus_ORs'][inds])  # Default susceptibilities
+        self.set('rel_trans',   progs['trans_ORs'][inds] * cvu.sample(**self.pars['beta_dist'], size=len(inds)))  # Default transmissibilities, with viral load drawn from a distribution
 
         return
 
@@ -170,7 +201,11 @@ class People(cvb.BasePeople):
 
         # Initialize
         self.t = t
-        self.is_exp = self.true('exposed') # For storing the interim values since used in every subsequent calculation
+        if cvo.event_queue:
+            self._due = self.pop_events() # Only check people with a transition scheduled for today
+            self.is_exp = None
+        else:
+            self.is_exp = self.true('exposed') # For storing the interim values since used in every subsequent calculation
 
         # Perform updates
         self.init_flows()
@@ -191,10 +226,119 @@ class People(cvb.BasePeople):
         self.flows['new_diagnoses']   += self.check_diagnosed()
         self.flows['new_quarantined'] += self.check_quar()
         del self.is_exp  # Tidy up
+        self._due = None
 
         return
 
 
+    def schedule_events(self, inds):
+        '''
+        Add the disease-state transitions of the specified people to the calendar
+        queue, in the bucket for the first day on which each will occur. Called by
+        infect(), so transitions only need to be scheduled once, when the dates
+        are calculated.
+
+        Args:
+            inds (array): the people whose transitions to schedule
+        '''
+        buckets = self._events.buckets
+        for key in self._event_states:
+            dates = self[f'date_{key}'][inds]
+            defined = ~np.isnan(dates)
+            these = inds[defined]
+            days = np.ceil(dates[defined]).astype(np.int64) # The first timestep on which t >= date
+            order = np.argsort(days, kind='stable')
+            days, these = days[order], these[order]
+            unique, starts = np.unique(days, return_index=True)
+            for day,day_inds in zip(unique, np.split(these, starts[1:])):
+                buckets.setdefault(int(day), {}).setdefault(key, []).append(day_inds)
+        return
+
+
+    def pop_events(self):
+        '''
+        Remove the transitions due on or before the current timestep from the
+        calendar queue, and return the people who might undergo each one. Events
+        are only candidates: people whose dates have changed since the event was
+        scheduled (e.g. because they were reinfected) are filtered out by the
+        usual checks, so stale events are simply dropped.
+
+        Used by update_states_pre() if ``cv.options.event_queue`` is set. The queue
+        is initialized from the current dates of everyone exposed on the first call.
+
+        Returns:
+            due (dict): for each state, the indices of exposed people with a transition to it due
+        '''
+        if self._events is None or self._events.n != len(self):
+            self._events = sc.objdict(n=len(self), buckets={})
+            self.schedule_events(self.true('exposed'))
+
+        due = {key:[] for key in self._event_states}
+        buckets = self._events.buckets
+        for day in [day for day in buckets.keys() if day <= self.t]:
+            for key,arrs in buckets.pop(day).items():
+                due[key].extend(arrs)
+
+        for key,arrs in due.items():
+            inds = np.unique(np.concatenate(arrs)) if len(arrs) else np.empty(0, dtype=cvd.default_int)
+            due[key] = inds[self.exposed[inds]] # Exposed at the start of the timestep, as for is_exp
+
+        return due
+
+
+    def exp_inds(self, key):
+        ''' The people to check for a transition to the given state: either everyone exposed, or only those with an event due (see pop_events()) '''
+        if self._due is not None:
+            return self._due[key]
+        return self.is_exp
+
+
+    def compute_viral_switch(self, inds):
+        ''' Calculate the day on which the viral load of the specified people drops from high to low; see cvu.compute_viral_switch() '''
+        frac_time = cvd.default_float(self.pars['viral_dist']['frac_time'])
+        high_cap  = cvd.default_float(self.pars['viral_dist']['high_cap'])
+        return cvu.compute_viral_switch(self.date_infectious[inds], self.date_recovered[inds], self.date_dead[inds], frac_time, high_cap)
+
+
+    def update_viral_load(self):
+        '''
+        Calculate viral loads for the current timestep, like cvu.compute_viral_load(),
+        but only for people who are infectious. The infectious people are tracked
+        as they become infectious (in check_infectious()) and removed once they are
+        no longer infectious, and the day on which each person's viral load drops is
+        calculated once, when they are infected. The viral loads of people who are
+        not infectious are not updated, and should not be used.
+
+        Used instead of cvu.compute_viral_load() if ``cv.options.sparse_viral_load``
+        is set. State is initialized from the current dates on the first call.
+
+        Returns:
+            viral_load (array): the viral load of each (infectious) person
+        '''
+        viral = self._viral
+        if viral is None or len(viral.load) != len(self):
+            viral = sc.objdict()
+            viral.load   = np.ones(len(self), dtype=cvd.default_float)
+            viral.switch = np.full(len(self), np.nan, dtype=cvd.default_float)
+            exposed = self.true('exposed')
+            viral.switch[exposed] = self.compute_viral_switch(exposed)
+            viral.inds = self.true('infectious')
+            viral.new  = []
+            self._viral = viral
+        else:
+            viral.inds = np.concatenate([viral.inds[self.infectious[viral.inds]]] + viral.new) # Remove people who are no longer infectious, and add new ones
+            viral.new = []
+
+        # Calculate the high and low viral loads in the same way as cvu.compute_viral_load()
+        one = cvd.default_float(1.0)
+        frac_time  = cvd.default_float(self.pars['viral_dist']['frac_time'])
+        load_ratio = cvd.default_float(self.pars['viral_dist']['load_ratio'])
+        denom = one + frac_time*(load_ratio - one)
+        inds = viral.inds
+        viral.load[inds] = np.where(self.t < viral.switch[inds], load_ratio/denom, one/denom)
+        return viral.load
+
+
     def update_contacts(self):
         ''' Refresh dynamic contacts, e.g. community '''
         # Figure out if anything needs to be done -- e.g. {'h':False, 'c':True}
@@ -213,6 +357,8 @@ class People(cvb.BasePeople):
             not_current = cvu.false(current)
         else:
             not_current = cvu.ifalsei(current, filter_inds)
+        if isinstance(date, cvb.DayArray): # Undefined days are never due, so there's no need to check for them
+            return date.due(self.t, not_current)
         has_date = cvu.idefinedi(date, not_current)
         inds     = cvu.itrue(self.t >= date[has_date], has_date)
         return inds
@@ -220,35 +366,38 @@ class People(cvb.BasePeople):
 
     def check_infectious(self):
         ''' Check if they become infectious '''
-        inds = self.check_inds(self.infectious, self.date_infectious, filter_inds=self.is_exp)
-        self.infectious[inds] = True
+        inds = self.check_inds(self.infectious, self.date_infectious, filter_inds=self.exp_inds('infectious'))
+        self.set_state('infectious', inds, True)
         self.infectious_variant[inds] = self.exposed_variant[inds]
+        if self._viral is not None:
+            self._viral.new.append(inds)
         for variant in range(self.pars['n_variants']):
             this_variant_inds = cvu.itrue(self.infectious_variant[inds] == variant, inds)
             n_this_variant_inds = len(this_variant_inds)
             self.flows_variant['new_infectious_by_variant'][variant] += n_this_variant_inds
-            self.infectious_by_variant[variant, this_variant_inds] = True
+            if self.allocated('infectious_by_variant'): # Not needed until another variant circulates; see infect()
+                self.set_state('infectious_by_variant', this_variant_inds, True, variant=variant)
         return len(inds)
 
 
     def check_symptomatic(self):
         ''' Check for new progressions to symptomatic '''
-        inds = self.check_inds(self.symptomatic, self.date_symptomatic, filter_inds=self.is_exp)
-        self.symptomatic[inds] = True
+        inds = self.check_inds(self.symptomatic, self.date_symptomatic, filter_inds=self.exp_inds('symptomatic'))
+        self.set_state('symptomatic', inds, True)
         return len(inds)
 
 
     def check_severe(self):
         ''' Check for new progressions to severe '''
-        inds = self.check_inds(self.severe, self.date_severe, filter_inds=self.is_exp)
-        self.severe[inds] = True
+        inds = self.check_inds(self.severe, self.date_severe, filter_inds=self.exp_inds('severe'))
+        self.set_state('severe', inds, True)
         return len(inds)
 
 
     def check_critical(self):
         ''' Check for new progressions to critical '''
-        inds = self.check_inds(self.critical, self.date_critical, filter_inds=self.is_exp)
-        self.critical[inds] = True
+        inds = self.check_inds(self.critical, self.date_critical, filter_inds=self.exp_inds('critical'))
+        self.set_state('critical', inds, True)
         return len(inds)
 
 
@@ -261,23 +410,21 @@ class People(cvb.BasePeople):
         '''
 
         # Handle more flexible options for setting indices
-        if filter_inds == 'is_exp':
-            filter_inds = self.is_exp
+        if isinstance(filter_inds, str) and filter_inds == 'is_exp':
+            filter_inds = self.exp_inds('recovered')
         if inds is None:
             inds = self.check_inds(self.recovered, self.date_recovered, filter_inds=filter_inds)
 
         # Now reset all disease states
-        self.exposed[inds]          = False
-        self.infectious[inds]       = False
-        self.symptomatic[inds]      = False
-        self.severe[inds]           = False
-        self.critical[inds]         = False
+        for key in ['exposed', 'infectious', 'symptomatic', 'severe', 'critical']:
+            self.set_state(key, inds, False)
         self.recovered[inds]        = True
         self.recovered_variant[inds] = self.exposed_variant[inds]
         self.infectious_variant[inds] = np.nan
         self.exposed_variant[inds]    = np.nan
-        self.exposed_by_variant[:, inds] = False
-        self.infectious_by_variant[:, inds] = False
+        for key in self.meta.by_variant_states:
+            if self.allocated(key):
+                self.set_state(key, inds, False)
 
 
         # Handle immunity aspects
@@ -292,18 +439,16 @@ class People(cvb.BasePeople):
 
     def check_death(self):
         ''' Check whether or not this person died on this timestep  '''
-        inds = self.check_inds(self.dead, self.date_dead, filter_inds=self.is_exp)
+        inds = self.check_inds(self.dead, self.date_dead, filter_inds=self.exp_inds('dead'))
         self.dead[inds]             = True
+        if self._imm_sums is not None: # NAbs are only averaged over people who are alive
+            self._imm_sums.nab -= self.nab[inds].sum(dtype=np.float64)
         diag_inds = inds[self.diagnosed[inds]] # Check whether the person was diagnosed before dying
         self.known_dead[diag_inds]  = True
         self.susceptible[inds]      = False
-        self.exposed[inds]          = False
-        self.infectious[inds]       = False
-        self.symptomatic[inds]      = False
-        self.severe[inds]           = False
-        self.critical[inds]         = False
+        for key in ['exposed', 'infectious', 'symptomatic', 'severe', 'critical', 'quarantined']:
+            self.set_state(key, inds, False)
         self.known_contact[inds]    = False
-        self.quarantined[inds]      = False
         self.recovered[inds]        = False
         self.infectious_variant[inds] = np.nan
         self.exposed_variant[inds]    = np.nan
@@ -329,7 +474,7 @@ class People(cvb.BasePeople):
         self.diagnosed[diag_inds]   = True # Set these people to be diagnosed
         quarantined = cvu.itruei(self.quarantined, diag_inds)
         self.date_end_quarantine[quarantined] = self.t # Set end quarantine date to match when the person left quarantine (and entered isolation)
-        self.quarantined[diag_inds] = False # If you are diagnosed, you are isolated, not in quarantine
+        self.set_state('quarantined', diag_inds, False) # If you are diagnosed, you are isolated, not in quarantine
 
         return len(test_pos_inds)
 
@@ -337,19 +482,33 @@ class People(cvb.BasePeople):
     def check_quar(self):
         ''' Update quarantine state '''
 
-        n_quarantined = 0 # Number of people entering quarantine
-        for ind,end_day in self._pending_quarantine[self.t]:
-            if self.quarantined[ind]:
-                self.date_end_quarantine[ind] = max(self.date_end_quarantine[ind], end_day) # Extend quarantine if required
-            elif not (self.dead[ind] or self.recovered[ind] or self.diagnosed[ind]): # Unclear whether recovered should be included here # elif not (self.dead[ind] or self.diagnosed[ind]):
-                self.quarantined[ind] = True
-                self.date_quarantined[ind] = self.t
-                self.date_end_quarantine[ind] = end_day
-                n_quarantined += 1
+        # Gather everyone scheduled to start quarantine today, keeping the latest end day for anyone scheduled more than once
+        pending = self._pending_quarantine.pop(self.t, [])
+        if len(pending):
+            inds = np.concatenate([np.atleast_1d(p_inds) for p_inds,_ in pending])
+            end_days = np.concatenate([np.broadcast_to(end_day, np.shape(p_inds)).ravel() for p_inds,end_day in pending])
+            order = np.argsort(inds, kind='stable')
+            inds, starts = np.unique(inds[order], return_index=True)
+            end_days = np.maximum.reduceat(end_days[order], starts)
+        else:
+            inds = end_days = np.zeros(0, dtype=np.int64)
+
+        # Extend the quarantine of anyone already in quarantine
+        quar = self.quarantined[inds]
+        ext_inds = inds[quar]
+        self.date_end_quarantine[ext_inds] = np.maximum(self.date_end_quarantine[ext_inds], end_days[quar])
+
+        # Quarantine everyone else, unless they are no longer eligible
+        eligible = ~(quar | self.dead[inds] | self.recovered[inds] | self.diagnosed[inds]) # Unclear whether recovered should be included here
+        quar_inds = inds[eligible] # People entering quarantine
+        self.set_state('quarantined', quar_inds, True)
+        self.date_quarantined[quar_inds] = self.t
+        self.date_end_quarantine[quar_inds] = end_days[eligible]
+        n_quarantined = len(quar_inds) # Number of people entering quarantine
 
         # If someone on quarantine has reached the end of their quarantine, release them
         end_inds = self.check_inds(~self.quarantined, self.date_end_quarantine, filter_inds=None) # Note the double-negative here (~)
-        self.quarantined[end_inds] = False # Release from quarantine
+        self.set_state('quarantined', end_inds, False) # Release from quarantine
 
         return n_quarantined
 
@@ -360,25 +519,32 @@ class People(cvb.BasePeople):
         '''
         Make a set of people naive. This is used during dynamic resampling.
         '''
+        if self._imm_sums is not None: # Remove their NAbs and immunity from the population sums
+            alive = inds[~self.dead[inds]]
+            self._imm_sums.nab      -= self.nab[alive].sum(dtype=np.float64)
+            self._imm_sums.sus_imm  -= self.sus_imm[:, inds].sum(dtype=np.float64)
+            self._imm_sums.symp_imm -= self.symp_imm[:, inds].sum(dtype=np.float64)
+
         for key in self.meta.states:
             if key in ['susceptible', 'naive']:
-                self[key][inds] = True
+                self.set_state(key, inds, True)
             else:
-                self[key][inds] = False
+                self.set_state(key, inds, False)
 
         # Reset variant states
         for key in self.meta.variant_states:
             self[key][inds] = np.nan
         for key in self.meta.by_variant_states:
-            self[key][:, inds] = False
+            if self.allocated(key): # Arrays that haven't been used yet don't need resetting
+                self.set_state(key, inds, False)
 
         # Reset immunity and antibody states
         for key in self.meta.imm_states:
-            self[key][:, inds] = 0
-        for key in self.meta.nab_states:
-            self[key][inds] = 0
-        for key in self.meta.vacc_states:
-            self[key][inds] = 0
+            if self.allocated(key):
+                self[key][:, inds] = 0
+        for key in self.meta.nab_states + self.meta.vacc_states:
+            if self.allocated(key):
+                self[key][inds] = 0
 
         # Reset dates
         for key in self.meta.dates + self.meta.durs:
@@ -418,7 +584,7 @@ class People(cvb.BasePeople):
             * Critical cases either recover or die
 
         Method also deduplicates input arrays in case one agent is infected many times
-        and stores who infected whom in infection_log list.
+        and stores who infected whom in the infection log.
 
         Args:
             inds     (array): array of people to infect
@@ -460,91 +626,135 @@ class People(cvb.BasePeople):
         n_infections = len(inds)
         durpars      = self.pars['dur']
 
+        # The states by variant aren't needed until another variant circulates, since until then they match the states (see count_by_variant())
+        if variant:
+            self.alloc_arrays(self.meta.by_variant_states)
+
         # Update states, variant info, and flows
         self.susceptible[inds]    = False
         self.naive[inds]          = False
         self.recovered[inds]      = False
         self.diagnosed[inds]      = False
-        self.exposed[inds]        = True
+        self.set_state('exposed', inds, True)
         self.n_infections[inds]  += 1
         self.exposed_variant[inds] = variant
-        self.exposed_by_variant[variant, inds] = True
+        if self.allocated('exposed_by_variant'):
+            self.set_state('exposed_by_variant', inds, True, variant=variant)
         self.flows['new_infections']   += len(inds)
         self.flows['new_reinfections'] += len(cvu.defined(self.date_recovered[inds])) # Record reinfections
         self.flows_variant['new_infections_by_variant'][variant] += len(inds)
 
         # Record transmissions
-        for i, target in enumerate(inds):
-            entry = dict(source=source[i] if source is not None else None, target=target, date=self.t, layer=layer, variant=variant_label)
-            self.infection_log.append(entry)
-
-        # Calculate how long before this person can infect other people
-        self.dur_exp2inf[inds] = cvu.sample(**durpars['exp2inf'], size=n_infections)
-        self.date_exposed[inds]   = self.t
-        self.date_infectious[inds] = self.dur_exp2inf[inds] + self.t
+        self.infection_log.add(inds, sources=source, date=self.t, layer=layer, variant=variant_label)
+
+        # Use prognosis probabilities to determine what happens to them, in a single compiled pass if possible
+        self.date_exposed[inds] = self.t
+        if self.allocated('symp_imm'):
+            symp_imm, sev_imm = self.symp_imm[variant], self.sev_imm[variant]
+        else: # No one has any immunity without waning
+            symp_imm = sev_imm = np.zeros(len(self), dtype=cvd.default_float)
+        progpars = cvu.prognosis_pars(durpars) if cvo.fast_prognoses else None
+        if progpars is not None:
+            self.date_diagnosed[inds] = np.nan
+            dist_codes, dist_pars = progpars
+            u = np.random.random((4, n_infections))
+            z = np.random.standard_normal((5, n_infections))
+            hosp_factor = self.pars['no_hosp_factor'] if hosp_max else 1.
+            icu_factor  = self.pars['no_icu_factor'] if icu_max else 1.
+            probs = [self.symp_prob, self.severe_prob, self.crit_prob, self.death_prob, symp_imm, sev_imm]
+            day_keys = ['dur_exp2inf', 'dur_inf2sym', 'dur_sym2sev', 'dur_sev2crit', 'dur_disease', 'date_infectious', 'date_symptomatic', 'date_severe', 'date_critical', 'date_recovered', 'date_dead']
+            days = [self[key] for key in day_keys]
+            prog_inds = inds
+            if cvo.compact_days: # The compiled pass needs float arrays, so give it the values for just these people, and store them afterwards
+                prog_inds = np.arange(n_infections)
+                probs = [arr[inds] for arr in probs]
+                days = [arr[inds] for arr in days]
+            outcomes = cvu.compute_prognoses(self.t, prog_inds, dist_codes, dist_pars, z, u, *probs, infect_pars['rel_symp_prob'], infect_pars['rel_severe_prob'],
+                                             infect_pars['rel_crit_prob']*hosp_factor, infect_pars['rel_death_prob']*icu_factor, *days)
+            if cvo.compact_days:
+                for key,arr in zip(day_keys, days):
+                    self[key][inds] = arr
+            asymp_inds = inds[outcomes == 0]
+            mild_inds  = inds[outcomes == 1]
+            sev_inds   = inds[outcomes >= 2]
+            self.flows_variant['new_symptomatic_by_variant'][variant] += n_infections - len(asymp_inds)
+            self.flows_variant['new_severe_by_variant'][variant] += len(sev_inds)
 
-        # Reset all other dates
-        for key in ['date_symptomatic', 'date_severe', 'date_critical', 'date_diagnosed', 'date_recovered']:
-            self[key][inds] = np.nan
-
-        # Use prognosis probabilities to determine what happens to them
-        symp_probs = infect_pars['rel_symp_prob']*self.symp_prob[inds]*(1-self.symp_imm[variant, inds]) # Calculate their actual probability of being symptomatic
-        is_symp = cvu.binomial_arr(symp_probs) # Determine if they develop symptoms
-        symp_inds = inds[is_symp]
-        asymp_inds = inds[~is_symp] # Asymptomatic
-        self.flows_variant['new_symptomatic_by_variant'][variant] += len(symp_inds)
-
-        # CASE 1: Asymptomatic: may infect others, but have no symptoms and do not die
-        dur_asym2rec = cvu.sample(**durpars['asym2rec'], size=len(asymp_inds))
-        self.date_recovered[asymp_inds] = self.date_infectious[asymp_inds] + dur_asym2rec  # Date they recover
-        self.dur_disease[asymp_inds] = self.dur_exp2inf[asymp_inds] + dur_asym2rec  # Store how long this person had COVID-19
-
-        # CASE 2: Symptomatic: can either be mild, severe, or critical
-        n_symp_inds = len(symp_inds)
-        self.dur_inf2sym[symp_inds] = cvu.sample(**durpars['inf2sym'], size=n_symp_inds) # Store how long this person took to develop symptoms
-        self.date_symptomatic[symp_inds] = self.date_infectious[symp_inds] + self.dur_inf2sym[symp_inds] # Date they become symptomatic
-        sev_probs = infect_pars['rel_severe_prob'] * self.severe_prob[symp_inds]*(1-self.sev_imm[variant, symp_inds]) # Probability of these people being severe
-        is_sev = cvu.binomial_arr(sev_probs) # See if they're a severe or mild case
-        sev_inds = symp_inds[is_sev]
-        mild_inds = symp_inds[~is_sev] # Not severe
-        self.flows_variant['new_severe_by_variant'][variant] += len(sev_inds)
-
-        # CASE 2.1: Mild symptoms, no hospitalization required and no probability of death
-        dur_mild2rec = cvu.sample(**durpars['mild2rec'], size=len(mild_inds))
-        self.date_recovered[mild_inds] = self.date_symptomatic[mild_inds] + dur_mild2rec  # Date they recover
-        self.dur_disease[mild_inds] = self.dur_exp2inf[mild_inds] + self.dur_inf2sym[mild_inds] + dur_mild2rec  # Store how long this person had COVID-19
-
-        # CASE 2.2: Severe cases: hospitalization required, may become critical
-        self.dur_sym2sev[sev_inds] = cvu.sample(**durpars['sym2sev'], size=len(sev_inds)) # Store how long this person took to develop severe symptoms
-        self.date_severe[sev_inds] = self.date_symptomatic[sev_inds] + self.dur_sym2sev[sev_inds]  # Date symptoms become severe
-        crit_probs = infect_pars['rel_crit_prob'] * self.crit_prob[sev_inds] * (self.pars['no_hosp_factor'] if hosp_max else 1.) # Probability of these people becoming critical - higher if no beds available
-        is_crit = cvu.binomial_arr(crit_probs)  # See if they're a critical case
-        crit_inds = sev_inds[is_crit]
-        non_crit_inds = sev_inds[~is_crit]
-
-        # CASE 2.2.1 Not critical - they will recover
-        dur_sev2rec = cvu.sample(**durpars['sev2rec'], size=len(non_crit_inds))
-        self.date_recovered[non_crit_inds] = self.date_severe[non_crit_inds] + dur_sev2rec  # Date they recover
-        self.dur_disease[non_crit_inds] = self.dur_exp2inf[non_crit_inds] + self.dur_inf2sym[non_crit_inds] + self.dur_sym2sev[non_crit_inds] + dur_sev2rec  # Store how long this person had COVID-19
-
-        # CASE 2.2.2: Critical cases: ICU required, may die
-        self.dur_sev2crit[crit_inds] = cvu.sample(**durpars['sev2crit'], size=len(crit_inds))
-        self.date_critical[crit_inds] = self.date_severe[crit_inds] + self.dur_sev2crit[crit_inds]  # Date they become critical
-        death_probs = infect_pars['rel_death_prob'] * self.death_prob[crit_inds] * (self.pars['no_icu_factor'] if icu_max else 1.)# Probability they'll die
-        is_dead = cvu.binomial_arr(death_probs)  # Death outcome
-        dead_inds = crit_inds[is_dead]
-        alive_inds = crit_inds[~is_dead]
-
-        # CASE 2.2.2.1: Did not die
-        dur_crit2rec = cvu.sample(**durpars['crit2rec'], size=len(alive_inds))
-        self.date_recovered[alive_inds] = self.date_critical[alive_inds] + dur_crit2rec # Date they recover
-        self.dur_disease[alive_inds] = self.dur_exp2inf[alive_inds] + self.dur_inf2sym[alive_inds] + self.dur_sym2sev[alive_inds] + self.dur_sev2crit[alive_inds] + dur_crit2rec  # Store how long this person had COVID-19
-
-        # CASE 2.2.2.2: Did die
-        dur_crit2die = cvu.sample(**durpars['crit2die'], size=len(dead_inds))
-        self.date_dead[dead_inds] = self.date_critical[dead_inds] + dur_crit2die # Date of death
-        self.dur_disease[dead_inds] = self.dur_exp2inf[dead_inds] + self.dur_inf2sym[dead_inds] + self.dur_sym2sev[dead_inds] + self.dur_sev2crit[dead_inds] + dur_crit2die   # Store how long this person had COVID-19
-        self.date_recovered[dead_inds] = np.nan # If they did die, remove them from recovered
+        else:
+            # Calculate how long before this person can infect other people
+            self.dur_exp2inf[inds] = cvu.sample(**durpars['exp2inf'], size=n_infections)
+            self.date_infectious[inds] = self.dur_exp2inf[inds] + self.t
+
+            # Reset all other dates
+            for key in ['date_symptomatic', 'date_severe', 'date_critical', 'date_diagnosed', 'date_recovered']:
+                self[key][inds] = np.nan
+
+            # Use prognosis probabilities to determine what happens to them
+            symp_probs = infect_pars['rel_symp_prob']*self.symp_prob[inds]*(1-symp_imm[inds]) # Calculate their actual probability of being symptomatic
+            is_symp = cvu.binomial_arr(symp_probs) # Determine if they develop symptoms
+            symp_inds = inds[is_symp]
+            asymp_inds = inds[~is_symp] # Asymptomatic
+            self.flows_variant['new_symptomatic_by_variant'][variant] += len(symp_inds)
+
+            # CASE 1: Asymptomatic: may infect others, but have no symptoms and do not die
+            dur_asym2rec = cvu.sample(**durpars['asym2rec'], size=len(asymp_inds))
+            self.date_recovered[asymp_inds] = self.date_infectious[asymp_inds] + dur_asym2rec  # Date they recover
+            self.dur_disease[asymp_inds] = self.dur_exp2inf[asymp_inds] + dur_asym2rec  # Store how long this person had COVID-19
+
+            # CASE 2: Symptomatic: can either be mild, severe, or critical
+            n_symp_inds = len(symp_inds)
+            self.dur_inf2sym[symp_inds] = cvu.sample(**durpars['inf2sym'], size=n_symp_inds) # Store how long this person took to develop symptoms
+            self.date_symptomatic[symp_inds] = self.date_infectious[symp_inds] + self.dur_inf2sym[symp_inds] # Date they become symptomatic
+            sev_probs = infect_pars['rel_severe_prob'] * self.severe_prob[symp_inds]*(1-sev_imm[symp_inds]) # Probability of these people being severe
+            is_sev = cvu.binomial_arr(sev_probs) # See if they're a severe or mild case
+            sev_inds = symp_inds[is_sev]
+            mild_inds = symp_inds[~is_sev] # Not severe
+            self.flows_variant['new_severe_by_variant'][variant] += len(sev_inds)
+
+            # CASE 2.1: Mild symptoms, no hospitalization required and no probability of death
+            dur_mild2rec = cvu.sample(**durpars['mild2rec'], size=len(mild_inds))
+            self.date_recovered[mild_inds] = self.date_symptomatic[mild_inds] + dur_mild2rec  # Date they recover
+            self.dur_disease[mild_inds] = self.dur_exp2inf[mild_inds] + self.dur_inf2sym[mild_inds] + dur_mild2rec  # Store how long this person had COVID-19
+
+            # CASE 2.2: Severe cases: hospitalization required, may become critical
+            self.dur_sym2sev[sev_inds] = cvu.sample(**durpars['sym2sev'], size=len(sev_inds)) # Store how long this person took to develop severe symptoms
+            self.date_severe[sev_inds] = self.date_symptomatic[sev_inds] + self.dur_sym2sev[sev_inds]  # Date symptoms become severe
+            crit_probs = infect_pars['rel_crit_prob'] * self.crit_prob[sev_inds] * (self.pars['no_hosp_factor'] if hosp_max else 1.) # Probability of these people becoming critical - higher if no beds available
+            is_crit = cvu.binomial_arr(crit_probs)  # See if they're a critical case
+            crit_inds = sev_inds[is_crit]
+            non_crit_inds = sev_inds[~is_crit]
+
+            # CASE 2.2.1 Not critical - they will recover
+            dur_sev2rec = cvu.sample(**durpars['sev2rec'], size=len(non_crit_inds))
+            self.date_recovered[non_crit_inds] = self.date_severe[non_crit_inds] + dur_sev2rec  # Date they recover
+            self.dur_disease[non_crit_inds] = self.dur_exp2inf[non_crit_inds] + self.dur_inf2sym[non_crit_inds] + self.dur_sym2sev[non_crit_inds] + dur_sev2rec  # Store how long this person had COVID-19
+
+            # CASE 2.2.2: Critical cases: ICU required, may die
+            self.dur_sev2crit[crit_inds] = cvu.sample(**durpars['sev2crit'], size=len(crit_inds))
+            self.date_critical[crit_inds] = self.date_severe[crit_inds] + self.dur_sev2crit[crit_inds]  # Date they become critical
+            death_probs = infect_pars['rel_death_prob'] * self.death_prob[crit_inds] * (self.pars['no_icu_factor'] if icu_max else 1.)# Probability they'll die
+            is_dead = cvu.binomial_arr(death_probs)  # Death outcome
+            dead_inds = crit_inds[is_dead]
+            alive_inds = crit_inds[~is_dead]
+
+            # CASE 2.2.2.1: Did not die
+            dur_crit2rec = cvu.sample(**durpars['crit2rec'], size=len(alive_inds))
+            self.date_recovered[alive_inds] = self.date_critical[alive_inds] + dur_crit2rec # Date they recover
+            self.dur_disease[alive_inds] = self.dur_exp2inf[alive_inds] + self.dur_inf2sym[alive_inds] + self.dur_sym2sev[alive_inds] + self.dur_sev2crit[alive_inds] + dur_crit2rec  # Store how long this person had COVID-19
+
+            # CASE 2.2.2.2: Did die
+            dur_crit2die = cvu.sample(**durpars['crit2die'], size=len(dead_inds))
+            self.date_dead[dead_inds] = self.date_critical[dead_inds] + dur_crit2die # Date of death
+            self.dur_disease[dead_inds] = self.dur_exp2inf[dead_inds] + self.dur_inf2sym[dead_inds] + self.dur_sym2sev[dead_inds] + self.dur_sev2crit[dead_inds] + dur_crit2die   # Store how long this person had COVID-19
+            self.date_recovered[dead_inds] = np.nan # If they did die, remove them from recovered
+
+        # Calculate when their viral load will drop, if viral loads are being computed incrementally
+        if self._viral is not None:
+            self._viral.switch[inds] = self.compute_viral_switch(inds)
+
+        # Schedule their transitions, if a calendar queue is being used
+        if self._events is not None:
+            self.schedule_events(inds)
 
         # Handle immunity aspects
         if self.pars['use_waning']:
@@ -605,8 +815,9 @@ class People(cvb.BasePeople):
 
         start_date = self.t if start_date is None else int(start_date)
         period = self.pars['quar_period'] if period is None else int(period)
-        for ind in inds:
-            self._pending_quarantine[start_date].append((ind, start_date + period))
+        inds = np.array(inds, dtype=np.int64).ravel()
+        if len(inds):
+            self._pending_quarantine[start_date].append((inds, start_date + period))
         return
 
 
@@ -720,7 +931,9 @@ class People(cvb.BasePeople):
                 if not np.isnan(date):
                     events.append((date, message))
 
-            for infection in self.infection_log:
+            log = self.infection_log
+            for i in cvu.true((log.target == uid) | (log.source == uid)): # Only the infections involving this person
+                infection = log[i]
                 lkey = infection['layer']
                 llabel = label_lkey(lkey)
                 if infection['target'] == uid:
@@ -730,7 +943,7 @@ class People(cvb.BasePeople):
                         events.append((infection['date'], 'was infected with COVID as a seed infection'))
 
                 if infection['source'] == uid:
-                    x = len([a for a in self.infection_log if a['source'] == infection['target']])
+                    x = np.count_nonzero(log.source == infection['target'])
                     events.append((infection['date'],f'gave COVID to {infection["target"]} via the {llabel} layer ({x} secondary infections)'))
 
             if len(events):
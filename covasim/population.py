@@ -3,9 +3,9 @@ Defines functions for making the population.
 '''
 
 #%% Imports
+import os
 import numpy as np # Needed for a few things not provided by pl
 import sciris as sc
-from collections import defaultdict
 from . import requirements as cvreq
 from . import utils as cvu
 from . import misc as cvm
@@ -13,6 +13,7 @@ from . import data as cvdata
 from . import defaults as cvd
 from . import parameters as cvpar
 from . import people as cvppl
+from . import base as cvb
 
 
 # Specify all externally visible functions this file defines
@@ -96,8 +97,11 @@ def make_people(sim, popdict=None, save_pop=False, popfile=None, die=True, reset
             errormsg = 'Please specify a file to save to using the popfile kwarg'
             raise FileNotFoundError(errormsg)
         else:
-            filepath = sc.makefilepath(filename=popfile)
-            cvm.save(filepath, people)
+            if popfile.endswith(('/', os.sep)) or os.path.isdir(popfile): # Save to a folder as memory-mappable columns
+                filepath = people.save_columns(popfile)
+            else:
+                filepath = sc.makefilepath(filename=popfile)
+                cvm.save(filepath, people)
             if verbose:
                 print(f'Saved population of type "{pop_type}" with {pop_size:n} people to {filepath}')
 
@@ -113,7 +117,7 @@ def make_randpop(sim, use_age_data=True, use_household_data=True, sex_ratio=0.5,
         - uid: an array of (usually consecutive) integers of length N, uniquely identifying each agent
         - age: an array of floats of length N, the age in years of each agent
         - sex: an array of integers of length N (not currently used, so does not have to be binary)
-        - contacts: list of length N listing the contacts; see make_random_contacts() for details
+        - contacts: the contacts, as a Contacts object with an edge list for each layer; see make_random_contacts() for details
         - layer_keys: a list of strings representing the different contact layers in the population; see make_random_contacts() for details
 
     Args:
@@ -170,9 +174,9 @@ def make_randpop(sim, use_age_data=True, use_household_data=True, sex_ratio=0.5,
     popdict['sex'] = sexes
 
     # Actually create the contacts
-    if   microstructure == 'random':    contacts, layer_keys    = make_random_contacts(pop_size, sim['contacts'])
-    elif microstructure == 'clustered': contacts, layer_keys, _ = make_microstructured_contacts(pop_size, sim['contacts'])
-    elif microstructure == 'hybrid':    contacts, layer_keys, _ = make_hybrid_contacts(pop_size, ages, sim['contacts'])
+    if   microstructure == 'random':    contacts, layer_keys    = make_random_contacts(pop_size, sim['contacts'], as_layers=True)
+    elif microstructure == 'clustered': contacts, layer_keys, _ = make_microstructured_contacts(pop_size, sim['contacts'], as_layers=True)
+    elif microstructure == 'hybrid':    contacts, layer_keys, _ = make_hybrid_contacts(pop_size, ages, sim['contacts'], as_layers=True)
     else: # pragma: no cover
         errormsg = f'Microstructure type "{microstructure}" not found; choices are random, clustered, or hybrid'
         raise NotImplementedError(errormsg)
@@ -183,7 +187,7 @@ def make_randpop(sim, use_age_data=True, use_household_data=True, sex_ratio=0.5,
     return popdict
 
 
-def make_random_contacts(pop_size, contacts, overshoot=1.2, dispersion=None):
+def make_random_contacts(pop_size, contacts, overshoot=1.2, dispersion=None, as_layers=False):
     '''
     Make random static contacts.
 
@@ -192,9 +196,10 @@ def make_random_contacts(pop_size, contacts, overshoot=1.2, dispersion=None):
         contacts (dict): a dictionary with one entry per layer describing the average number of contacts per person for that layer
         overshoot (float): to avoid needing to take multiple Poisson draws
         dispersion (float): if not None, use a negative binomial distribution with this dispersion parameter instead of Poisson to make the contacts
+        as_layers (bool): if true, return the contacts as a Contacts object with an edge list for each layer, instead of a list of contacts by person (much faster for large populations)
 
     Returns:
-        contacts_list (list): a list of length N, where each entry is a dictionary by layer, and each dictionary entry is the UIDs of the agent's contacts
+        contacts_list (list): a list of length N, where each entry is a dictionary by layer, and each dictionary entry is the UIDs of the agent's contacts (or a Contacts object if as_layers is true)
         layer_keys (list): a list of layer keys, which is the same as the keys of the input "contacts" dictionary
     '''
 
@@ -202,7 +207,6 @@ def make_random_contacts(pop_size, contacts, overshoot=1.2, dispersion=None):
     pop_size = int(pop_size) # Number of people
     contacts = sc.dcp(contacts)
     layer_keys = list(contacts.keys())
-    contacts_list = []
 
     # Precalculate contacts
     n_across_layers = np.sum(list(contacts.values()))
@@ -216,68 +220,101 @@ def make_random_contacts(pop_size, contacts, overshoot=1.2, dispersion=None):
             p_count = cvu.n_neg_binomial(rate=contacts[lkey], dispersion=dispersion, n=pop_size) # Or, from a negative binomial
         p_counts[lkey] = np.array((p_count/2.0).round(), dtype=cvd.default_int)
 
-    # Make contacts
-    count = 0
-    for p in range(pop_size):
-        contact_dict = {}
-        for lkey in layer_keys:
-            n_contacts = p_counts[lkey][p]
-            contact_dict[lkey] = all_contacts[count:count+n_contacts] # Assign people
-            count += n_contacts
-        contacts_list.append(contact_dict)
+    # Assign people: each person takes their contacts for each layer in turn from all_contacts, until it runs out
+    counts = np.array([p_counts[lkey] for lkey in layer_keys], dtype=np.int64).T.reshape(pop_size, len(layer_keys))
+    ends   = np.cumsum(counts).reshape(counts.shape)
+    starts = np.minimum(ends - counts, n_all_contacts)
+    counts = np.minimum(ends, n_all_contacts) - starts
+
+    # Make the edges of each layer
+    edges = {}
+    for l,lkey in enumerate(layer_keys):
+        n_contacts = counts[:,l]
+        offsets = np.repeat(starts[:,l] - (np.cumsum(n_contacts) - n_contacts), n_contacts) # Where each person's contacts start in all_contacts, less where they start in the layer
+        edges[lkey] = all_contacts[offsets + np.arange(len(offsets))]
+
+    # Return as layers
+    if as_layers:
+        output = cvb.Contacts(layer_keys=layer_keys)
+        for l,lkey in enumerate(layer_keys):
+            p1 = np.repeat(np.arange(pop_size, dtype=cvd.default_int), counts[:,l])
+            p2 = edges[lkey].astype(cvd.default_int)
+            output[lkey] = cvb.Layer(p1=p1, p2=p2, beta=np.ones(len(p1), dtype=cvd.default_float), label=lkey)
+        return output, layer_keys
+
+    # Or split them up by person
+    contacts_list = [{} for p in range(pop_size)]
+    for l,lkey in enumerate(layer_keys):
+        start = 0
+        for p,end in enumerate(np.cumsum(counts[:,l]).tolist()):
+            contacts_list[p][lkey] = edges[lkey][start:end]
+            start = end
 
     return contacts_list, layer_keys
 
 
-def make_microstructured_contacts(pop_size, contacts):
-    ''' Create microstructured contacts -- i.e. for households '''
+def make_microstructured_contacts(pop_size, contacts, as_layers=False):
+    '''
+    Create microstructured contacts -- i.e. for households. Each layer divides
+    the population into clusters of consecutive people, with Poisson-distributed
+    sizes, and connects everyone in a cluster with everyone else.
+
+    Args:
+        pop_size (int): number of agents to create contacts between (N)
+        contacts (dict): a dictionary with one entry per layer describing the average cluster size for that layer; community contacts ('c') are ignored
+        as_layers (bool): if true, return the contacts as a Contacts object with an edge list for each layer, instead of a list of contacts by person (much faster for large populations)
+
+    Returns:
+        contacts_list (list): a list of length N, where each entry is a dictionary by layer of the UIDs of the agent's contacts (or a Contacts object if as_layers is true)
+        layer_keys (list): a list of layer keys
+        clusters (dict): for each layer, a dictionary of the UIDs of the people in each cluster (or if as_layers is true, an array of the cluster of each person)
+    '''
 
     # Preprocessing -- same as above
     pop_size = int(pop_size) # Number of people
     contacts = sc.dcp(contacts)
     contacts.pop('c', None) # Remove community
     layer_keys = list(contacts.keys())
-    contacts_list = [{c:[] for c in layer_keys} for p in range(pop_size)] # Pre-populate
+    output = cvb.Contacts(layer_keys=layer_keys) if as_layers else [{c:[] for c in layer_keys} for p in range(pop_size)] # Pre-populate
+    clusters = {}
 
     for layer_name, cluster_size in contacts.items():
 
-        # Initialize
-        cluster_dict = dict() # Add dictionary for this layer
-        n_remaining = pop_size # Make clusters - each person belongs to one cluster
-        contacts_dict = defaultdict(set) # Use defaultdict of sets for convenience while initializing. Could probably change this as part of performance optimization
-
-        # Loop over the clusters
-        cluster_id = -1
-        while n_remaining > 0:
-            cluster_id += 1 # Assign cluster id
-            this_cluster =  cvu.poisson(cluster_size)  # Sample the cluster size
-            if this_cluster > n_remaining:
-                this_cluster = n_remaining
-
-            # Indices of people in this cluster
-            cluster_indices = (pop_size-n_remaining)+np.arange(this_cluster)
-            cluster_dict[cluster_id] = cluster_indices
-            for i in cluster_indices: # Add symmetric pairwise contacts in each cluster
-                for j in cluster_indices:
-                    if j > i:
-                        contacts_dict[i].add(j)
-
-            n_remaining -= this_cluster
+        # Make clusters - each person belongs to one cluster
+        sizes  = cvu.cluster_sizes(cluster_size, pop_size)
+        starts = np.cumsum(sizes) - sizes
 
-        for key in contacts_dict.keys():
-            contacts_list[key][layer_name] = np.array(list(contacts_dict[key]), dtype=cvd.default_int)
+        # Make the symmetric pairwise contacts in each cluster, with each pair listed once
+        n_edges = int(np.sum(sizes*(sizes-1)//2))
+        p1 = np.empty(n_edges, dtype=cvd.default_int)
+        p2 = np.empty(n_edges, dtype=cvd.default_int)
+        cvu.make_cliques(sizes, p1, p2)
 
-        clusters = {layer_name: cluster_dict}
+        if as_layers:
+            output[layer_name] = cvb.Layer(p1=p1, p2=p2, beta=np.ones(n_edges, dtype=cvd.default_float), label=layer_name)
+            clusters[layer_name] = np.repeat(np.arange(len(sizes), dtype=cvd.default_int), sizes)
+        else:
+            n_contacts = np.repeat(starts + sizes, sizes) - np.arange(pop_size) - 1 # Each person is connected to everyone after them in their cluster
+            start = 0
+            for p,end in enumerate(np.cumsum(n_contacts).tolist()):
+                if end > start:
+                    output[p][layer_name] = p2[start:end]
+                start = end
+            clusters[layer_name] = {cluster_id:np.arange(start, start+size) for cluster_id,(start,size) in enumerate(zip(starts.tolist(), sizes.tolist()))}
 
-    return contacts_list, layer_keys, clusters
+    return output, layer_keys, clusters
 
 
-def make_hybrid_contacts(pop_size, ages, contacts, school_ages=None, work_ages=None):
+def make_hybrid_contacts(pop_size, ages, contacts, school_ages=None, work_ages=None, as_layers=False):
     '''
     Create "hybrid" contacts -- microstructured contacts for households and
     random contacts for schools and workplaces, both of which have extremely
     basic age structure. A combination of both make_random_contacts() and
     make_microstructured_contacts().
+
+    If as_layers is true, return the contacts as a Contacts object with an edge
+    list for each layer (much faster for large populations), and the households
+    as an array of the household of each person.
     '''
 
     # Handle inputs and defaults
@@ -288,14 +325,11 @@ def make_hybrid_contacts(pop_size, ages, contacts, school_ages=None, work_ages=N
     if work_ages is None:
         work_ages   = [22, 65]
 
-    # Create the empty contacts list -- a list of {'h':[], 's':[], 'w':[]}
-    contacts_list = [{key:[] for key in layer_keys} for i in range(pop_size)]
-
     # Start with the household contacts for each person
-    h_contacts, _, clusters = make_microstructured_contacts(pop_size, {'h':contacts['h']})
+    h_contacts, _, clusters = make_microstructured_contacts(pop_size, {'h':contacts['h']}, as_layers=as_layers)
 
     # Make community contacts
-    c_contacts, _ = make_random_contacts(pop_size, {'c':contacts['c']})
+    c_contacts, _ = make_random_contacts(pop_size, {'c':contacts['c']}, as_layers=as_layers)
 
     # Get the indices of people in each age bin
     ages = np.array(ages)
@@ -303,14 +337,25 @@ def make_hybrid_contacts(pop_size, ages, contacts, school_ages=None, work_ages=N
     w_inds = sc.findinds((ages >= work_ages[0])   * (ages < work_ages[1]))
 
     # Create the school and work contacts for each person
-    s_contacts, _ = make_random_contacts(len(s_inds), {'s':contacts['s']})
-    w_contacts, _ = make_random_contacts(len(w_inds), {'w':contacts['w']})
-
-    # Construct the actual lists of contacts
-    for i     in range(pop_size):   contacts_list[i]['h']   =        h_contacts[i]['h']  # Copy over household contacts -- present for everyone
-    for i,ind in enumerate(s_inds): contacts_list[ind]['s'] = s_inds[s_contacts[i]['s']] # Copy over school contacts
-    for i,ind in enumerate(w_inds): contacts_list[ind]['w'] = w_inds[w_contacts[i]['w']] # Copy over work contacts
-    for i     in range(pop_size):   contacts_list[i]['c']   =        c_contacts[i]['c']  # Copy over community contacts -- present for everyone
+    s_contacts, _ = make_random_contacts(len(s_inds), {'s':contacts['s']}, as_layers=as_layers)
+    w_contacts, _ = make_random_contacts(len(w_inds), {'w':contacts['w']}, as_layers=as_layers)
+
+    # Construct the layers, mapping the school and work contacts from the people in each age bin back to the whole population
+    if as_layers:
+        s_layer, w_layer = s_contacts['s'], w_contacts['w']
+        contacts_list = cvb.Contacts(layer_keys=layer_keys)
+        contacts_list['h'] = h_contacts['h']
+        contacts_list['s'] = cvb.Layer(p1=s_inds[s_layer['p1']], p2=s_inds[s_layer['p2']], beta=s_layer['beta'], label='s')
+        contacts_list['w'] = cvb.Layer(p1=w_inds[w_layer['p1']], p2=w_inds[w_layer['p2']], beta=w_layer['beta'], label='w')
+        contacts_list['c'] = c_contacts['c']
+
+    # Or construct the actual lists of contacts -- a list of {'h':[], 's':[], 'w':[], 'c':[]}
+    else:
+        contacts_list = [{key:[] for key in layer_keys} for i in range(pop_size)]
+        for i     in range(pop_size):   contacts_list[i]['h']   =        h_contacts[i]['h']  # Copy over household contacts -- present for everyone
+        for i,ind in enumerate(s_inds): contacts_list[ind]['s'] = s_inds[s_contacts[i]['s']] # Copy over school contacts
+        for i,ind in enumerate(w_inds): contacts_list[ind]['w'] = w_inds[w_contacts[i]['w']] # Copy over work contacts
+        for i     in range(pop_size):   contacts_list[i]['c']   =        c_contacts[i]['c']  # Copy over community contacts -- present for everyone
 
     return contacts_list, layer_keys, clusters
 
@@ -336,12 +381,6 @@ def make_synthpop(sim=None, population=None, layer_mapping=None, community_conta
         sim.popdict = cv.make_synthpop(sim)
         sim.run()
     '''
-    try:
-        import synthpops as sp # Optional import
-    except ModuleNotFoundError as E: # pragma: no cover
-        errormsg = 'Please install the optional SynthPops module first, e.g. pip install synthpops' # Also caught in make_people()
-        raise ModuleNotFoundError(errormsg) from E
-
     # Handle layer mapping
     default_layer_mapping = {'H':'h', 'S':'s', 'W':'w', 'C':'c', 'LTCF':'l'} # Remap keys from old names to new names
     layer_mapping = sc.mergedicts(default_layer_mapping, layer_mapping)
@@ -351,6 +390,11 @@ def make_synthpop(sim=None, population=None, layer_mapping=None, community_conta
         if sim is None: # pragma: no cover
             errormsg = 'Either a simulation or a population must be supplied'
             raise ValueError(errormsg)
+        try:
+            import synthpops as sp # Optional import
+        except ModuleNotFoundError as E: # pragma: no cover
+            errormsg = 'Please install the optional SynthPops module first, e.g. pip install synthpops' # Also caught in make_people()
+            raise ModuleNotFoundError(errormsg) from E
         pop_size = sim['pop_size']
         population = sp.make_population(n=pop_size, rand_seed=sim['rand_seed'], **kwargs)
 
@@ -361,46 +405,62 @@ def make_synthpop(sim=None, population=None, layer_mapping=None, community_conta
             errormsg = 'If a simulation is not supplied, the number of community contacts must be specified'
             raise ValueError(errormsg)
 
-    # Create the basic lists
+    # Create the basic arrays
     pop_size = len(population)
-    uids, ages, sexes, contacts = [], [], [], []
-    for uid,person in population.items():
-        uids.append(uid)
-        ages.append(person['age'])
-        sexes.append(person['sex'])
-
-    # Replace contact UIDs with ints
-    uid_mapping = {uid:u for u,uid in enumerate(uids)}
-    for uid in uids:
-        iid = uid_mapping[uid] # Integer UID
-        person = population.pop(uid)
-        uid_contacts = sc.dcp(person['contacts'])
-        int_contacts = {}
-        for spkey in uid_contacts.keys():
+    uids  = np.array(list(population.keys()))
+    ages  = np.array([person['age'] for person in population.values()])
+    sexes = np.array([person['sex'] for person in population.values()])
+
+    # Gather the contacts of everyone in each layer, as the number of contacts of each person and their UIDs
+    n_contacts = {}
+    contact_uids = {}
+    for iid,person in enumerate(population.values()):
+        for spkey,uid_contacts in person['contacts'].items():
             try:
                 lkey = layer_mapping[spkey] # Map the SynthPops key into a Covasim layer key
             except KeyError: # pragma: no cover
                 errormsg = f'Could not find key "{spkey}" in layer mapping "{layer_mapping}"'
                 raise sc.KeyNotFoundError(errormsg)
-            int_contacts[lkey] = []
-            for cid in uid_contacts[spkey]: # Contact ID
-                icid = uid_mapping[cid] # Integer contact ID
-                if icid>iid: # Don't add duplicate contacts
-                    int_contacts[lkey].append(icid)
-            int_contacts[lkey] = np.array(int_contacts[lkey], dtype=cvd.default_int)
-        contacts.append(int_contacts)
-
-    # Add community contacts
-    c_contacts, _ = make_random_contacts(pop_size, {'c':community_contacts})
-    for i in range(int(pop_size)):
-        contacts[i]['c'] = c_contacts[i]['c'] # Copy over community contacts -- present for everyone
+            if lkey not in n_contacts:
+                n_contacts[lkey] = np.zeros(pop_size, dtype=np.int64)
+                contact_uids[lkey] = []
+            n_contacts[lkey][iid] = len(uid_contacts)
+            contact_uids[lkey].extend(uid_contacts)
+
+    # Replace contact UIDs with ints -- by sorting if the UIDs are numbers, or else by looking them up
+    numeric = np.issubdtype(uids.dtype, np.number)
+    if numeric:
+        order = np.argsort(uids, kind='stable')
+        sorted_uids = uids[order]
+    else:
+        uid_mapping = {uid:u for u,uid in enumerate(uids.tolist())}
+
+    contacts = cvb.Contacts(layer_keys=list(n_contacts.keys()))
+    for lkey,cids in contact_uids.items():
+        if numeric:
+            cids = np.array(cids, dtype=uids.dtype)
+            icids = np.minimum(np.searchsorted(sorted_uids, cids), pop_size-1)
+            missing = sorted_uids[icids] != cids
+            if missing.any():
+                errormsg = f'Contact UID {cids[missing][0]} in layer "{lkey}" is not in the population'
+                raise sc.KeyNotFoundError(errormsg)
+            icids = order[icids]
+        else:
+            icids = np.fromiter(map(uid_mapping.__getitem__, cids), dtype=np.int64, count=len(cids)) # Integer contact IDs
+        p1 = np.repeat(np.arange(pop_size), n_contacts[lkey])
+        keep = icids > p1 # Don't add duplicate contacts
+        contacts[lkey] = cvb.Layer(p1=p1[keep], p2=icids[keep], beta=np.ones(keep.sum(), dtype=cvd.default_float), label=lkey)
+
+    # Add community contacts -- present for everyone
+    c_contacts, _ = make_random_contacts(pop_size, {'c':community_contacts}, as_layers=True)
+    contacts['c'] = c_contacts['c']
 
     # Finalize
     popdict = {}
-    popdict['uid']        = np.array(list(uid_mapping.values()), dtype=cvd.default_int)
-    popdict['age']        = np.array(ages)
-    popdict['sex']        = np.array(sexes)
-    popdict['contacts']   = sc.dcp(contacts)
+    popdict['uid']        = np.arange(pop_size, dtype=cvd.default_int)
+    popdict['age']        = ages
+    popdict['sex']        = sexes
+    popdict['contacts']   = contacts
     popdict['layer_keys'] = list(layer_mapping.values())
 
     return popdict
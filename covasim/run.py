@@ -3,6 +3,8 @@ Functions and classes for running multiple Covasim runs.
 '''
 
 #%% Imports
+import os
+import sys
 import numpy as np
 import pandas as pd
 import sciris as sc
@@ -16,7 +18,7 @@ from .settings import options as cvo
 
 
 # Specify all externally visible functions this file defines
-__all__ = ['make_metapars', 'MultiSim', 'Scenarios', 'single_run', 'multi_run']
+__all__ = ['make_metapars', 'MultiSim', 'Scenarios', 'SharedPeople', 'single_run', 'multi_run']
 
 
 
@@ -1296,7 +1298,144 @@ class Scenarios(cvb.ParsObj):
             return string
 
 
-def single_run(sim, ind=0, reseed=True, noise=0.0, noisepar=None, keep_people=False, run_args=None, sim_args=None, verbose=None, do_run=True, **kwargs):
+class SharedPeople(object):
+    '''
+    The static arrays of a sim's people -- the edges of the contact layers that are
+    not dynamic, and the person attributes that do not change once the people have
+    been initialized -- copied into a block of shared memory, so that parallel runs
+    of the same population can use them without each process having its own copy.
+    Used by multi_run() if ``share_static=True``.
+
+    When pickled, only the name of the shared memory and the layout of the arrays
+    are saved. When unpickled (e.g. in a worker process), the shared memory is
+    attached, and attach() sets the sim's arrays to views into it. These arrays
+    must not be modified in place, since the changes would be seen by every run;
+    Covasim itself only replaces them (e.g. when clipping edges, or if the people
+    are initialized again, which replaces their prognoses). The process that
+    created the shared memory must call close() once the runs are finished.
+
+    Args:
+        sim (Sim): an initialized sim whose static arrays to share
+
+    **Example**::
+
+        sim = cv.Sim(pop_size=100e3, pop_type='hybrid').init_people()
+        sims = cv.multi_run(sim, n_runs=8, share_static=True)
+    '''
+
+    person_keys = ['uid', 'age', 'sex', 'rel_trans', 'severe_prob', 'crit_prob', 'death_prob'] # Not changed after the people are initialized
+
+    def __init__(self, sim):
+        from multiprocessing import shared_memory # Only needed if sharing
+        arrays = self.get_arrays(sim)
+        columns = {key:(arr.shape, arr.dtype) for key,arr in arrays.items()}
+        table, nbytes = cvb.ColumnBuffer.layout(columns)
+        self.columns = columns
+        self.shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        self.buffer = cvb.ColumnBuffer(columns, buffer=np.ndarray(nbytes, dtype=np.uint8, buffer=self.shm.buf))
+        for key,arr in arrays.items():
+            self.buffer[key][...] = arr
+        return
+
+
+    @classmethod
+    def get_arrays(cls, sim):
+        ''' Get the static arrays of the sim, with the key of each layer column given by (layer key, column key) '''
+        people = sim.people
+        arrays = {key:people[key] for key in cls.person_keys}
+        for lkey,layer in people.contacts.items():
+            if not sim['dynam_layer'].get(lkey, False):
+                for col,arr in layer.items():
+                    arrays[(lkey, col)] = arr
+        return arrays
+
+
+    @staticmethod
+    def set_arrays(sim, arrays):
+        ''' Set the static arrays of the sim, in the format returned by get_arrays() '''
+        people = sim.people
+        for key,arr in arrays.items():
+            if isinstance(key, tuple):
+                lkey, col = key
+                people.contacts[lkey][col] = arr
+            else:
+                people[key] = arr
+        return
+
+
+    def strip(self, sim):
+        '''
+        Replace the static arrays of the sim with empty arrays, so the sim can be
+        pickled without them; returns the original arrays, to pass to restore()
+        '''
+        arrays = self.get_arrays(sim)
+        self.set_arrays(sim, {key:np.empty(0, dtype=arr.dtype) for key,arr in arrays.items()})
+        return arrays
+
+
+    def restore(self, sim, arrays):
+        ''' Restore the arrays removed by strip() '''
+        self.set_arrays(sim, arrays)
+        return
+
+
+    def attach(self, sim):
+        ''' Set the static arrays of the sim to views into the shared memory '''
+        self.set_arrays(sim, {key:self.buffer[key] for key in self.columns.keys()})
+        return
+
+
+    def close(self):
+        ''' Release the shared memory -- only to be called by the process that created it, once no process needs it '''
+        self.buffer = None # The views into the shared memory must be released before it can be closed
+        self.shm.close()
+        self.shm.unlink()
+        return
+
+
+    def __getstate__(self):
+        ''' Only save the name of the shared memory, and the layout of the arrays '''
+        return {'name':self.shm.name, 'columns':self.columns}
+
+
+    def __setstate__(self, state):
+        ''' Attach the shared memory, reusing it if already attached by this process '''
+        self.columns = state['columns']
+        self.shm = _attach_shared_memory(state['name'])
+        nbytes = cvb.ColumnBuffer.layout(self.columns)[1]
+        self.buffer = cvb.ColumnBuffer(self.columns, buffer=np.ndarray(nbytes, dtype=np.uint8, buffer=self.shm.buf))
+        return
+
+
+_attached = {} # The shared memory attached by this process, by name; kept open for the life of the process, since arrays may still refer to it
+
+def _attach_shared_memory(name):
+    '''
+    Attach a block of shared memory created by another process -- not for users.
+
+    The process that created the memory removes it (see SharedPeople.close()), so
+    this process must not track it too, or its resource tracker would remove the
+    memory when the process exits. From Python 3.13, this is done with track=False.
+    Before that, the memory is unregistered after attaching it, unless this process
+    shares the resource tracker of the process that created it (e.g. if forked).
+    This relies on the tracker's private ``_fd`` attribute (present in Python 3.8-3.12);
+    if it is missing, the memory is always unregistered.
+    '''
+    if name not in _attached:
+        from multiprocessing import shared_memory, resource_tracker
+        if sys.version_info >= (3, 13):
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        else:
+            tracker = getattr(resource_tracker, '_resource_tracker', None)
+            tracked = os.name == 'posix' and getattr(tracker, '_fd', None) is not None # Whether this process shares the resource tracker of the process that created the memory
+            shm = shared_memory.SharedMemory(name=name)
+            if os.name == 'posix' and not tracked: # pragma: no cover
+                resource_tracker.unregister(shm._name, 'shared_memory')
+        _attached[name] = shm
+    return _attached[name]
+
+
+def single_run(sim, ind=0, reseed=True, noise=0.0, noisepar=None, keep_people=False, run_args=None, sim_args=None, verbose=None, do_run=True, shared=None, **kwargs):
     '''
     Convenience function to perform a single simulation run. Mostly used for
     parallelization, but can also be used directly.
@@ -1312,6 +1451,7 @@ def single_run(sim, ind=0, reseed=True, noise=0.0, noisepar=None, keep_people=Fa
         sim_args    (dict)  : extra parameters to pass to the sim, e.g. 'n_infected'
         verbose     (int)   : detail to print
         do_run      (bool)  : whether to actually run the sim (if not, just initialize it)
+        shared      (SharedPeople) : if supplied, the static arrays to use for the sim's people (see multi_run())
         kwargs      (dict)  : also passed to the sim
 
     Returns:
@@ -1330,6 +1470,10 @@ def single_run(sim, ind=0, reseed=True, noise=0.0, noisepar=None, keep_people=Fa
     if verbose is None:
         verbose = sim['verbose']
 
+    # Use the shared static arrays, if supplied
+    if shared is not None:
+        shared.attach(sim)
+
     if not sim.label:
         sim.label = f'Sim {ind:d}'
 
@@ -1376,7 +1520,7 @@ def single_run(sim, ind=0, reseed=True, noise=0.0, noisepar=None, keep_people=Fa
     return sim
 
 
-def multi_run(sim, n_runs=4, reseed=True, noise=0.0, noisepar=None, iterpars=None, combine=False, keep_people=None, run_args=None, sim_args=None, par_args=None, do_run=True, parallel=True, n_cpus=None, verbose=None, **kwargs):
+def multi_run(sim, n_runs=4, reseed=True, noise=0.0, noisepar=None, iterpars=None, combine=False, keep_people=None, run_args=None, sim_args=None, par_args=None, do_run=True, parallel=True, n_cpus=None, share_static=False, verbose=None, **kwargs):
     '''
     For running multiple runs in parallel. If the first argument is a list of sims,
     exactly these will be run and most other arguments will be ignored.
@@ -1396,6 +1540,7 @@ def multi_run(sim, n_runs=4, reseed=True, noise=0.0, noisepar=None, iterpars=Non
         do_run      (bool)  : whether to actually run the sim (if not, just initialize it)
         parallel    (bool)  : whether to run in parallel using multiprocessing (else, just run in a loop)
         n_cpus      (int)   : the number of CPUs to run on (if blank, set automatically; otherwise, passed to par_args)
+        share_static (bool) : if running a single sim in parallel, whether to share its static contact layers and person attributes between the runs via shared memory, rather than giving each run its own copy (see SharedPeople); the sim is initialized first if needed, so all runs use the same population
         verbose     (int)   : detail to print
         kwargs      (dict)  : also passed to the sim
 
@@ -1403,11 +1548,14 @@ def multi_run(sim, n_runs=4, reseed=True, noise=0.0, noisepar=None, iterpars=Non
         If combine is True, a single sim object with the combined results from each sim.
         Otherwise, a list of sim objects (default).
 
-    **Example**::
+    **Examples**::
 
         import covasim as cv
         sim = cv.Sim()
         sims = cv.multi_run(sim, n_runs=6, noise=0.2)
+
+        sim = cv.Sim(pop_size=1e6, pop_type='hybrid')
+        sims = cv.multi_run(sim, n_runs=32, share_static=True) # Only one copy of the household, school, and work contacts
     '''
 
     # Handle inputs
@@ -1438,6 +1586,15 @@ def multi_run(sim, n_runs=4, reseed=True, noise=0.0, noisepar=None, iterpars=Non
         errormsg = f'Must be Sim object or list, not {type(sim)}'
         raise TypeError(errormsg)
 
+    # Optionally share the static arrays between the runs, removing them from the sim while it's pickled
+    shared = None
+    if share_static and parallel and isinstance(sim, cvs.Sim):
+        if not sim.initialized:
+            sim.initialize()
+        shared = SharedPeople(sim)
+        stripped = shared.strip(sim)
+        kwargs['shared'] = shared
+
     # Actually run!
     if parallel:
         try:
@@ -1461,6 +1618,10 @@ Alternatively, to run without multiprocessing, set parallel=False.
                 raise RuntimeError(errormsg) from E
             else: # For all other runtime errors, raise the original exception
                 raise E
+        finally:
+            if shared is not None:
+                shared.restore(sim, stripped)
+                shared.close()
     else: # Run in serial, not in parallel
         sims = []
         n_sims = len(list(iterkwargs.values())[0]) # Must have length >=1 and all entries must be the same length
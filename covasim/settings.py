@@ -53,12 +53,45 @@ def set_default_options():
     optdesc.precision = 'Set arithmetic precision for Numba -- 32-bit by default for efficiency'
     options.precision = int(os.getenv('COVASIM_PRECISION', 32))
 
-    optdesc.numba_parallel = 'Set Numba multithreading -- none, safe, full; full multithreading is ~20% faster, but results become nondeterministic'
+    optdesc.numba_parallel = 'Set Numba multithreading -- none, safe, full; full multithreading is ~20% faster, and uses a counter-based random number stream so results are reproducible for any number of threads, but differ from none/safe'
     options.numba_parallel = str(os.getenv('COVASIM_NUMBA_PARALLEL', 'none'))
 
     optdesc.numba_cache = 'Set Numba caching -- saves on compilation time, but harder to update'
     options.numba_cache = bool(int(os.getenv('COVASIM_NUMBA_CACHE', 1)))
 
+    optdesc.layer_index = 'Set whether to index the edges of non-dynamic layers by person, so transmission only visits the contacts of infectious people -- faster at low prevalence, but uses more memory'
+    options.layer_index = bool(int(os.getenv('COVASIM_LAYER_INDEX', 0)))
+
+    optdesc.sparse_viral_load = 'Set whether to compute viral loads only for infectious people, using switch points calculated at infection -- faster at low prevalence'
+    options.sparse_viral_load = bool(int(os.getenv('COVASIM_SPARSE_VIRAL_LOAD', 0)))
+
+    optdesc.event_queue = 'Set whether to schedule disease-state transitions in a calendar queue when people are infected, so each timestep only checks the transitions due that day -- faster for large populations, but dates must only be changed via People.infect()'
+    options.event_queue = bool(int(os.getenv('COVASIM_EVENT_QUEUE', 0)))
+
+    optdesc.state_index = 'Set whether to keep index sets of the people in each state that people leave (e.g. symptomatic, but not recovered), updated as states change, so counting and finding people in these states does not need to check everyone -- faster for large populations, but states must only be changed via people.set_state()'
+    options.state_index = bool(int(os.getenv('COVASIM_STATE_INDEX', 0)))
+
+    optdesc.immunity_sums = 'Set whether to calculate the population NAb and protection results from running sums updated as immunity changes -- faster for large populations, but results differ from the full calculation by floating-point rounding'
+    options.immunity_sums = bool(int(os.getenv('COVASIM_IMMUNITY_SUMS', 0)))
+
+    optdesc.retire_nabs = 'Set whether to stop updating the NAbs of people once they have decayed to a level that will not change again (until they are next boosted) -- faster for long simulations with waning, but NAbs must only be boosted via Covasim'
+    options.retire_nabs = bool(int(os.getenv('COVASIM_RETIRE_NABS', 0)))
+
+    optdesc.fast_prognoses = 'Set whether to determine the outcomes and dates of new infections in a single compiled pass -- faster when there are many infections, but random numbers are drawn in a different order, so results differ (statistically equivalent)'
+    options.fast_prognoses = bool(int(os.getenv('COVASIM_FAST_PROGNOSES', 0)))
+
+    optdesc.clip_in_place = 'Set whether clip_edges() removes edges in place, by moving the edges at the end of the layer into the gaps, so clipping and restoring edges only costs as much as the number of edges moved -- much faster for large layers, but the order of the edges changes, so results differ (statistically equivalent)'
+    options.clip_in_place = bool(int(os.getenv('COVASIM_CLIP_IN_PLACE', 0)))
+
+    optdesc.columnar_people = 'Set whether to store the arrays of People (ages, states, dates, etc.) as views into a single contiguous buffer -- makes copying, saving, and resizing people faster, but arrays that are replaced rather than modified in place are copied back into the buffer'
+    options.columnar_people = bool(int(os.getenv('COVASIM_COLUMNAR_PEOPLE', 0)))
+
+    optdesc.packed_states = 'Set whether to store the Boolean states of People (e.g. infectious) as bits -- one word of flags per person, plus a bitset per variant for the states by variant -- rather than as one byte per person each; uses several times less memory for states, and counts use popcount, but each access to a state goes through an array-like view, so states must be modified in place (e.g. people.infectious[inds] = True) rather than replaced'
+    options.packed_states = bool(int(os.getenv('COVASIM_PACKED_STATES', 0)))
+
+    optdesc.compact_days = 'Set whether to store the dates and durations of People as whole days in 16- or 32-bit integers (0 = off, as floats) -- uses two to four times less memory for them, and checking which dates are due is a single integer comparison; they are still read and written as floats, with NaN for undefined, but only whole days can be stored'
+    options.compact_days = int(os.getenv('COVASIM_COMPACT_DAYS', 0))
+
     return options, optdesc
 
 
@@ -95,6 +128,17 @@ def set_option(key=None, value=None, **kwargs):
         - precision:      the arithmetic to use in calculations
         - numba_parallel: whether to parallelize Numba functions
         - numba_cache:    whether to cache (precompile) Numba functions
+        - layer_index:    whether to use a per-person index of each layer's edges for transmission
+        - sparse_viral_load: whether to compute viral loads only for infectious people
+        - event_queue:    whether to schedule disease-state transitions in a calendar queue
+        - state_index:    whether to keep index sets of the people in states such as symptomatic
+        - immunity_sums:  whether to calculate population immunity results from running sums
+        - retire_nabs:    whether to stop updating NAbs once they will not change again
+        - fast_prognoses: whether to determine the outcomes of new infections in a single compiled pass
+        - clip_in_place:  whether clip_edges() removes and restores edges in place
+        - columnar_people: whether to store the arrays of People in a single buffer
+        - packed_states:  whether to store the Boolean states of People as bits
+        - compact_days:   whether to store the dates and durations of People as 16- or 32-bit integers
 
     **Examples**::
 
@@ -3,6 +3,7 @@ Defines the Sim class, Covasim's core class.
 '''
 
 #%% Imports
+import os
 import numpy as np
 import pandas as pd
 import sciris as sc
@@ -12,10 +13,12 @@ from . import base as cvb
 from . import defaults as cvd
 from . import parameters as cvpar
 from . import population as cvpop
+from . import people as cvppl
 from . import plotting as cvplt
 from . import interventions as cvi
 from . import immunity as cvimm
 from . import analysis as cva
+from .settings import options as cvo
 
 # Almost everything in this file is contained in the Sim class
 __all__ = ['Sim', 'diff_sims', 'demo', 'AlreadyRunError']
@@ -34,7 +37,7 @@ class Sim(cvb.BaseSim):
         datacols (list):   list of column names of the data to load
         label    (str):    the name of the simulation (useful to distinguish in batch runs)
         simfile  (str):    the filename for this simulation, if it's saved (default: creation date)
-        popfile  (str):    the filename to load/save the population for this simulation
+        popfile  (str):    the filename to load/save the population for this simulation; if a folder (e.g. ending in "/"), save/load the people as memory-mappable columns
         load_pop (bool):   whether to load the population from the named file
         save_pop (bool):   whether to save the population to the named file
         version  (str):    if supplied, use default parameters from this version of Covasim instead of the latest
@@ -351,7 +354,9 @@ class Sim(cvb.BaseSim):
         dictionaries (popdicts, file ending .pop by convention), or ready-to-go
         People objects (file ending .ppl by convention). Either object an also be
         supplied directly. Once a population file is loaded, it is removed from
-        the Sim object.
+        the Sim object. If the population file is a folder, it is assumed to have
+        been saved by people.save_columns(), and the people are memory-mapped
+        from it (see people.load_columns()).
 
         Args:
             popfile (str or obj): if a string, name of the file; otherwise, the popdict or People object to load
@@ -366,8 +371,12 @@ class Sim(cvb.BaseSim):
 
             # Load from disk or use directly
             if isinstance(popfile, str): # It's a string, assume it's a filename
-                filepath = sc.makefilepath(filename=popfile, **kwargs)
-                obj = cvm.load(filepath)
+                if os.path.isdir(popfile): # It's a folder, assume it was saved by people.save_columns() and memory-map it
+                    filepath = popfile
+                    obj = cvppl.People.load_columns(filepath)
+                else:
+                    filepath = sc.makefilepath(filename=popfile, **kwargs)
+                    obj = cvm.load(filepath)
                 if self['verbose']:
                     print(f'Loading population from {filepath}')
             else:
@@ -589,13 +598,16 @@ class Sim(cvb.BaseSim):
         people.update_states_post() # Check for state changes after interventions
 
         # Compute viral loads
-        frac_time = cvd.default_float(self['viral_dist']['frac_time'])
-        load_ratio = cvd.default_float(self['viral_dist']['load_ratio'])
-        high_cap = cvd.default_float(self['viral_dist']['high_cap'])
-        date_inf = people.date_infectious
-        date_rec = people.date_recovered
-        date_dead = people.date_dead
-        viral_load = cvu.compute_viral_load(t, date_inf, date_rec, date_dead, frac_time, load_ratio, high_cap)
+        if cvo.sparse_viral_load: # Only for people who are infectious
+            viral_load = people.update_viral_load()
+        else:
+            frac_time = cvd.default_float(self['viral_dist']['frac_time'])
+            load_ratio = cvd.default_float(self['viral_dist']['load_ratio'])
+            high_cap = cvd.default_float(self['viral_dist']['high_cap'])
+            date_inf = np.asarray(people.date_infectious) # Convert to arrays in case the days are stored as integers
+            date_rec = np.asarray(people.date_recovered)
+            date_dead = np.asarray(people.date_dead)
+            viral_load = cvu.compute_viral_load(t, date_inf, date_rec, date_dead, frac_time, load_ratio, high_cap)
 
         # Shorten useful parameters
         nv = self['n_variants'] # Shorten number of variants
@@ -608,9 +620,12 @@ class Sim(cvb.BaseSim):
 
         # Check nabs.
         if self['use_waning']:
-            has_nabs = cvu.true(people.peak_nab)
-            if len(has_nabs):
-                cvimm.update_nab(people, inds=has_nabs)
+            if cvo.retire_nabs:
+                cvimm.update_active_nabs(people)
+            else:
+                has_nabs = cvu.true(people.peak_nab)
+                if len(has_nabs):
+                    cvimm.update_nab(people, inds=has_nabs)
 
         # Iterate through n_variants to calculate infections
         for variant in range(nv):
@@ -627,23 +642,26 @@ class Sim(cvb.BaseSim):
                 rel_beta *= self['variant_pars'][variant_label]['rel_beta']
             beta = cvd.default_float(self['beta'] * rel_beta)
 
-            for lkey, layer in contacts.items():
-                p1 = layer['p1']
-                p2 = layer['p2']
-                betas = layer['beta']
-
-                # Compute relative transmission and susceptibility
-                inf_variant = people.infectious * (people.infectious_variant == variant) # TODO: move out of loop?
-                sus_imm = people.sus_imm[variant,:]
-                iso_factor  = cvd.default_float(self['iso_factor'][lkey])
-                quar_factor = cvd.default_float(self['quar_factor'][lkey])
-                beta_layer  = cvd.default_float(self['beta_layer'][lkey])
-                rel_trans, rel_sus = cvu.compute_trans_sus(prel_trans, prel_sus, inf_variant, sus, beta_layer, viral_load, symp, diag, quar, asymp_factor, iso_factor, quar_factor, sus_imm)
-
-                # Calculate actual transmission
-                for sources, targets in [[p1, p2], [p2, p1]]:  # Loop over the contact network from p1->p2 and p2->p1
-                    source_inds, target_inds = cvu.compute_infections(beta, sources, targets, betas, rel_trans, rel_sus)  # Calculate transmission!
-                    people.infect(inds=target_inds, hosp_max=hosp_max, icu_max=icu_max, source=source_inds, layer=lkey, variant=variant)  # Actually infect people
+            # Compute relative transmission and susceptibility and the resulting infections across all layers
+            if people._packed is not None: # The compiled calculation needs Boolean arrays, so unpack the states in a single pass
+                sus, symp, diag, quar = people._packed.unpack(['susceptible', 'symptomatic', 'diagnosed', 'quarantined'])
+            inf_variant = people.infectious * (people.infectious_variant == variant)
+            inf_inds = cvu.true(inf_variant)
+            sus_imm = people.sus_imm[variant,:] if people.allocated('sus_imm') else np.zeros(len(people), dtype=cvd.default_float) # No one has any immunity without waning
+            lkeys = list(contacts.keys())
+            indexed = [cvo.layer_index and not self['dynam_layer'].get(lkey, False) for lkey in lkeys] # Dynamic layers change too often to be worth indexing
+            layer_arrays = cvu.layer_lists(contacts, indexed=indexed, n=len(people))
+            beta_layers  = np.array([self['beta_layer'][lkey]  for lkey in lkeys], dtype=cvd.default_float)
+            iso_factors  = np.array([self['iso_factor'][lkey]  for lkey in lkeys], dtype=cvd.default_float)
+            quar_factors = np.array([self['quar_factor'][lkey] for lkey in lkeys], dtype=cvd.default_float)
+            source_inds, target_inds, layer_inds, pass_inds = cvu.compute_transmission(beta, *layer_arrays, beta_layers, iso_factors, quar_factors, prel_trans, prel_sus,
+                                                                                       viral_load, inf_variant, inf_inds, sus, symp, diag, quar, asymp_factor, sus_imm, *cvu.next_stream())
+
+            # Actually infect people, one layer and direction (p1->p2 and p2->p1) at a time
+            for l,lkey in enumerate(lkeys):
+                for direction in range(2):
+                    start, end = pass_inds[2*l+direction], pass_inds[2*l+direction+1]
+                    people.infect(inds=target_inds[start:end], hosp_max=hosp_max, icu_max=icu_max, source=source_inds[start:end], layer=lkey, variant=variant)
 
         # Update counts for this time step: stocks
         for key in cvd.result_stocks.keys():
@@ -659,11 +677,18 @@ class Sim(cvb.BaseSim):
             for variant in range(nv):
                 self.results['variant'][key][variant][t] += count[variant]
 
-        # Update nab and immunity for this time step
-        inds_alive = cvu.false(people.dead)
-        self.results['pop_nabs'][t]            = np.sum(people.nab[inds_alive[cvu.true(people.nab[inds_alive])]])/len(inds_alive)
-        self.results['pop_protection'][t]      = np.nanmean(people.sus_imm)
-        self.results['pop_symp_protection'][t] = np.nanmean(people.symp_imm)
+        # Update nab and immunity for this time step -- unless the arrays haven't been created, in which case no one has any, and the results stay at zero
+        if people.allocated('nab') or people.allocated('sus_imm'):
+            if cvo.immunity_sums:
+                pop_nabs, pop_protection, pop_symp_protection = cvimm.pop_immunity(people)
+                self.results['pop_nabs'][t]            = pop_nabs
+                self.results['pop_protection'][t]      = pop_protection
+                self.results['pop_symp_protection'][t] = pop_symp_protection
+            else:
+                inds_alive = cvu.false(people.dead)
+                self.results['pop_nabs'][t]            = np.sum(people.nab[inds_alive[cvu.true(people.nab[inds_alive])]])/len(inds_alive)
+                self.results['pop_protection'][t]      = np.nanmean(people.sus_imm)
+                self.results['pop_symp_protection'][t] = np.nanmean(people.symp_imm)
 
         # Apply analyzers -- same syntax as interventions
         for i,analyzer in enumerate(self['analyzers']):
@@ -933,8 +958,8 @@ class Sim(cvb.BaseSim):
         # Alternate (traditional) method -- count from the date of infection or outcome
         elif method in ['infectious', 'outcome']:
 
-            # Store a mapping from each source to their date
-            source_dates = {}
+            # Store a mapping from each source to their date (-1 if none)
+            source_dates = np.full(len(self.people), -1, dtype=np.int64)
 
             for t in self.tvec:
 
@@ -948,15 +973,13 @@ class Sim(cvb.BaseSim):
                 sources[t] = len(inds)
 
                 # Create the mapping from sources to dates
-                for ind in inds:
-                    source_dates[ind] = t
+                source_dates[inds] = t
 
-            # Targets are hard -- loop over the transmission tree
-            for transdict in self.people.infection_log:
-                source = transdict['source']
-                if source is not None and source in source_dates: # Skip seed infections and people with e.g. recovery after the end of the sim
-                    source_date = source_dates[source]
-                    targets[source_date] += 1
+            # Targets are hard -- count the infections caused by each source, on the date of the source
+            log = self.people.infection_log
+            log_dates = source_dates[log.source[log.source >= 0]] # Skip seed infections
+            log_dates = log_dates[log_dates >= 0] # Skip people with e.g. recovery after the end of the sim
+            np.add.at(targets, log_dates, 1)
 
                 # for ind in inds:
                 #     targets[t] += len(self.people.transtree.targets[ind])
@@ -992,28 +1015,22 @@ class Sim(cvb.BaseSim):
             gen_time (dict): the generation time results
         '''
 
-        intervals1 = np.zeros(len(self.people))
-        intervals2 = np.zeros(len(self.people))
-        pos1 = 0
-        pos2 = 0
         date_exposed = self.people.date_exposed
         date_symptomatic = self.people.date_symptomatic
 
-        for infection in self.people.infection_log:
-            if infection['source'] is not None:
-                source_ind = infection['source']
-                target_ind = infection['target']
-                intervals1[pos1] = date_exposed[target_ind] - date_exposed[source_ind]
-                pos1 += 1
-                if np.isfinite(date_symptomatic[source_ind]) and np.isfinite(date_symptomatic[target_ind]):
-                    intervals2[pos2] = date_symptomatic[target_ind] - date_symptomatic[source_ind]
-                    pos2 += 1
+        log = self.people.infection_log
+        has_source = log.source >= 0 # Skip seed infections
+        source_inds = log.source[has_source]
+        target_inds = log.target[has_source]
+        symp = np.isfinite(date_symptomatic[source_inds]) & np.isfinite(date_symptomatic[target_inds])
+        intervals1 = np.array(date_exposed[target_inds] - date_exposed[source_inds], dtype=np.float64)
+        intervals2 = np.array(date_symptomatic[target_inds[symp]] - date_symptomatic[source_inds[symp]], dtype=np.float64)
 
         self.results['gen_time'] = {
-                'true':         np.mean(intervals1[:pos1]),
-                'true_std':     np.std(intervals1[:pos1]),
-                'clinical':     np.mean(intervals2[:pos2]),
-                'clinical_std': np.std(intervals2[:pos2])}
+                'true':         np.mean(intervals1),
+                'true_std':     np.std(intervals1),
+                'clinical':     np.mean(intervals2),
+                'clinical_std': np.std(intervals2)}
         return self.results['gen_time']
 
 
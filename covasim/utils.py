@@ -8,6 +8,7 @@ at the heart of the integration loop.
 #%% Housekeeping
 
 import numba as nb # For faster computations
+import math # For lgamma
 import numpy as np # For numerics
 import random # Used only for resetting the seed
 import sciris as sc # For additional utilities
@@ -23,8 +24,11 @@ __all__ = []
 nbbool  = nb.bool_
 nbint   = cvd.nbint
 nbfloat = cvd.nbfloat
+nbintlist   = nb.types.ListType(nbint[:]) # Typed lists of per-layer edge arrays, used by compute_transmission()
+nbfloatlist = nb.types.ListType(nbfloat[:])
+int64list   = nb.types.ListType(nb.int64[:])
 
-# Specify whether to allow parallel Numba calculation -- 10% faster for safe and 20% faster for random, but the random number stream becomes nondeterministic for the latter
+# Specify whether to allow parallel Numba calculation -- 10% faster for safe and 20% faster for random; the latter uses a counter-based random number stream (see below) so results are reproducible, but differ from the serial stream
 safe_opts = [1, '1', 'safe']
 full_opts = [2, '2', 'full']
 safe_parallel = cvo.numba_parallel in safe_opts + full_opts
@@ -35,6 +39,117 @@ if cvo.numba_parallel not in [0, 1, 2, '0', '1', '2', 'none', 'safe', 'full']:
 cache = cvo.numba_cache # Turning this off can help switching parallelization options
 
 
+#%% Counter-based random numbers -- used instead of the Numba random number stream for multithreaded ("full") calculations
+
+# Philox4x32-10 constants (Salmon et al., 2011); uint64 is used throughout to avoid conversion to float
+_mask32 = np.uint64(0xFFFFFFFF)
+_shift  = np.uint64(32)
+_philox_m0 = np.uint64(0xD2511F53)
+_philox_m1 = np.uint64(0xCD9E8D57)
+_philox_w0 = np.uint64(0x9E3779B9)
+_philox_w1 = np.uint64(0xBB67AE85)
+
+# The state of the counter-based stream: the key is set by set_seed(), and the stream is incremented on each call
+rng_state = sc.objdict(key=np.uint64(0), stream=0)
+
+
+@nb.njit((nb.uint64, nb.uint64, nb.uint64, nb.uint64, nb.uint64, nb.uint64), cache=cache)
+def philox(k0, k1, c0, c1, c2, c3): # pragma: no cover
+    '''
+    The Philox4x32-10 counter-based random number generator: map a 64-bit key
+    (k0, k1) and a 128-bit counter (c0, c1, c2, c3), each given as 32-bit words,
+    to four random 32-bit words. Since each output depends only on the key and
+    counter, draws can be computed independently, in any order, in parallel.
+    '''
+    for r in range(10):
+        if r:
+            k0 = (k0 + _philox_w0) & _mask32
+            k1 = (k1 + _philox_w1) & _mask32
+        p0 = _philox_m0*c0
+        p1 = _philox_m1*c2
+        c0, c1, c2, c3 = ((p1 >> _shift) ^ c1 ^ k0), (p1 & _mask32), ((p0 >> _shift) ^ c3 ^ k1), (p0 & _mask32)
+    return c0, c1, c2, c3
+
+
+@nb.njit((nb.uint64, nb.uint64, nb.uint64, nb.uint64), cache=cache)
+def cb_random(key, stream, i, j): # pragma: no cover
+    '''
+    Counter-based uniform random number in [0, 1), with 53 bits of precision
+
+    Args:
+        key (uint64): the key, derived from the random seed
+        stream (uint64): the stream, e.g. one per function call (only the lower 32 bits are used)
+        i (uint64): the first counter, e.g. the index of the edge or person
+        j (uint64): the second counter, e.g. the index of the draw for that edge or person (only the lower 32 bits are used)
+    '''
+    w0, w1, w2, w3 = philox(key & _mask32, key >> _shift, i & _mask32, i >> _shift, j & _mask32, stream & _mask32)
+    return ((w0 >> np.uint64(5))*67108864.0 + (w1 >> np.uint64(6)))/9007199254740992.0
+
+
+@nb.njit((nb.float64, nb.uint64, nb.uint64, nb.uint64), cache=cache)
+def cb_poisson(rate, key, stream, i): # pragma: no cover
+    '''
+    Counter-based Poisson trial, using inversion for small rates and the PTRS
+    transformed rejection method (Hörmann, 1993) for large rates, as NumPy does
+
+    Args:
+        rate (float): the rate of the Poisson process
+        key, stream, i (uint64): see cb_random(); successive draws use j = 0, 1, 2, ...
+    '''
+    j = np.uint64(0)
+    one = np.uint64(1)
+    if rate <= 0:
+        return 0
+
+    # Small rates: inversion, using a single draw
+    if rate < 10:
+        u = cb_random(key, stream, i, j)
+        k = 0
+        p = np.exp(-rate)
+        cdf = p
+        while u > cdf and p > 0:
+            k += 1
+            p *= rate/k
+            cdf += p
+        return k
+
+    # Large rates: transformed rejection
+    slam = np.sqrt(rate)
+    loglam = np.log(rate)
+    b = 0.931 + 2.53*slam
+    a = -0.059 + 0.02483*b
+    invalpha = 1.1239 + 1.1328/(b - 3.4)
+    vr = 0.9277 - 3.6224/(b - 2)
+    while True:
+        U = cb_random(key, stream, i, j) - 0.5
+        V = cb_random(key, stream, i, j+one)
+        j += np.uint64(2)
+        us = 0.5 - np.abs(U)
+        k = int(np.floor((2*a/us + b)*U + rate + 0.43))
+        if us >= 0.07 and V <= vr:
+            return k
+        if k < 0 or (us < 0.013 and V > us):
+            continue
+        if np.log(V) + np.log(invalpha) - np.log(a/(us*us) + b) <= -rate + k*loglam - math.lgamma(k + 1):
+            return k
+
+
+def set_rng_key(seed=None):
+    ''' Set the key of the counter-based random number stream from a seed (or from entropy if None), and reset the stream '''
+    rng_state.key = np.random.SeedSequence(seed).generate_state(1, dtype=np.uint64)[0]
+    rng_state.stream = 0
+    return
+
+
+def next_stream():
+    ''' Get the key and the next stream of the counter-based random number stream, for a single function call '''
+    rng_state.stream += 1
+    return rng_state.key, np.uint64(rng_state.stream)
+
+
+set_rng_key() # Initialize from entropy, as with the other random number streams
+
+
 #%% The core Covasim functions -- compute the infections
 
 @nb.njit(             (nbint, nbfloat[:], nbfloat[:],     nbfloat[:], nbfloat,   nbfloat,    nbfloat), cache=cache, parallel=safe_parallel)
@@ -80,6 +195,51 @@ def compute_viral_load(t,     time_start, time_recovered, time_dead,  frac_time,
     return load
 
 
+@nb.njit(                (nbfloat[:], nbfloat[:],     nbfloat[:], nbfloat,   nbfloat), cache=cache)
+def compute_viral_switch(time_start, time_recovered, time_dead,  frac_time, high_cap): # pragma: no cover
+    '''
+    Calculate the day on which each person's viral load switches from high to low,
+    i.e. the first timestep t for which compute_viral_load() gives the low value.
+    Since this only depends on the dates, it can be calculated once, at the time
+    of infection; see People.update_viral_load().
+
+    Args:
+        time_start: (float[]) individuals' infectious date
+        time_recovered: (float[]) individuals' recovered date
+        time_dead: (float[]) individuals' death date
+        frac_time: (float) fraction of time in high load
+        high_cap: (float) cap on the number of days with high viral load
+
+    Returns:
+        switch (float[]): the switch day (NaN if the load is never high)
+    '''
+    n = len(time_start)
+    switch = np.full(n, np.nan, dtype=cvd.default_float)
+    for i in range(n):
+
+        # Same calculations (and precision) as compute_viral_load()
+        time_stop = time_dead[i] if not np.isnan(time_dead[i]) else time_recovered[i]
+        infect_days_total = time_stop - time_start[i]
+        if not infect_days_total >= 0: # Handle NaNs
+            continue
+        elif infect_days_total == 0: # Division by zero: the load is high only before the start
+            switch[i] = time_start[i]
+            continue
+        trans_point = frac_time
+        if frac_time*infect_days_total > high_cap:
+            trans_point = high_cap/infect_days_total
+
+        # Find the first day that is not early, starting from a guess just before it
+        t = int(np.floor(time_start[i] + trans_point*infect_days_total)) - 1
+        while (t - np.float64(time_start[i]))/infect_days_total >= trans_point:
+            t -= 1
+        while (t - np.float64(time_start[i]))/infect_days_total < trans_point:
+            t += 1
+        switch[i] = t
+
+    return switch
+
+
 @nb.njit(            (nbfloat[:], nbfloat[:], nbbool[:], nbbool[:], nbfloat,    nbfloat[:], nbbool[:], nbbool[:], nbbool[:], nbfloat,      nbfloat,    nbfloat,     nbfloat[:]), cache=cache, parallel=safe_parallel)
 def compute_trans_sus(rel_trans,  rel_sus,    inf,       sus,       beta_layer, viral_load, symp,      diag,      quar,      asymp_factor, iso_factor, quar_factor, immunity_factors): # pragma: no cover
     ''' Calculate relative transmissibility and susceptibility '''
@@ -91,7 +251,7 @@ def compute_trans_sus(rel_trans,  rel_sus,    inf,       sus,       beta_layer,
     return rel_trans, rel_sus
 
 
-@nb.njit(             (nbfloat,  nbint[:], nbint[:],  nbfloat[:],  nbfloat[:], nbfloat[:]), cache=cache, parallel=rand_parallel)
+@nb.njit(             (nbfloat,  nbint[:], nbint[:],  nbfloat[:],  nbfloat[:], nbfloat[:]), cache=cache)
 def compute_infections(beta,     sources,  targets,   layer_betas, rel_trans,  rel_sus): # pragma: no cover
     '''
     Compute who infects whom
@@ -114,6 +274,274 @@ def compute_infections(beta,     sources,  targets,   layer_betas, rel_trans,  r
     return source_inds, target_inds
 
 
+@nb.njit(cache=cache)
+def _grow(arr, capacity): # pragma: no cover
+    ''' Copy an array into a new, larger array '''
+    out = np.empty(capacity, dtype=arr.dtype)
+    out[:len(arr)] = arr
+    return out
+
+
+@nb.njit(cache=cache)
+def _edge_beta(beta, source, target, edge_beta, beta_layer, iso_factor, quar_factor, rel_trans, rel_sus, viral_load, sus, symp, diag, quar, asymp_factor, immunity_factors): # pragma: no cover
+    '''
+    Calculate the transmission probability along a single edge from an infectious
+    source (the caller must check this, which is much faster to do inline), or 0
+    if the target isn't susceptible
+    '''
+    zero = cvd.default_float(0.0)
+    one  = cvd.default_float(1.0) # Ensure 1-immunity is calculated at the same precision as in compute_trans_sus()
+    source_trans = rel_trans[source] # Same order of operations as compute_trans_sus()
+    if quar[source]:
+        source_trans *= quar_factor
+    if not symp[source]:
+        source_trans *= asymp_factor
+    if diag[source]:
+        source_trans *= iso_factor
+    source_trans *= beta_layer
+    source_trans *= viral_load[source]
+    if source_trans == 0 or not sus[target]:
+        return zero
+    target_sus = rel_sus[target]
+    if quar[target]:
+        target_sus *= quar_factor
+    target_sus *= (one - immunity_factors[target])
+    return beta * edge_beta * source_trans * target_sus # Same order of operations as compute_infections()
+
+
+@nb.njit(cache=cache)
+def _transmit(beta, sources, targets, betas, edge_inds, use_inds, beta_layer, iso_factor, quar_factor, rel_trans, rel_sus, viral_load, inf, sus, symp, diag, quar, asymp_factor, immunity_factors, layer, source_inds, target_inds, layer_inds, count, start): # pragma: no cover
+    '''
+    Compute the infections along one direction of one layer, starting from edge
+    "start"; see compute_transmission(). If use_inds is true, only the edges in
+    edge_inds are checked; otherwise, all edges are. If the output arrays fill up,
+    return early (before the random draw) with the position to resume from, so
+    the caller can grow them -- this keeps array reallocation out of the hot loop.
+    '''
+    n_edges = len(edge_inds) if use_inds else len(sources)
+    for i in range(start, n_edges):
+        e = edge_inds[i] if use_inds else i
+        source = sources[e]
+        if not inf[source]:
+            continue
+        target = targets[e]
+        edge_beta = _edge_beta(beta, source, target, betas[e], beta_layer, iso_factor, quar_factor, rel_trans, rel_sus, viral_load, sus, symp, diag, quar, asymp_factor, immunity_factors)
+        if edge_beta == 0:
+            continue
+        if count == len(source_inds): # Out of space, so return and resume from this edge
+            return count, i
+        if np.random.random() < edge_beta: # Compute the actual infection!
+            source_inds[count] = source
+            target_inds[count] = target
+            layer_inds[count]  = layer
+            count += 1
+    return count, n_edges
+
+
+@nb.njit(cache=cache, parallel=rand_parallel)
+def _transmit_parallel(beta, sources, targets, betas, edge_inds, use_inds, beta_layer, iso_factor, quar_factor, rel_trans, rel_sus, viral_load, inf, sus, symp, diag, quar, asymp_factor, immunity_factors, key, stream, pass_ind): # pragma: no cover
+    '''
+    Multithreaded version of _transmit(), using counter-based random numbers
+    keyed on the edge index, so the results do not depend on the number of
+    threads. Returns the indices of the edges along which transmission occurred,
+    in edge order.
+    '''
+    n_edges = len(edge_inds) if use_inds else len(sources)
+    transmitted = np.zeros(n_edges, dtype=np.bool_)
+    for i in nb.prange(n_edges):
+        e = np.int64(edge_inds[i]) if use_inds else np.int64(i)
+        if not inf[sources[e]]:
+            continue
+        edge_beta = _edge_beta(beta, sources[e], targets[e], betas[e], beta_layer, iso_factor, quar_factor, rel_trans, rel_sus, viral_load, sus, symp, diag, quar, asymp_factor, immunity_factors)
+        if edge_beta != 0:
+            transmitted[i] = cb_random(key, stream, np.uint64(e), np.uint64(pass_ind)) < edge_beta
+    inds = transmitted.nonzero()[0]
+    if use_inds:
+        inds = edge_inds[inds].astype(np.int64)
+    return inds
+
+
+@nb.njit(cache=cache)
+def _index_edges(inds, indptr, edges): # pragma: no cover
+    ''' Find the edges of the specified people from a CSR index, sorted into edge order '''
+    n = 0
+    for i in inds:
+        n += indptr[i+1] - indptr[i]
+    out = np.empty(n, dtype=edges.dtype)
+    n = 0
+    for i in inds:
+        for j in range(indptr[i], indptr[i+1]):
+            out[n] = edges[j]
+            n += 1
+    out.sort()
+    return out
+
+
+@nb.njit(                (nbfloat, nbintlist, nbintlist, nbfloatlist, nbbool[:], int64list, nbintlist, int64list, nbintlist, nbfloat[:],  nbfloat[:],  nbfloat[:],   nbfloat[:], nbfloat[:], nbfloat[:], nbbool[:], nb.int64[:], nbbool[:], nbbool[:], nbbool[:], nbbool[:], nbfloat,      nbfloat[:],       nb.uint64, nb.uint64), cache=cache)
+def compute_transmission(beta,    p1s,       p2s,       layer_betas, use_index, p1_ptrs,   p1_edges,  p2_ptrs,   p2_edges,  beta_layers, iso_factors, quar_factors, rel_trans,  rel_sus,    viral_load, inf,       inf_inds,    sus,       symp,      diag,      quar,      asymp_factor, immunity_factors, key,       stream): # pragma: no cover
+    '''
+    Compute who infects whom across all layers in a single pass
+
+    Equivalent to calling compute_trans_sus() followed by compute_infections()
+    in both directions for each layer in turn, but without allocating the
+    population-sized transmissibility and susceptibility arrays for each layer:
+    these are instead calculated on the fly for each edge, skipping edges whose
+    source is not infectious or whose target is not susceptible. The random
+    draws and floating point operations are performed in the same order as in
+    the layer-by-layer version, so results are identical.
+
+    For layers with a CSR index (see Layer.get_index()), only the edges of the
+    infectious people are visited, so the cost scales with the number of
+    contacts of infectious people rather than with the total number of edges.
+
+    Susceptibility is updated at the end of each layer (but not between the two
+    directions of a layer) to reflect the people infected in that layer.
+
+    Args:
+        beta (float): overall transmissibility
+        p1s (list): the p1 array for each layer
+        p2s (list): the p2 array for each layer
+        layer_betas (list): the per-edge beta array for each layer
+        use_index (bool[]): whether to use the CSR index for each layer
+        p1_ptrs, p1_edges, p2_ptrs, p2_edges (lists): the CSR index of each layer (empty arrays if not used)
+        beta_layers (float[]): the beta for each layer
+        iso_factors (float[]): the isolation factor for each layer
+        quar_factors (float[]): the quarantine factor for each layer
+        inf_inds (int[]): the indices of the infectious people (only used for indexed layers)
+        rel_trans etc. (arrays): the people arrays used by compute_trans_sus()
+        key, stream (uint64): the counter-based random number stream to use if numba_parallel is "full" (see next_stream())
+
+    Returns:
+        source_inds (int[]): the source of each transmission
+        target_inds (int[]): the target of each transmission
+        layer_inds (int[]): the index of the layer of each transmission
+        pass_inds (int[]): offsets into the above arrays for each layer and direction (p1->p2 then p2->p1), of length 2*n_layers+1
+    '''
+    sus = sus.copy() # Working copy of susceptibility, updated after each layer
+    n_layers = len(p1s)
+    capacity = 1024
+    source_inds = np.empty(capacity, dtype=cvd.default_int)
+    target_inds = np.empty(capacity, dtype=cvd.default_int)
+    layer_inds  = np.empty(capacity, dtype=np.int32)
+    pass_inds   = np.zeros(2*n_layers+1, dtype=np.int64)
+    count = 0
+
+    for l in range(n_layers):
+        layer_start = count
+        for direction in range(2):
+            if direction == 0:
+                sources, targets, indptr, edges = p1s[l], p2s[l], p1_ptrs[l], p1_edges[l]
+            else:
+                sources, targets, indptr, edges = p2s[l], p1s[l], p2_ptrs[l], p2_edges[l]
+            if use_index[l]:
+                edge_inds = _index_edges(inf_inds, indptr, edges)
+                n_edges = len(edge_inds)
+            else:
+                edge_inds = edges # Not used
+                n_edges = len(sources)
+            if rand_parallel: # Multithreaded, with counter-based random numbers
+                hits = _transmit_parallel(beta, sources, targets, layer_betas[l], edge_inds, use_index[l], beta_layers[l], iso_factors[l], quar_factors[l], rel_trans, rel_sus, viral_load,
+                                          inf, sus, symp, diag, quar, asymp_factor, immunity_factors, key, stream, 2*l+direction)
+                if count + len(hits) > capacity:
+                    capacity = max(2*capacity, count + len(hits))
+                    source_inds = _grow(source_inds, capacity)
+                    target_inds = _grow(target_inds, capacity)
+                    layer_inds  = _grow(layer_inds,  capacity)
+                for e in hits:
+                    source_inds[count] = sources[e]
+                    target_inds[count] = targets[e]
+                    layer_inds[count]  = l
+                    count += 1
+                n_edges = 0 # Skip the serial calculation
+            i = 0
+            while i < n_edges:
+                count, i = _transmit(beta, sources, targets, layer_betas[l], edge_inds, use_index[l], beta_layers[l], iso_factors[l], quar_factors[l], rel_trans, rel_sus, viral_load,
+                                     inf, sus, symp, diag, quar, asymp_factor, immunity_factors, l, source_inds, target_inds, layer_inds, count, i)
+                if count == capacity: # Grow the output arrays
+                    capacity *= 2
+                    source_inds = _grow(source_inds, capacity)
+                    target_inds = _grow(target_inds, capacity)
+                    layer_inds  = _grow(layer_inds,  capacity)
+            pass_inds[2*l+direction+1] = count
+
+        # Anyone infected in this layer is no longer susceptible in subsequent layers
+        for i in range(layer_start, count):
+            sus[target_inds[i]] = False
+
+    return source_inds[:count], target_inds[:count], layer_inds[:count], pass_inds
+
+
+def layer_lists(contacts, indexed=None, n=None):
+    '''
+    Collect the arrays of each layer into the typed lists used by compute_transmission()
+
+    Args:
+        contacts (Contacts): the layers
+        indexed (list): whether to use the CSR index for each layer (default: none)
+        n (int): the number of people, passed to Layer.get_index()
+
+    Returns:
+        A tuple of the p1s, p2s, betas, use_index, p1_ptrs, p1_edges, p2_ptrs, and p2_edges arguments to compute_transmission()
+    '''
+    if indexed is None:
+        indexed = [False]*len(contacts)
+    use_index = np.array(indexed, dtype=bool)
+    p1s      = nb.typed.List.empty_list(nbint[:])
+    p2s      = nb.typed.List.empty_list(nbint[:])
+    betas    = nb.typed.List.empty_list(nbfloat[:])
+    p1_ptrs  = nb.typed.List.empty_list(nb.int64[:])
+    p1_edges = nb.typed.List.empty_list(nbint[:])
+    p2_ptrs  = nb.typed.List.empty_list(nb.int64[:])
+    p2_edges = nb.typed.List.empty_list(nbint[:])
+    no_ptrs  = np.zeros(0, dtype=np.int64)
+    no_edges = np.zeros(0, dtype=cvd.default_int)
+    for layer,use in zip(contacts.values(), use_index):
+        p1s.append(layer['p1'])
+        p2s.append(layer['p2'])
+        betas.append(layer['beta'])
+        if use:
+            index = layer.get_index(n=n)
+            p1_ptrs.append(index.p1_ptr)
+            p1_edges.append(index.p1_edges)
+            p2_ptrs.append(index.p2_ptr)
+            p2_edges.append(index.p2_edges)
+        else:
+            p1_ptrs.append(no_ptrs)
+            p1_edges.append(no_edges)
+            p2_ptrs.append(no_ptrs)
+            p2_edges.append(no_edges)
+    return p1s, p2s, betas, use_index, p1_ptrs, p1_edges, p2_ptrs, p2_edges
+
+
+@nb.njit((nbint[:], nb.int64), cache=cache)
+def build_csr(keys, n): # pragma: no cover
+    '''
+    Build a compressed sparse row (CSR) index of edges keyed by person, using a
+    counting sort. For each person i, edges[indptr[i]:indptr[i+1]] are the
+    indices of the edges where keys == i, in ascending order.
+
+    Args:
+        keys (int[]): the person for each edge, e.g. layer['p1']
+        n (int): the number of people; all keys must be less than this
+
+    Returns:
+        indptr (int[]): the start of each person's edges, of length n+1
+        edges (int[]): the edge indices, grouped by person
+    '''
+    indptr = np.zeros(n+1, dtype=np.int64)
+    for k in keys:
+        indptr[k+1] += 1
+    for i in range(n):
+        indptr[i+1] += indptr[i]
+    pos = indptr[:-1].copy()
+    edges = np.empty(len(keys), dtype=keys.dtype)
+    for e in range(len(keys)):
+        k = keys[e]
+        edges[pos[k]] = e
+        pos[k] += 1
+    return indptr, edges
+
+
 @nb.njit((nbint[:], nbint[:], nb.int64[:]), cache=cache)
 def find_contacts(p1, p2, inds): # pragma: no cover
     """
@@ -133,6 +561,460 @@ def find_contacts(p1, p2, inds): # pragma: no cover
     return pairing_partners
 
 
+@nb.njit(cache=cache)
+def find_indexed_contacts(p1, p2, p1_ptr, p1_edges, p2_ptr, p2_edges, inds): # pragma: no cover
+    """
+    Numba for Layer.find_contacts() using the layer's CSR index (see Layer.get_index()),
+    so only the edges of the specified people are visited. Returns an array of
+    their contacts, which may include duplicates; people not in the index are skipped.
+    """
+    n = len(p1_ptr) - 1
+    count = 0
+    for i in inds:
+        if i >= 0 and i < n:
+            count += p1_ptr[i+1] - p1_ptr[i] + p2_ptr[i+1] - p2_ptr[i]
+    partners = np.empty(count, dtype=p1.dtype)
+    count = 0
+    for i in inds:
+        if i >= 0 and i < n:
+            for j in range(p1_ptr[i], p1_ptr[i+1]):
+                partners[count] = p2[p1_edges[j]]
+                count += 1
+            for j in range(p2_ptr[i], p2_ptr[i+1]):
+                partners[count] = p1[p2_edges[j]]
+                count += 1
+    return partners
+
+
+@nb.njit((nbfloat, nb.int64), cache=cache)
+def np_cluster_sizes(rate, n): # pragma: no cover
+    ''' Version of cluster_sizes() using the Numba random number stream '''
+    sizes = np.empty(max(16, int(2*n/max(rate, 1.0))), dtype=np.int64)
+    count = 0
+    remaining = n
+    while remaining > 0:
+        if count == len(sizes):
+            sizes = _grow(sizes, 2*count)
+        size = min(np.random.poisson(rate), remaining)
+        sizes[count] = size
+        remaining -= size
+        count += 1
+    return sizes[:count]
+
+
+@nb.njit((nb.float64, nb.int64, nb.uint64, nb.uint64), cache=cache)
+def cb_cluster_sizes(rate, n, key, stream): # pragma: no cover
+    ''' Counter-based version of cluster_sizes(), with each cluster using the next stream, as poisson() does '''
+    sizes = np.empty(max(16, int(2*n/max(rate, 1.0))), dtype=np.int64)
+    count = 0
+    remaining = n
+    while remaining > 0:
+        if count == len(sizes):
+            sizes = _grow(sizes, 2*count)
+        size = min(cb_poisson(rate, key, stream + np.uint64(count), np.uint64(0)), remaining)
+        sizes[count] = size
+        remaining -= size
+        count += 1
+    return sizes[:count]
+
+
+def cluster_sizes(rate, n):
+    '''
+    Draw Poisson cluster sizes one at a time until n people have been assigned
+    to clusters, truncating the last cluster. Clusters of size 0 are kept, so
+    the random numbers used are the same as for a loop over poisson(), including
+    which stream is used (see poisson()).
+    '''
+    if not rand_parallel:
+        return np_cluster_sizes(rate, n)
+    key, stream = next_stream()
+    sizes = cb_cluster_sizes(rate, n, key, stream)
+    rng_state.stream += len(sizes) - 1 # One stream per cluster has been used
+    return sizes
+
+
+@nb.njit(cache=cache)
+def _set_table_size(n): # pragma: no cover
+    '''
+    The size of the hash table of a Python set after adding n consecutive integers
+    to an empty set, following CPython's resizing rule; only used by make_cliques()
+    to reproduce the set order of previous versions
+    '''
+    size = 8
+    fill = (3*(size - 1) + 4)//5 # The fill that triggers a resize, i.e. fill*5 >= mask*3
+    while n >= fill:
+        used = 4*fill if fill <= 50000 else 2*fill
+        while size <= used:
+            size *= 2
+        fill = (3*(size - 1) + 4)//5
+    return size
+
+
+@nb.njit(cache=cache)
+def make_cliques(sizes, p1, p2, set_order=True): # pragma: no cover
+    '''
+    Fill preallocated arrays with the edges of clusters of consecutive people,
+    of the given sizes, connecting each person to everyone after them in their
+    cluster.
+
+    By default, the partners of each person are listed in the order of iterating
+    over a Python set of them, as make_microstructured_contacts() used to do, so
+    that populations (and results) are unchanged from previous versions. This
+    order depends on the size of the set's hash table (see _set_table_size()),
+    and is checked against real sets in the tests. With set_order=False, they
+    are listed in ascending order instead.
+
+    Args:
+        sizes (int[]): the size of each cluster
+        p1, p2 (int[]): the arrays to fill, of length sum(sizes*(sizes-1)//2)
+        set_order (bool): whether to list partners in the legacy set order, rather than ascending order
+    '''
+    e = 0
+    start = 0
+    for size in sizes:
+        end = start + size
+        for i in range(start, end-1):
+            wrap = end
+            if set_order: # Partners past the end of the hash table wrap around to the start, so come first
+                table = _set_table_size(end - 1 - i)
+                wrap = min(((i + 1)//table + 1)*table, end)
+                for j in range(wrap, end):
+                    p1[e] = i
+                    p2[e] = j
+                    e += 1
+            for j in range(i+1, wrap):
+                p1[e] = i
+                p2[e] = j
+                e += 1
+        start = end
+    return
+
+
+@nb.njit(               (nbbool[:], nbbool[:],  nbfloat[:],     nbfloat[:],        nbfloat[:], nbfloat[:], nb.int64, nb.int64), cache=cache)
+def immunity_groups(sus,       vaccinated, date_recovered, recovered_variant, nab,        cross_imm,  t,        variant): # pragma: no cover
+    '''
+    Numba for immunity.check_immunity(): find, in a single pass, the susceptible
+    people whose immunity to the given variant comes from vaccination (and no
+    prior infection) or from a prior infection, and scale the NAbs of the latter
+    by the cross-immunity between their prior variant and this one.
+
+    Only the effective NAb levels are computed here: converting them to efficacy
+    is left to immunity.nab_to_efficacy(), since the compiled log() and exp() do
+    not always agree with NumPy's in the last bit, and results would change.
+
+    Args:
+        cross_imm (float[]): the row of the immunity matrix for this variant
+
+    Returns:
+        vacc (int[]): susceptible people who have been vaccinated but not previously infected
+        inf (int[]): susceptible people who have recovered from a previous infection
+        inf_nab (float[]): the NAb levels of the latter, scaled by cross-immunity
+    '''
+    n = len(sus)
+    vacc = np.empty(n, dtype=np.int64)
+    inf = np.empty(n, dtype=np.int64)
+    inf_nab = np.empty(n, dtype=nab.dtype)
+    n_vacc = 0
+    n_inf = 0
+    for i in range(n):
+        if sus[i]:
+            if t >= date_recovered[i]: # False if they have not recovered (NaN)
+                inf[n_inf] = i
+                inf_nab[n_inf] = nab[i] * cross_imm[np.int64(recovered_variant[i])]
+                n_inf += 1
+            elif vaccinated[i]:
+                vacc[n_vacc] = i
+                n_vacc += 1
+    return vacc[:n_vacc], inf[:n_inf], inf_nab[:n_inf]
+
+
+@nb.njit(cache=cache)
+def update_nab(t, inds, nab, peak_nab, date_exposed, date_vaccinated, nab_kin, kin_max, kin_maxabs): # pragma: no cover
+    '''
+    Numba for immunity.update_nab(): step the NAb levels of the specified people
+    forward in time, in place, with the same arithmetic as the array version.
+
+    Also flags people who are dormant, i.e. for whom this and every future update
+    leaves their NAbs unchanged, because their NAbs have decayed to zero or the
+    remaining decrements are too small to change them. This requires kin_max and
+    kin_maxabs, the maximum and maximum absolute values of nab_kin after each day
+    (see immunity.nab_kin_bounds()); if these are empty, no one is flagged.
+
+    Returns:
+        dormant (bool[]): for each person, whether their NAbs will not change until they are next boosted
+    '''
+    n = len(inds)
+    dormant = np.zeros(n, dtype=np.bool_)
+    check = len(kin_max) > 0
+    for j in range(n):
+        i = inds[j]
+        de = date_exposed[i]
+        dv = date_vaccinated[i]
+        date = dv if np.isnan(de) or de < dv else de # Equivalent to np.fmax()
+        t_since_boost = t - cvd.default_int(date)
+        kin = nab_kin[t_since_boost]
+        old = nab[i]
+        nab[i] += kin*peak_nab[i]
+        if nab[i] < 0: # Make sure nabs don't drop below 0
+            nab[i] = 0
+        if nab[i] > peak_nab[i]: # Make sure nabs don't exceed peak_nab
+            nab[i] = peak_nab[i]
+        if check and t_since_boost >= 0 and nab[i] == old and kin <= 0 and kin_max[t_since_boost] <= 0:
+            dormant[j] = nab[i] == 0 or kin_maxabs[t_since_boost] <= -kin
+    return dormant
+
+
+# Durations used by compute_prognoses(), in the order of the rows returned by prognosis_pars()
+prognosis_keys = ['exp2inf', 'inf2sym', 'sym2sev', 'sev2crit', 'asym2rec', 'mild2rec', 'sev2rec', 'crit2rec', 'crit2die']
+
+
+def prognosis_pars(durpars):
+    '''
+    Convert the duration distributions in pars['dur'] into the form used by
+    compute_prognoses(): for each duration, a code for the type of distribution,
+    and the two parameters of the underlying normal distribution (or the bounds
+    of a uniform distribution). Returns None if any distribution (e.g. Poisson)
+    cannot be drawn from a standard normal sample.
+
+    Returns:
+        codes (int[]): type of each distribution; see compute_prognoses() for the codes
+        pars (float[][]): the two parameters of each distribution
+    '''
+    n = len(prognosis_keys)
+    codes = np.zeros(n, dtype=np.int64)
+    pars = np.zeros((n, 2), dtype=np.float64)
+    for k,key in enumerate(prognosis_keys):
+        dur = durpars[key]
+        dist, par1, par2 = dur['dist'], dur['par1'], dur['par2']
+        if   dist in ['norm', 'normal']: code = 0
+        elif dist == 'normal_pos':       code = 1
+        elif dist == 'normal_int':       code = 2
+        elif dist in ['unif', 'uniform']: code = 5
+        elif dist in ['lognorm', 'lognormal', 'lognorm_int', 'lognormal_int']:
+            if par1 > 0: # As in sample()
+                code = 4 if '_int' in dist else 3
+                par1, par2 = np.log(par1**2 / np.sqrt(par2**2 + par1**2)), np.sqrt(np.log(par2**2/par1**2 + 1))
+            else:
+                code = 6
+        else:
+            return None
+        codes[k] = code
+        pars[k,:] = [par1, par2]
+    return codes, pars
+
+
+@nb.njit(cache=cache)
+def _draw_duration(code, par1, par2, z): # pragma: no cover
+    ''' Transform a standard normal sample into a duration; see prognosis_pars() '''
+    if code == 0:
+        return par1 + par2*z # Normal
+    elif code == 1:
+        return abs(par1 + par2*z) # Positive normal
+    elif code == 2:
+        return np.round(abs(par1 + par2*z)) # Integer normal
+    elif code == 3:
+        return np.exp(par1 + par2*z) # Lognormal
+    elif code == 4:
+        return np.round(np.exp(par1 + par2*z)) # Integer lognormal
+    elif code == 5:
+        return par1 + (par2 - par1)*0.5*(1 + math.erf(z/np.sqrt(2))) # Uniform, via the normal CDF
+    else:
+        return 0.0 # Lognormal with zero mean
+
+
+@nb.njit(cache=cache)
+def compute_prognoses(t, inds, codes, pars, z, u, symp_prob, severe_prob, crit_prob, death_prob, symp_imm, sev_imm, rel_symp, rel_severe, rel_crit, rel_death,
+                      dur_exp2inf, dur_inf2sym, dur_sym2sev, dur_sev2crit, dur_disease, date_infectious, date_symptomatic, date_severe, date_critical, date_recovered, date_dead): # pragma: no cover
+    '''
+    Numba for People.infect(): determine the outcome of each new infection and
+    write all of their durations and dates in a single pass.
+
+    The durations are drawn from the standard normal samples z (5 per person;
+    the first for the latent period, and each subsequent one for the next stage
+    the person reaches), and the outcomes from the uniform samples u (4 per person:
+    symptomatic, severe, critical, and death). The distributions are given by
+    codes and pars (see prognosis_pars()): 0 = normal, 1 = positive normal, 2 = integer
+    normal, 3 = lognormal, 4 = integer lognormal, 5 = uniform, 6 = zero.
+
+    Returns:
+        outcomes (int8[]): for each person, 0 = asymptomatic, 1 = mild, 2 = severe, 3 = critical, 4 = dead
+    '''
+    n = len(inds)
+    outcomes = np.zeros(n, dtype=np.int8)
+    for j in range(n):
+        i = inds[j]
+        dur_exp2inf[i] = _draw_duration(codes[0], pars[0,0], pars[0,1], z[0,j])
+        date_infectious[i] = dur_exp2inf[i] + t
+        date_symptomatic[i] = np.nan
+        date_severe[i] = np.nan
+        date_critical[i] = np.nan
+
+        # Asymptomatic
+        if not u[0,j] < rel_symp*symp_prob[i]*(1-symp_imm[i]):
+            dur = _draw_duration(codes[4], pars[4,0], pars[4,1], z[1,j])
+            date_recovered[i] = date_infectious[i] + dur
+            dur_disease[i] = dur_exp2inf[i] + dur
+            continue
+
+        # Mild
+        dur_inf2sym[i] = _draw_duration(codes[1], pars[1,0], pars[1,1], z[1,j])
+        date_symptomatic[i] = date_infectious[i] + dur_inf2sym[i]
+        if not u[1,j] < rel_severe*severe_prob[i]*(1-sev_imm[i]):
+            outcomes[j] = 1
+            dur = _draw_duration(codes[5], pars[5,0], pars[5,1], z[2,j])
+            date_recovered[i] = date_symptomatic[i] + dur
+            dur_disease[i] = dur_exp2inf[i] + dur_inf2sym[i] + dur
+            continue
+
+        # Severe
+        dur_sym2sev[i] = _draw_duration(codes[2], pars[2,0], pars[2,1], z[2,j])
+        date_severe[i] = date_symptomatic[i] + dur_sym2sev[i]
+        if not u[2,j] < rel_crit*crit_prob[i]:
+            outcomes[j] = 2
+            dur = _draw_duration(codes[6], pars[6,0], pars[6,1], z[3,j])
+            date_recovered[i] = date_severe[i] + dur
+            dur_disease[i] = dur_exp2inf[i] + dur_inf2sym[i] + dur_sym2sev[i] + dur
+            continue
+
+        # Critical, then either recover or die
+        dur_sev2crit[i] = _draw_duration(codes[3], pars[3,0], pars[3,1], z[3,j])
+        date_critical[i] = date_severe[i] + dur_sev2crit[i]
+        if not u[3,j] < rel_death*death_prob[i]:
+            outcomes[j] = 3
+            dur = _draw_duration(codes[7], pars[7,0], pars[7,1], z[4,j])
+            date_recovered[i] = date_critical[i] + dur
+        else:
+            outcomes[j] = 4
+            dur = _draw_duration(codes[8], pars[8,0], pars[8,1], z[4,j])
+            date_dead[i] = date_critical[i] + dur
+            date_recovered[i] = np.nan
+        dur_disease[i] = dur_exp2inf[i] + dur_inf2sym[i] + dur_sym2sev[i] + dur_sev2crit[i] + dur
+    return outcomes
+
+
+
+#%% Bit-packed states -- used instead of Boolean arrays if cv.options.packed_states is set
+
+# Constants for counting bits in 64-bit words; uint64 is used throughout to avoid conversion to float
+_m1  = np.uint64(0x5555555555555555)
+_m2  = np.uint64(0x3333333333333333)
+_m4  = np.uint64(0x0F0F0F0F0F0F0F0F)
+_h01 = np.uint64(0x0101010101010101)
+_one = np.uint64(1)
+_six = np.uint64(6)
+_w63 = np.uint64(63)
+_b2  = np.uint64(2)
+_b4  = np.uint64(4)
+_b56 = np.uint64(56)
+
+
+@nb.njit(cache=cache)
+def get_bits(words, flag, inds): # pragma: no cover
+    ''' Whether the flag is set in the state words of the given people '''
+    out = np.empty(len(inds), dtype=np.bool_)
+    for k in range(len(inds)):
+        out[k] = (words[inds[k]] & flag) != 0
+    return out
+
+
+@nb.njit(cache=cache)
+def set_bits(words, flag, inds, values): # pragma: no cover
+    ''' Set or clear the flag in the state words of the given people, in place; values is broadcast if it has length 1 '''
+    scalar = len(values) == 1
+    for k in range(len(inds)):
+        i = inds[k]
+        if values[0 if scalar else k]:
+            words[i] = words[i] | flag
+        else:
+            words[i] = words[i] & ~flag
+    return
+
+
+@nb.njit(cache=cache)
+def unpack_bits(words, flags): # pragma: no cover
+    ''' Unpack several flags from the state words into Boolean arrays, in a single pass '''
+    n = len(words)
+    out = np.empty((len(flags), n), dtype=np.bool_)
+    for i in range(n):
+        word = words[i]
+        for f in range(len(flags)):
+            out[f,i] = (word & flags[f]) != 0
+    return out
+
+
+@nb.njit(cache=cache)
+def count_bits(words, flag): # pragma: no cover
+    ''' Count the people whose state words have the flag set '''
+    count = 0
+    for i in range(len(words)):
+        if words[i] & flag:
+            count += 1
+    return count
+
+
+@nb.njit(cache=cache)
+def match_bits(words, mask, value): # pragma: no cover
+    '''
+    Find the people whose state words match the value on the bits in the mask,
+    e.g. symptomatic but neither diagnosed nor quarantined, in a single pass
+    '''
+    n = len(words)
+    inds = np.empty(n, dtype=np.int64)
+    count = 0
+    for i in range(n):
+        if (words[i] & mask) == value:
+            inds[count] = i
+            count += 1
+    return inds[:count]
+
+
+@nb.njit(cache=cache)
+def get_bitset(bits, inds): # pragma: no cover
+    ''' Whether the given people are in a bitset, stored as 64-bit words with one bit per person '''
+    out = np.empty(len(inds), dtype=np.bool_)
+    for k in range(len(inds)):
+        i = np.uint64(inds[k])
+        out[k] = ((bits[i >> _six] >> (i & _w63)) & _one) != 0
+    return out
+
+
+@nb.njit(cache=cache)
+def set_bitset(bits, inds, values): # pragma: no cover
+    ''' Add or remove the given people from a bitset, in place; values is broadcast if it has length 1 '''
+    scalar = len(values) == 1
+    for k in range(len(inds)):
+        i = np.uint64(inds[k])
+        w = i >> _six
+        bit = _one << (i & _w63)
+        if values[0 if scalar else k]:
+            bits[w] = bits[w] | bit
+        else:
+            bits[w] = bits[w] & ~bit
+    return
+
+
+@nb.njit(cache=cache)
+def unpack_bitset(bits, n): # pragma: no cover
+    ''' Unpack a bitset into a Boolean array of n people '''
+    out = np.empty(n, dtype=np.bool_)
+    for i in range(n):
+        j = np.uint64(i)
+        out[i] = ((bits[j >> _six] >> (j & _w63)) & _one) != 0
+    return out
+
+
+@nb.njit(cache=cache)
+def popcount(bits): # pragma: no cover
+    ''' Count the bits that are set in an array of 64-bit words '''
+    count = 0
+    for x in bits:
+        x = x - ((x >> _one) & _m1)
+        x = (x & _m2) + ((x >> _b2) & _m2)
+        x = (x + (x >> _b4)) & _m4
+        count += np.int64((x * _h01) >> _b56)
+    return count
+
+
 
 #%% Sampling and seed methods
 
@@ -278,6 +1160,7 @@ def set_seed(seed=None):
     if seed is None: # Numba can't accept a None seed, so use our just-reinitialized Numpy stream to generate one
         seed = np.random.randint(1e9)
     set_seed_numba(seed)
+    set_rng_key(seed) # Reset the counter-based stream used for multithreaded calculations
     random.seed(seed) # Finally, reset Python's built-in random number generator, just in case (used by SynthPops)
 
     return
@@ -286,7 +1169,7 @@ def set_seed(seed=None):
 #%% Probabilities -- mostly not jitted since performance gain is minimal
 
 __all__ += ['n_binomial', 'binomial_filter', 'binomial_arr', 'n_multinomial',
-            'poisson', 'n_poisson', 'n_neg_binomial', 'choose', 'choose_r', 'choose_w']
+            'poisson', 'n_poisson', 'n_neg_binomial', 'choose', 'choose_r', 'choose_w', 'choose_sparse']
 
 def n_binomial(prob, n):
     '''
@@ -360,10 +1243,11 @@ def n_multinomial(probs, n): # No speed gain from Numba
     return np.searchsorted(np.cumsum(probs), np.random.random(n))
 
 
-@nb.njit((nbfloat,), cache=cache, parallel=rand_parallel) # Numba hugely increases performance
 def poisson(rate):
     '''
-    A Poisson trial.
+    A Poisson trial. If ``cv.options.numba_parallel`` is "full", the counter-based
+    random number stream is used (see cb_poisson()), like the other random numbers
+    drawn in parallel, rather than the Numba stream.
 
     Args:
         rate (float): the rate of the Poisson process
@@ -372,13 +1256,16 @@ def poisson(rate):
 
         outcome = cv.poisson(100) # Single Poisson trial with mean 100
     '''
-    return np.random.poisson(rate, 1)[0]
+    if rand_parallel:
+        return cb_poisson(rate, *next_stream(), np.uint64(0))
+    return np_poisson(rate)
 
 
-@nb.njit((nbfloat, nbint), cache=cache, parallel=rand_parallel) # Numba hugely increases performance
 def n_poisson(rate, n):
     '''
-    An array of Poisson trials.
+    An array of Poisson trials. If ``cv.options.numba_parallel`` is "full", they
+    are computed in parallel using the counter-based random number stream (see
+    poisson()).
 
     Args:
         rate (float): the rate of the Poisson process (mean)
@@ -388,9 +1275,32 @@ def n_poisson(rate, n):
 
         outcomes = cv.n_poisson(100, 20) # 20 Poisson trials with mean 100
     '''
+    if rand_parallel:
+        return cb_n_poisson(rate, n, *next_stream())
+    return np_n_poisson(rate, n)
+
+
+@nb.njit((nbfloat,), cache=cache) # Numba hugely increases performance
+def np_poisson(rate): # pragma: no cover
+    ''' Version of poisson() using the Numba random number stream '''
+    return np.random.poisson(rate, 1)[0]
+
+
+@nb.njit((nbfloat, nbint), cache=cache) # Numba hugely increases performance
+def np_n_poisson(rate, n): # pragma: no cover
+    ''' Version of n_poisson() using the Numba random number stream '''
     return np.random.poisson(rate, n)
 
 
+@nb.njit((nb.float64, nb.int64, nb.uint64, nb.uint64), cache=cache, parallel=rand_parallel)
+def cb_n_poisson(rate, n, key, stream): # pragma: no cover
+    ''' Counter-based version of n_poisson(), with each trial computed independently '''
+    out = np.empty(n, dtype=np.int64)
+    for i in nb.prange(n):
+        out[i] = cb_poisson(rate, key, stream, np.uint64(i))
+    return out
+
+
 def n_neg_binomial(rate, dispersion, n, step=1): # Numba not used due to incompatible implementation
     '''
     An array of negative binomial trials. See cv.sample() for more explanation.
@@ -444,6 +1354,35 @@ def choose_r(max_n, n):
     return np.random.choice(max_n, n, replace=True)
 
 
+@nb.njit((nbint, nbint), cache=cache)
+def choose_sparse(max_n, n): # pragma: no cover
+    '''
+    Choose a subset of items without replacement, like choose(), but in a time
+    proportional to the number of items chosen rather than the total number of
+    items, using Floyd's algorithm. The items are not in random order. Useful for
+    choosing a few items from a very large number, e.g. edges of a contact layer.
+
+    Args:
+        max_n (int): the total number of items
+        n (int): the number of items to choose
+
+    **Example**::
+
+        choices = cv.choose_sparse(100_000_000, 10) # choose 10 out of 100 million edges with equal probability (without repeats)
+    '''
+    if 10*n > max_n: # Choosing a large fraction is faster with a permutation
+        return np.random.choice(max_n, n, replace=False)
+    chosen = set()
+    choices = np.empty(n, dtype=np.int64)
+    for k,j in enumerate(range(max_n-n, max_n)):
+        choice = np.random.randint(0, j+1)
+        if choice in chosen:
+            choice = j
+        chosen.add(choice)
+        choices[k] = choice
+    return choices
+
+
 def choose_w(probs, n, unique=True): # No performance gain from Numba
     '''
     Choose n items (e.g. people), each with a probability from the distribution probs.
@@ -4,6 +4,6 @@ Version and license information.
 
 __all__ = ['__version__', '__versiondate__', '__license__']
 
-__version__ = '3.0.7'
-__versiondate__ = '2021-06-29'
+__version__ = '3.0.8'
+__versiondate__ = '2026-10-18'
 __license__ = f'Covasim {__version__} ({__versiondate__}) — © 2021 by IDM'
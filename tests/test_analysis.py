@@ -168,6 +168,22 @@ def test_transtree():
 
     transtree = sim.make_transtree()
     print(len(transtree))
+
+    # Check the infection log's columns against its list-of-dicts view
+    log = sim.people.infection_log
+    entries = log.to_list()
+    assert len(entries) == len(log) == len(transtree)
+    assert [e['target'] for e in entries] == log.target.tolist()
+    assert [e['source'] for e in entries if e['source'] is not None] == transtree.source_inds
+    log2 = cv.InfectionLog(entries)
+    assert log2.to_df().equals(log.to_df())
+    assert len(sc.dcp(log)) == len(log)
+
+    # Check that the columns are widened for values that don't fit
+    log3 = cv.InfectionLog()
+    for i in range(200):
+        log3.add([i], date=40000+i, layer=f'layer{i}')
+    assert log3[-1]['date'] == 40199 and log3[-1]['layer'] == 'layer199'
     if do_plot:
         transtree.plot()
         transtree.animate(animate=False)
@@ -120,6 +120,15 @@ def test_waning(do_plot=False):
             assert v1 > v0, f'Expected {key} to be higher with waning ({v1}) than without ({v0})'
             print(f'✓ ({v1} > {v0})')
 
+        # Check that calculating population immunity from running sums gives the same results
+        cv.options.set(immunity_sums=True)
+        try:
+            s2 = cv.Sim(base_pars, **pars, use_waning=True).run()
+        finally:
+            cv.options.set(immunity_sums=False)
+        for key in ['pop_nabs', 'pop_protection', 'pop_symp_protection']:
+            assert np.allclose(s1.results[key].values, s2.results[key].values, rtol=1e-5), f'Population immunity {key} from running sums does not match'
+
         # Optionally plot
         if do_plot:
             msim.plot('overview-variant', rotation=30)
@@ -279,6 +288,19 @@ def test_decays(do_plot=False):
 
     res.x = x
 
+    # Check that retiring people whose NAbs have stopped changing doesn't change the results
+    sims = []
+    try:
+        for retire in [False, True]:
+            cv.options.set(retire_nabs=retire)
+            nab_decay = dict(form='exp_decay', init_val=1, half_life=5)
+            sim = cv.Sim(base_pars, n_days=150, use_waning=True, nab_decay=nab_decay, interventions=cv.vaccinate_prob('pfizer', days=20, prob=0.05))
+            sims.append(sim.run())
+    finally:
+        cv.options.set(retire_nabs=False)
+    assert np.array_equal(sims[0].people.nab, sims[1].people.nab)
+    assert len(sims[1].people._nab_active.inds) < cv.true(sims[1].people.peak_nab).size
+
     return res
 
 
@@ -5,7 +5,9 @@ corner cases or otherwise not part of major workflows.
 
 #%% Imports and settings
 import os
+import shutil
 import pytest
+import contextlib
 import numpy as np
 import sciris as sc
 import covasim as cv
@@ -27,6 +29,27 @@ def remove_files(*args):
     return
 
 
+@contextlib.contextmanager
+def use_options(**kwargs):
+    ''' Set options for part of a test, restoring them afterwards even if it fails '''
+    orig = {key:cv.options[key] for key in kwargs}
+    cv.options.set(**kwargs)
+    try:
+        yield
+    finally:
+        cv.options.set(**orig)
+
+
+def run_with_options(**kwargs):
+    ''' Run a small sim with and without the given options, and check that the results are the same '''
+    pars = dict(pop_size=100, n_days=10, verbose=verbose, pop_type='hybrid', beta=0.02, dynam_layer={'c':0})
+    base = cv.Sim(pars).run()
+    with use_options(**kwargs):
+        sim = cv.Sim(pars).run()
+    assert not cv.diff_sims(base, sim, output=True)
+    return base, sim
+
+
 #%% Define the tests
 
 def test_base():
@@ -133,6 +156,51 @@ def test_basepeople():
     assert len(layer2) == n
     assert len(layer2.keys()) == 5
 
+    # Check the per-person edge index, including after the layer is modified
+    csr = layer.get_index(n=n_people)
+    assert np.array_equal(csr.p1_edges[csr.p1_ptr[5]:csr.p1_ptr[6]], cv.true(layer['p1'] == 5))
+    assert np.array_equal(csr.p2_edges[csr.p2_ptr[5]:csr.p2_ptr[6]], cv.true(layer['p2'] == 5))
+    assert layer.get_index() is csr
+    layer.append(layer.pop_inds(np.arange(10)))
+    csr = layer.get_index(n=n_people)
+    assert np.array_equal(csr.p1_edges[csr.p1_ptr[5]:csr.p1_ptr[6]], cv.true(layer['p1'] == 5))
+
+    # Check that changing the edges discards the index
+    for change in [lambda: layer.pop_inds(np.arange(5), in_place=True), lambda: layer.append(layer.pop_inds(np.arange(5))), lambda: layer.__setitem__('p1', layer['p1'][::-1].copy())]:
+        layer.get_index(n=n_people)
+        change()
+        assert layer._index is None
+    csr = layer.get_index(n=n_people)
+    assert np.array_equal(csr.p1_edges[csr.p1_ptr[5]:csr.p1_ptr[6]], cv.true(layer['p1'] == 5))
+
+    # Check that finding contacts and members with the index matches scanning every edge
+    inds = np.array([0, 5, 17, 999, n_people+10])
+    contacts = cv.utils.find_contacts(layer['p1'], layer['p2'], inds)
+    assert layer.find_contacts(inds, as_array=False) == contacts
+    assert np.array_equal(layer.find_contacts(inds), np.sort(list(contacts)))
+    assert np.array_equal(layer.members, np.unique([layer['p1'], layer['p2']]))
+    missing = np.setdiff1d(np.arange(n_people), layer.members)
+    assert all(i in layer for i in layer.members[:10])
+    assert all(i not in layer for i in missing[:10].tolist() + [-1, n_people+10])
+
+    # Check that removing edges in place and restoring them keeps the same edges
+    n_edges = len(layer)
+    edges = set(zip(layer['p1'], layer['p2']))
+    popped = layer.pop_inds(cv.choose_sparse(n_edges, 100), in_place=True)
+    assert len(layer) == n_edges - 100
+    assert not edges - set(zip(layer['p1'], layer['p2'])) - set(zip(popped['p1'], popped['p2']))
+    layer.append(popped)
+    assert set(zip(layer['p1'], layer['p2'])) == edges
+    assert layer._storage('p1') is not layer['p1'] # Restored into the space left by the removed edges
+
+    # Check that adding edges a few at a time leaves spare capacity
+    daily = cv.Layer()
+    for day in range(10):
+        daily.append(dict(p1=np.arange(5)+day, p2=np.arange(5), beta=np.ones(5)))
+    assert np.array_equal(daily['p1'], (np.arange(5)[None,:] + np.arange(10)[:,None]).ravel())
+    assert daily['p1'].dtype == cv.default_int
+    assert len(daily._storage('beta')) > len(daily) == 50
+
     # Test dynamic layers, plotting, and stories
     pars = dict(pop_size=100, n_days=10, verbose=verbose, pop_type='hybrid', beta=0.02)
     s1 = cv.Sim(pars, dynam_layer={'c':1})
@@ -146,6 +214,20 @@ def test_basepeople():
     s2.run()
     assert cv.diff_sims(s1, s2, output=True)
 
+    # Check quarantine scheduling, including extensions, people scheduled more than once, and people who are no longer eligible
+    s4 = cv.Sim(pars)
+    s4.initialize()
+    qppl = s4.people
+    qppl.quarantined[0] = True
+    qppl.date_end_quarantine[0] = 5
+    qppl.diagnosed[1] = True
+    qppl.schedule_quarantine([0, 1, 2, 3], period=10)
+    qppl.schedule_quarantine(np.array([3, 2]), period=14)
+    qppl.schedule_quarantine([4], start_date=1)
+    assert qppl.check_quar() == 2
+    assert qppl.quarantined[:5].tolist() == [True, False, True, True, False]
+    assert qppl.date_end_quarantine[[0,2,3]].tolist() == [10, 14, 14]
+
     # Create a bare People object
     ppl = cv.People(100)
     with pytest.raises(sc.KeyNotFoundError): # Need additional parameters
@@ -154,6 +236,111 @@ def test_basepeople():
     return
 
 
+def test_indexed_people():
+    sc.heading('Testing the layer index, sparse viral loads, the event queue, and state index sets...')
+
+    # Check that these don't change the results, and that the state index sets match the states
+    base, sim = run_with_options(layer_index=True, sparse_viral_load=True, event_queue=True, state_index=True)
+    with use_options(state_index=True):
+        for key in ['exposed', 'recovered', 'dead']:
+            assert np.array_equal(sim.people.true(key), cv.true(sim.people[key]))
+        sppl = sc.dcp(sim.people)
+        for key in ['exposed', 'infectious', 'symptomatic', 'severe', 'critical', 'quarantined']:
+            assert sppl.count(key) == np.count_nonzero(sppl[key]) # The running counts match the states
+        inds = cv.false(sppl.quarantined)[:10]
+        sppl.set_state('quarantined', np.concatenate([inds, inds]), True) # People listed twice are only counted once
+        sppl.set_state('quarantined', inds[:5], False)
+        assert sppl.count('quarantined') == np.count_nonzero(sppl.quarantined)
+        n_exposed = sppl.count('exposed')
+        sppl['age'] = sppl.age.copy() # Replacing an array that isn't a state keeps the index sets
+        assert sppl._state_inds is not None and sppl.count('exposed') == n_exposed
+        sppl['exposed'] = np.zeros(len(sppl), dtype=bool) # Replacing a state resets them
+        assert sppl._state_inds is None and sppl.count('exposed') == 0 and len(sppl.true('exposed')) == 0
+
+    return sim
+
+
+def test_columnar_people():
+    sc.heading('Testing storing the people arrays in a single buffer...')
+
+    # Check that this doesn't change the results, and survives copying, combining, and resizing
+    base, sim = run_with_options(columnar_people=True)
+    cppl = sim.people
+    buffer = cppl._columns.buffer
+    assert all(np.shares_memory(cppl[key], buffer) for key in cppl._columns.keys())
+    cppl2 = sc.dcp(cppl)
+    assert not any(np.shares_memory(cppl2[key], buffer) for key in cppl.keys())
+    assert all(np.array_equal(cppl2[key], cppl[key], equal_nan=True) for key in cppl.keys())
+    cppl3 = cppl + cppl2
+    assert len(cppl3) == len(cppl3.age) == 2*len(cppl)
+    assert all(np.shares_memory(cppl3[key], cppl3._columns.buffer) for key in cppl3._columns.keys())
+    cppl._resize_arrays(new_size=200)
+    assert np.array_equal(cppl.age[:100], cppl2.age) and len(cppl.dead) == 200
+
+    return sim
+
+
+def test_packed_states():
+    sc.heading('Testing packing the states into bits...')
+
+    # Check that this doesn't change the results, and that the states can still be used like Boolean arrays
+    base, sim = run_with_options(packed_states=True)
+    pppl = sim.people
+    for key in ['susceptible', 'exposed', 'recovered', 'dead', 'exposed_by_variant', 'infectious_by_variant']:
+        assert np.array_equal(np.asarray(pppl[key]), base.people[key])
+        assert pppl.count(key) == base.people.count(key)
+    for key in ['susceptible', 'recovered']:
+        assert np.array_equal(pppl.true(key), base.people.true(key)) and np.array_equal(pppl.false(key), base.people.false(key))
+    assert np.array_equal(pppl.match(recovered=True, naive=False), base.people.match(recovered=True, naive=False))
+    assert pppl.count_by_variant('exposed_by_variant', 0) == base.people.count_by_variant('exposed_by_variant', 0)
+    df = pppl.to_df()
+    assert np.array_equal(df['exposed'], base.people.exposed) and np.array_equal(df['exposed_by_variant_0'], pppl.exposed_by_variant[0])
+    inds = np.array([3, 1, -1])
+    pppl.tested[inds] = [True, False, True]
+    pppl.exposed_by_variant[0, inds] = True
+    assert list(pppl.tested[inds]) == [True, False, True] and pppl.exposed_by_variant[0, inds].all()
+    pppl2 = pppl + sc.dcp(pppl)
+    assert len(pppl2.dead) == 200 and np.array_equal(pppl2.tested[100:], pppl.tested[:])
+
+    return sim
+
+
+def test_compact_days():
+    sc.heading('Testing storing dates and durations as integers...')
+
+    # Check that this doesn't change the results, and that they are still read as floats with NaN
+    base, sim = run_with_options(compact_days=16)
+    dppl = sim.people
+    for key in ['date_exposed', 'date_recovered', 'dur_disease']:
+        assert dppl[key].days.dtype == np.int16
+        assert np.array_equal(np.asarray(dppl[key]), base.people[key], equal_nan=True)
+        assert np.array_equal(dppl.defined(key), base.people.defined(key)) and np.array_equal(dppl.undefined(key), base.people.undefined(key))
+    dppl.date_diagnosed[[0, 1]] = [np.nan, 3]
+    assert np.isnan(dppl.date_diagnosed[0]) and dppl.date_diagnosed[1] == 3
+    with pytest.raises(ValueError):
+        dppl.date_diagnosed[2] = 3.5
+
+    return sim
+
+
+def test_lazy_people():
+    sc.heading('Testing creating the people arrays on first use...')
+
+    # Check that the arrays for immunity, vaccination, and other variants aren't created unless they're used, and are the same when they are
+    pars = dict(pop_size=100, n_days=10, verbose=verbose, pop_type='hybrid', beta=0.02)
+    lppl = cv.Sim(pars, dynam_layer={'c':0}).run().people
+    by_variant = ['exposed_by_variant', 'infectious_by_variant']
+    lazy = ['sus_imm', 'nab', 'vaccinations'] + ([] if cv.options.packed_states else by_variant) # Packed states are always held as bits
+    assert not any(lppl.allocated(key) for key in lazy)
+    counts = [lppl.count_by_variant(key, 0) for key in by_variant]
+    assert lppl.exposed_by_variant.shape == (1, len(lppl)) and not lppl.sus_imm.any()
+    assert lppl.allocated('exposed_by_variant') and not lppl.allocated('nab')
+    assert counts == [lppl.count_by_variant(key, 0) for key in by_variant] and counts[0] == lppl.count('exposed')
+    assert cv.Sim(pars, use_waning=True).initialize().people.allocated('nab')
+
+    return lppl
+
+
 def test_misc():
     sc.heading('Testing miscellaneous functions')
 
@@ -291,6 +478,23 @@ def test_population():
         errormsg = f'Synthpops test did not pass:\n{str(E)}\nNote: synthpops is optional so this exception is OK.'
         print(errormsg)
 
+    # Convert a pre-generated SynthPops-style population, which doesn't need synthpops
+    population = {
+        'a': dict(age=40, sex=0, contacts={'H':{'b', 'c'}, 'W':{'d'}}),
+        'b': dict(age=42, sex=1, contacts={'H':{'a', 'c'}, 'W':set()}),
+        'c': dict(age=10, sex=0, contacts={'H':{'a', 'b'}, 'W':set()}),
+        'd': dict(age=30, sex=1, contacts={'H':set(), 'W':{'a'}}),
+    }
+    popdict = cv.make_synthpop(population=population, community_contacts=2)
+    contacts = popdict['contacts']
+    assert popdict['uid'].tolist() == [0, 1, 2, 3]
+    assert popdict['age'].tolist() == [40, 42, 10, 30]
+    assert sorted(zip(contacts['h']['p1'], contacts['h']['p2'])) == [(0,1), (0,2), (1,2)]
+    assert list(zip(contacts['w']['p1'], contacts['w']['p2'])) == [(0,3)]
+    assert 'c' in contacts
+    with pytest.raises(sc.KeyNotFoundError):
+        cv.make_synthpop(population={0:dict(age=40, sex=0, contacts={'H':{1}})}, community_contacts=2)
+
     # Not working
     with pytest.raises(ValueError):
         sim = cv.Sim(pop_type='not_an_option')
@@ -306,6 +510,62 @@ def test_population():
 
     remove_files(pop_path)
 
+    # Save/load as memory-mapped columns
+    pop_folder = 'pop_test_columns/'
+    s1 = cv.Sim(pop_size=100, n_days=20, popfile=pop_folder, save_pop=True)
+    s1.run()
+    s2 = cv.Sim(pop_size=100, n_days=20, popfile=pop_folder, load_pop=True)
+    s2.run()
+    assert not cv.diff_sims(s1, s2, output=True)
+    people = cv.People.load_columns(pop_folder)
+    assert people.susceptible.all() and not np.shares_memory(people.age, s2.people.age) # Changes are not written to the files
+    assert np.array_equal(people.contacts['a']['p2'], s1.people.contacts['a']['p2'])
+    with use_options(columnar_people=True): # Mapped arrays aren't copied into a buffer
+        people = cv.People.load_columns(pop_folder)
+        assert people._columns is None and not people.age.flags.owndata
+    shutil.rmtree(pop_folder)
+
+    # Random contacts generated directly as layers match the contacts list
+    contacts = dict(a=4, b=2)
+    cv.set_seed(1)
+    contacts_list, layer_keys = cv.make_random_contacts(100, contacts)
+    cv.set_seed(1)
+    layers, layer_keys2 = cv.make_random_contacts(100, contacts, as_layers=True)
+    assert layer_keys == layer_keys2
+    for lkey in layer_keys:
+        p1 = np.concatenate([np.full(len(c[lkey]), i) for i,c in enumerate(contacts_list)])
+        p2 = np.concatenate([c[lkey] for c in contacts_list])
+        assert np.array_equal(layers[lkey]['p1'], p1)
+        assert np.array_equal(layers[lkey]['p2'], p2)
+
+    # Likewise for clustered contacts, which should connect everyone in each cluster
+    cv.set_seed(1)
+    contacts_list, layer_keys, clusters = cv.make_microstructured_contacts(1000, contacts)
+    cv.set_seed(1)
+    layers, layer_keys2, clusters2 = cv.make_microstructured_contacts(1000, contacts, as_layers=True)
+    edgelist = cv.People(1000).make_edgelist(contacts_list)
+    for lkey in layer_keys:
+        assert np.array_equal(layers[lkey]['p1'], edgelist[lkey]['p1'])
+        assert np.array_equal(layers[lkey]['p2'], edgelist[lkey]['p2'])
+        members = clusters2[lkey][layers[lkey]['p1']]
+        assert np.array_equal(members, clusters2[lkey][layers[lkey]['p2']])
+        sizes = np.bincount(clusters2[lkey])
+        assert len(layers[lkey]) == np.sum(sizes*(sizes-1)//2)
+        assert [len(inds) for inds in clusters[lkey].values()] == sizes.tolist()
+
+    # Likewise for hybrid contacts
+    ages = np.random.uniform(0, 90, 1000)
+    cv.set_seed(1)
+    contacts_list, layer_keys, _ = cv.make_hybrid_contacts(1000, ages, {})
+    cv.set_seed(1)
+    layers, layer_keys2, _ = cv.make_hybrid_contacts(1000, ages, {}, as_layers=True)
+    assert layer_keys == layer_keys2 == list(layers.keys())
+    edgelist = cv.People(1000).make_edgelist(contacts_list)
+    for lkey in layer_keys:
+        assert np.array_equal(layers[lkey]['p1'], edgelist[lkey]['p1'])
+        assert np.array_equal(layers[lkey]['p2'], edgelist[lkey]['p2'])
+    assert np.all(ages[layers['s']['p1']] < 22) and np.all(ages[layers['w']['p2']] >= 22)
+
     return
 
 
@@ -460,6 +720,11 @@ if __name__ == '__main__':
 
     test_base()
     test_basepeople()
+    test_indexed_people()
+    test_columnar_people()
+    test_packed_states()
+    test_compact_days()
+    test_lazy_people()
     test_misc()
     test_plotting()
     test_population()
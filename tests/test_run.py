@@ -59,6 +59,39 @@ def test_multirun(do_plot=do_plot): # If being run via pytest, turn off
     return sims
 
 
+def test_shared_static():
+    sc.heading('Multirun with shared static arrays test')
+
+    n_runs = 3
+    pars = dict(pop_size=pop_size, pop_type='hybrid', n_days=30, verbose=verbose)
+    intervs = lambda: cv.clip_edges(days=10, changes=0.5, layers='h') # Removes edges from a shared layer
+
+    sim1 = cv.Sim(pars, interventions=intervs())
+    sim1.initialize() # Otherwise each run would create its own population
+    sims1 = cv.multi_run(sim1, n_runs=n_runs, keep_people=True)
+
+    sim2 = cv.Sim(pars, interventions=intervs())
+    sims2 = cv.multi_run(sim2, n_runs=n_runs, keep_people=True, share_static=True)
+    assert sim2.initialized and len(sim2.people.contacts['h']) == len(sim1.people.contacts['h']) # The arrays are restored after the runs
+    for s1,s2 in zip(sims1, sims2):
+        assert s1.summary == s2.summary
+        assert np.array_equal(s1.people.age, s2.people.age)
+        assert np.array_equal(s1.people.contacts['h']['p1'], s2.people.contacts['h']['p1'])
+
+    # Check that initializing the people again replaces the shared arrays, rather than writing into them
+    shared = cv.SharedPeople(sim1)
+    sim3 = sc.dcp(sim1)
+    shared.attach(sim3)
+    rel_trans = shared.buffer['rel_trans'].copy()
+    sim3.people.pars['rand_seed'] += 1
+    sim3.people.set_prognoses()
+    assert np.array_equal(shared.buffer['rel_trans'], rel_trans) and not np.array_equal(sim3.people.rel_trans, rel_trans)
+    shared.strip(sim3) # Release the views into the shared memory before closing it
+    shared.close()
+
+    return sims2
+
+
 def test_multisim_reduce(do_plot=do_plot): # If being run via pytest, turn off
     sc.heading('Combine results test')
 
@@ -258,6 +291,7 @@ if __name__ == '__main__':
 
     sim1   = test_singlerun()
     sims2  = test_multirun(do_plot=do_plot)
+    sims3  = test_shared_static()
     msim1  = test_multisim_reduce(do_plot=do_plot)
     msim2  = test_multisim_combine(do_plot=do_plot)
     m1,m2  = test_multisim_advanced()
@@ -3,6 +3,10 @@ Tests of the numerical utilities for the model.
 '''
 
 #%% Imports and settings
+import os
+import sys
+import subprocess
+import tempfile
 import pytest
 import numpy as np
 import numba as nb
@@ -53,6 +57,49 @@ def test_rand():
     return a
 
 
+def test_counter_rng():
+    sc.heading('Counter-based random numbers')
+    u = np.uint64
+
+    # Check against the Random123 known-answer tests for Philox4x32-10
+    assert cv.utils.philox(u(0), u(0), u(0), u(0), u(0), u(0)) == (0x6627e8d5, 0xe169c58d, 0xbc57ac4c, 0x9b00dbd8)
+    assert cv.utils.philox(u(0xa4093822), u(0x299f31d0), u(0x243f6a88), u(0x85a308d3), u(0x13198a2e), u(0x03707344)) == (0xd16cfe09, 0x94fdcceb, 0x5001e420, 0x24126ea1)
+
+    # Check that the stream is reset by the seed, and that draws don't depend on the order they're computed in
+    cv.set_seed(1)
+    key, stream = cv.utils.next_stream()
+    p1 = cv.utils.cb_n_poisson(5.0, 1000, key, stream)
+    p2 = np.array([cv.utils.cb_poisson(5.0, key, stream, u(i)) for i in range(1000)[::-1]])[::-1]
+    cv.set_seed(1)
+    assert cv.utils.next_stream() == (key, stream)
+    assert np.array_equal(p1, p2)
+
+    # Check the distributions
+    r = np.array([cv.utils.cb_random(key, stream, u(i), u(0)) for i in range(10000)])
+    assert (r >= 0).all() and (r < 1).all()
+    assert abs(r.mean() - 0.5) < 0.02
+    for rate in [0.5, 5, 50]:
+        assert abs(cv.utils.cb_n_poisson(rate, 10000, key, stream).mean() - rate) < 0.1*rate
+
+    return p1
+
+
+def test_parallel_rng():
+    sc.heading('Multithreaded results with the counter-based stream')
+
+    # The parallel option is fixed when Covasim is imported, so run the sims in new processes, with different numbers of threads
+    code = 'import covasim as cv; sim = cv.Sim(pop_size=2000, pop_type="hybrid", n_days=30, n_imports=1, verbose=0).run(); print(sim.results["cum_infections"][-1], sim.people.contacts["c"]["p1"].sum())'
+    outputs = []
+    with tempfile.TemporaryDirectory() as cache_dir: # Keep the compiled parallel functions separate from the usual cache
+        for threads in ['1', '1', '4']:
+            env = dict(os.environ, COVASIM_NUMBA_PARALLEL='full', NUMBA_CACHE_DIR=cache_dir, NUMBA_NUM_THREADS=threads)
+            result = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True)
+            outputs.append(result.stdout.strip().splitlines()[-1])
+    assert outputs[0] == outputs[1] == outputs[2]
+
+    return outputs
+
+
 def test_poisson():
     sc.heading('Poisson distribution')
     s1 = cv.poisson_test(10, 10)
@@ -228,6 +275,158 @@ def test_indexing():
     return
 
 
+def test_transmission():
+    sc.heading('Fused transmission kernel')
+
+    # Create a population and some layers
+    n = 1000
+    sim = cv.Sim(pop_size=n, pop_type='hybrid', pop_infected=100, rand_seed=1, verbose=0)
+    sim.run(until=10)
+    people = sim.people
+    lkeys = people.layer_keys()
+    beta = cv.default_float(sim['beta'])
+    viral_load = np.random.random(n).astype(cv.default_float)
+    args = [np.asarray(arr) for arr in [people.rel_trans, people.rel_sus, people.infectious, people.susceptible, people.symptomatic, people.diagnosed, people.quarantined, people.sus_imm[0,:]]] # In case the states are packed into bits
+    rel_trans, rel_sus, inf, sus, symp, diag, quar, sus_imm = args
+    factors = [np.array([sim[key][lkey] for lkey in lkeys], dtype=cv.default_float) for key in ['beta_layer', 'iso_factor', 'quar_factor']]
+
+    # Compute transmission layer by layer
+    cv.set_seed(1)
+    sus = sus.copy()
+    orig = []
+    for l,lkey in enumerate(lkeys):
+        layer = people.contacts[lkey]
+        trans, rsus = cv.utils.compute_trans_sus(rel_trans, rel_sus, inf, sus, factors[0][l], viral_load, symp, diag, quar, sim['asymp_factor'], factors[1][l], factors[2][l], sus_imm)
+        for sources, targets in [[layer['p1'], layer['p2']], [layer['p2'], layer['p1']]]:
+            orig.append(cv.utils.compute_infections(beta, sources, targets, layer['beta'], trans, rsus))
+        sus[np.concatenate([o[1] for o in orig[-2:]])] = False
+
+    # Compute it in a single pass, with and without the layer index, and check they match
+    for indexed in [False, True]:
+        cv.set_seed(1)
+        layer_arrays = cv.utils.layer_lists(people.contacts, indexed=[indexed]*len(lkeys), n=n)
+        sources, targets, layers, passes = cv.utils.compute_transmission(beta, *layer_arrays, *factors, rel_trans, rel_sus, viral_load, inf, cv.true(inf), args[3], symp, diag, quar, sim['asymp_factor'], sus_imm, *cv.utils.next_stream())
+        assert passes[-1] == len(sources) == len(targets) == len(layers)
+        for i,(o_sources, o_targets) in enumerate(orig):
+            start, end = passes[i], passes[i+1]
+            assert np.array_equal(o_sources, sources[start:end])
+            assert np.array_equal(o_targets, targets[start:end])
+            assert (layers[start:end] == i//2).all()
+        assert len(sources) > 0
+
+    return sources, targets
+
+
+def test_viral_load():
+    sc.heading('Viral load switch points')
+
+    # Create random dates, including non-integer, zero-length, and missing ones
+    n = 10000
+    f = cv.default_float
+    start = np.round(np.random.random(n)*60, 1).astype(f)
+    recovered = start + np.random.randint(0, 30, n).astype(f)
+    dead = np.full(n, np.nan, dtype=f)
+    died = np.random.random(n) < 0.1
+    dead[died] = recovered[died]
+    recovered[died] = np.nan
+    start[np.random.random(n) < 0.05] = np.nan
+
+    # Check that the switch points give the same viral loads as the full calculation
+    frac_time, load_ratio, high_cap = f(0.3), f(2), f(4)
+    switch = cv.utils.compute_viral_switch(start, recovered, dead, frac_time, high_cap)
+    high = load_ratio/(1 + frac_time*(load_ratio - 1))
+    low = 1/(1 + frac_time*(load_ratio - 1))
+    for t in range(100):
+        load = cv.utils.compute_viral_load(t, start, recovered, dead, frac_time, load_ratio, high_cap)
+        assert np.array_equal(load, np.where(t < switch, high, low).astype(f))
+
+    return switch
+
+
+def test_immunity_groups():
+    sc.heading('Immunity groups')
+
+    # Create random states, including people who have not recovered
+    n = 10000
+    f = cv.default_float
+    sus = np.random.random(n) < 0.5
+    vacc = np.random.random(n) < 0.3
+    date_rec = np.random.randint(0, 60, n).astype(f)
+    date_rec[np.random.random(n) < 0.5] = np.nan
+    rec_variant = np.random.randint(0, 3, n).astype(f)
+    nab = np.random.random(n).astype(f)
+    cross_imm = np.array([0.5, 1.0, 0.25], dtype=f)
+    t, variant = 30, 1
+
+    # Check against the equivalent set calculations
+    was_inf = cv.true(t >= date_rec)
+    vacc_inds, inf, inf_nab = cv.utils.immunity_groups(sus, vacc, date_rec, rec_variant, nab, cross_imm, t, variant)
+    assert np.array_equal(vacc_inds, np.setdiff1d(np.intersect1d(cv.true(sus), cv.true(vacc)), was_inf))
+    assert np.array_equal(inf, np.intersect1d(cv.true(sus), was_inf))
+    assert np.array_equal(inf_nab, nab[inf]*cross_imm[rec_variant[inf].astype(int)])
+
+    return vacc_inds, inf, inf_nab
+
+
+def test_cliques():
+    sc.heading('Clique edges')
+
+    # Clusters of many sizes, so that people are at many offsets into the hash table
+    sizes = np.array([1, 2, 7, 5, 30, 1, 100, 600, 3, 1200, 9, 2000], dtype=np.int64)
+    n_edges = int(np.sum(sizes*(sizes-1)//2))
+    for set_order in [True, False]:
+        p1 = np.empty(n_edges, dtype=cv.default_int)
+        p2 = np.empty(n_edges, dtype=cv.default_int)
+        cv.utils.make_cliques(sizes, p1, p2, set_order)
+
+        # Check each person's partners against iterating over a real set of them, or against sorting them
+        start = 0
+        e = 0
+        for size in sizes.tolist():
+            end = start + size
+            for i in range(start, end-1):
+                partners = set(range(i+1, end))
+                expected = list(partners) if set_order else sorted(partners)
+                n = end - 1 - i
+                assert (p1[e:e+n] == i).all() and p2[e:e+n].tolist() == expected
+                e += n
+            start = end
+
+    return p1, p2
+
+
+def test_prognoses():
+    sc.heading('Compiled prognoses')
+
+    # Run a sim with the outcomes of new infections determined in a single compiled pass
+    cv.options.set(fast_prognoses=True)
+    try:
+        sim = cv.Sim(pop_size=20e3, pop_infected=2000, n_days=60, verbose=0)
+        sim.run()
+    finally:
+        cv.options.set(fast_prognoses=False)
+    ppl = sim.people
+
+    # Check that the durations have the right means, and the dates are consistent
+    inf = cv.true(ppl.date_exposed == 0)
+    symp = inf[~np.isnan(ppl.date_symptomatic[inf])]
+    assert abs(ppl.dur_exp2inf[inf].mean() - sim['dur']['exp2inf']['par1']) < 0.2
+    assert abs(ppl.dur_inf2sym[symp].mean() - sim['dur']['inf2sym']['par1']) < 0.2
+    assert np.array_equal(ppl.date_infectious[inf], ppl.dur_exp2inf[inf])
+    assert np.array_equal(ppl.date_symptomatic[symp], ppl.date_infectious[symp] + ppl.dur_inf2sym[symp])
+    assert np.all(np.isnan(ppl.date_recovered[inf]) != np.isnan(ppl.date_dead[inf]))
+    assert 0 < len(symp) < len(inf)
+    assert sim.results['cum_deaths'][-1] > 0
+
+    # Check that distributions which cannot be drawn from a normal sample are handled separately
+    durpars = sc.dcp(sim['dur'])
+    assert cv.utils.prognosis_pars(durpars) is not None
+    durpars['exp2inf'] = dict(dist='poisson', par1=4, par2=None)
+    assert cv.utils.prognosis_pars(durpars) is None
+
+    return sim
+
+
 def test_doubling_time():
 
     sim = cv.Sim(pop_size=1000)
@@ -257,11 +456,18 @@ if __name__ == '__main__':
     T = sc.tic()
 
     rnd1    = test_rand()
+    rnd3    = test_counter_rng()
+    rnd4    = test_parallel_rng()
     rnd2    = test_poisson()
     samples = test_samples(do_plot=do_plot)
     people1 = test_choose()
     people2 = test_choose_w()
     inds    = test_indexing()
+    trans   = test_transmission()
+    switch  = test_viral_load()
+    groups  = test_immunity_groups()
+    cliques = test_cliques()
+    progs   = test_prognoses()
     dt      = test_doubling_time()
 
     print('\n'*2)